@@ -0,0 +1,264 @@
+import time
+import boto3
+import logging
+import threading
+from collections import defaultdict, OrderedDict
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+from config import (
+    AWS_MAX_ATTEMPTS, RETRY_BUDGET, RATE_LIMIT_EC2_DESCRIBE, RATE_LIMIT_EC2_MUTATE,
+    RATE_LIMIT_CLOUDWATCH, RATE_LIMIT_ELB, RATE_LIMIT_DEFAULT, SCANNER_MAX_WORKERS, EXECUTOR_MAX_WORKERS,
+    TARGET_HEALTH_CONCURRENCY
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+THROTTLE_CODES = {
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestLimitExceeded",
+    "RequestThrottled", "RequestThrottledException", "TooManyRequestsException",
+    "SlowDown", "PriorRequestNotComplete"
+}
+
+FAMILY_RATES = {
+    "ec2-describe": RATE_LIMIT_EC2_DESCRIBE,
+    "ec2-mutate": RATE_LIMIT_EC2_MUTATE,
+    "cloudwatch": RATE_LIMIT_CLOUDWATCH,
+    "elb": RATE_LIMIT_ELB,
+}
+
+# Enough connections for every thread that can share one client: scanners,
+# executor workers and concurrent target-health checks.
+MAX_POOL_CONNECTIONS = max(10, 2 * SCANNER_MAX_WORKERS, EXECUTOR_MAX_WORKERS, TARGET_HEALTH_CONCURRENCY)
+
+# Clients kept for reuse; credentials that expire (assumed roles) leave old entries behind.
+MAX_CACHED_CLIENTS = 128
+
+# Mirrors botocore's retry quota: a retry costs tokens, a success refunds one.
+RETRY_COST = 5
+SUCCESS_REFUND = 1
+
+
+class RetryBudgetExhausted(BotoCoreError):
+    fmt = "Retry budget exhausted, not retrying {operation}"
+
+
+class TokenBucket:
+    """Blocking token bucket allowing `rate` calls per second with bursts up to `rate`."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until one is available. Returns seconds waited."""
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+
+class RetryBudget:
+    """Retry tokens shared by every client in the process."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tokens = capacity
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            if self.tokens < RETRY_COST:
+                return False
+            self.tokens -= RETRY_COST
+            return True
+
+    def refund(self):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + SUCCESS_REFUND)
+
+
+_client_hooks = []
+_buckets = {}
+_buckets_lock = threading.Lock()
+_retry_budget = RetryBudget(RETRY_BUDGET)
+_stats_lock = threading.Lock()
+_stats = defaultdict(lambda: {"calls": 0, "retries": 0, "throttles": 0, "wait_seconds": 0.0})
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+_default_session = None
+_client_stats = {"created": 0, "reused": 0, "create_seconds": 0.0}
+
+
+def api_family(service_id, operation):
+
+    if service_id == "ec2":
+        if operation.startswith(("Describe", "Get", "List")):
+            return "ec2-describe"
+        return "ec2-mutate"
+    if service_id.startswith("elastic-load-balancing"):
+        return "elb"
+    return service_id
+
+
+def _get_bucket(family, region, access_key):
+
+    # AWS throttles per account and region, so each set of credentials gets its own buckets.
+    with _buckets_lock:
+        key = (family, region, access_key)
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(FAMILY_RATES.get(family, RATE_LIMIT_DEFAULT))
+        return _buckets[key]
+
+
+def _record(api, **increments):
+
+    with _stats_lock:
+        for key, value in increments.items():
+            _stats[api][key] += value
+
+
+def _register_hooks(client, access_key):
+
+    region = client.meta.region_name
+
+    def before_send(event_name, **kwargs):
+        _, service_id, operation = event_name.split(".", 2)
+        waited = _get_bucket(api_family(service_id, operation), region, access_key).acquire()
+        _record(f"{service_id}.{operation}", calls=1, wait_seconds=waited)
+
+    def needs_retry(event_name, response, attempts, caught_exception, **kwargs):
+        _, service_id, operation = event_name.split(".", 2)
+        api = f"{service_id}.{operation}"
+
+        if caught_exception is None:
+            http_response, parsed = response
+            if http_response.status_code < 400:
+                _retry_budget.refund()
+                return None
+            if parsed.get("Error", {}).get("Code") in THROTTLE_CODES:
+                _record(api, throttles=1)
+            elif http_response.status_code < 500:
+                return None
+
+        if attempts >= AWS_MAX_ATTEMPTS:
+            return None
+
+        if not _retry_budget.spend():
+            logger.warning(f"Retry budget exhausted on {api}")
+            raise RetryBudgetExhausted(operation=api)
+
+        _record(api, retries=1)
+        return None
+
+    client.meta.events.register("before-send", before_send)
+    client.meta.events.register("needs-retry", needs_retry)
+
+
+def register_client_hook(hook):
+    """
+    Call `hook(client)` for every client created from now on, e.g. to attach
+    event handlers. Register hooks at import time: clients are cached.
+    """
+
+    _client_hooks.append(hook)
+
+
+def create_client(service, session=None, region_name=None, max_pool_connections=10):
+    """
+    Create a boto3 client with adaptive retries, the shared per-API-family
+    rate limiter and the process-wide retry budget.
+    """
+
+    session = session or boto3.Session()
+    config = Config(
+        retries={"mode": "adaptive", "max_attempts": AWS_MAX_ATTEMPTS},
+        max_pool_connections=max_pool_connections
+    )
+    client = session.client(service, region_name=region_name, config=config)
+    credentials = session.get_credentials()
+    _register_hooks(client, credentials.access_key if credentials else None)
+    for hook in _client_hooks:
+        hook(client)
+    return client
+
+
+def get_session(session=None):
+    """`session`, or the process-wide default session, created on first use."""
+
+    global _default_session
+
+    if session is not None:
+        return session
+    with _clients_lock:
+        if _default_session is None:
+            _default_session = boto3.Session()
+        return _default_session
+
+
+def get_client(service, session=None, region_name=None):
+    """
+    A shared client from the process-wide registry, created on first use.
+
+    Clients are thread-safe and survive warm Lambda invocations, so their
+    connection pools are reused too. They are keyed by credentials as well
+    as service and region, so an assumed role gets its own clients and a
+    refreshed one gets new ones.
+    """
+
+    session = get_session(session)
+    region_name = region_name or session.region_name
+    credentials = session.get_credentials()
+    key = (service, region_name, credentials.access_key if credentials else None)
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            _client_stats["reused"] += 1
+            return client
+
+        # Sessions are not thread-safe, so clients are created under the lock.
+        started = time.perf_counter()
+        client = create_client(service, session=session, region_name=region_name,
+                               max_pool_connections=MAX_POOL_CONNECTIONS)
+        _client_stats["created"] += 1
+        _client_stats["create_seconds"] += time.perf_counter() - started
+
+        _clients[key] = client
+        if len(_clients) > MAX_CACHED_CLIENTS:
+            _clients.popitem(last=False)
+        return client
+
+
+def get_client_stats():
+    """Clients created and reused from the registry since the last reset, and seconds spent creating them."""
+
+    with _clients_lock:
+        return dict(_client_stats)
+
+
+def get_api_stats():
+    """Per-API call, retry and throttle counts and seconds spent waiting on the rate limiter."""
+
+    with _stats_lock:
+        return {api: dict(values) for api, values in _stats.items()}
+
+
+def reset_api_stats():
+
+    with _stats_lock:
+        _stats.clear()
+    with _clients_lock:
+        _client_stats.update(created=0, reused=0, create_seconds=0.0)
+
@@ -0,0 +1,451 @@
+"""
+Offline benchmark for the cleanup pipeline.
+
+Generates a synthetic account, serves every AWS call from an in-process
+stand-in (botocore event handlers, so nothing leaves the machine), runs
+main.lambda_handler against it and reports wall time, API calls per
+operation, peak RSS and throttle events per scanner and per API.
+
+    python benchmark.py --scale 0.1
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json --tolerance 0.2
+
+Most calls are answered before they reach the HTTP layer. Calls picked by
+--throttle-rate go through it instead: their first attempt gets a 400
+throttling error from a before-send handler, so the rate limiter, the
+retry budget and botocore's backoff all run as they would against AWS.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+import contextlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from botocore.awsrequest import AWSResponse
+
+DEFAULT_SIZES = {
+    "volumes": 10000,
+    "snapshots": 250000,
+    "amis": 5000,
+    "instances": 3000,
+    "load_balancers": 500,
+}
+
+PAGE_SIZE = 1000
+PAGINATED_KEYS = {
+    "DescribeVolumes": "Volumes",
+    "DescribeSnapshots": "Snapshots",
+    "DescribeImages": "Images",
+    "DescribeInstances": "Reservations",
+    "DescribeTargetGroups": "TargetGroups",
+}
+
+
+# Throttling errors as each protocol returns them.
+THROTTLE_BODIES = {
+    "ec2": b"<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Request limit exceeded."
+           b"</Message></Error></Errors><RequestID>benchmark</RequestID></Response>",
+    "query": b"<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code><Message>Rate exceeded"
+             b"</Message></Error><RequestId>benchmark</RequestId></ErrorResponse>",
+    "json": b'{"__type": "ThrottlingException", "message": "Rate exceeded"}',
+    "rest-json": b'{"__type": "ThrottlingException", "message": "Rate exceeded"}',
+    "rest-xml": b"<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message>"
+                b"<RequestId>benchmark</RequestId></Error>",
+}
+
+
+def _empty_body(protocol, operation):
+    """The smallest successful response body each protocol's parser accepts."""
+
+    if protocol == "query":
+        return f"<{operation}Response><{operation}Result/></{operation}Response>".encode("utf-8")
+    if protocol == "ec2":
+        return b"<Response/>"
+    if protocol == "rest-xml":
+        return b""
+    return b"{}"
+
+
+class _RawBody:
+    """The raw stream AWSResponse reads its content from."""
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class _Response:
+    """Just enough of an HTTP response for botocore's after-call handlers."""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b""
+
+
+class FakeAccount:
+    """Synthetic resources of one account and handlers answering API calls against them."""
+
+    def __init__(self, sizes, seed=1, latency_ms=0.0, throttle_rate=0.0):
+        self.random = random.Random(seed)
+        self.latency = latency_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.throttles = Counter()
+        self.deleted = set()
+        self.listings = {}
+        self.local = threading.local()
+        self._generate(sizes)
+
+    def _age(self, max_days):
+        return self.now - timedelta(days=self.random.uniform(0, max_days))
+
+    def _generate(self, sizes):
+
+        self.now = datetime.now(timezone.utc)
+        rnd = self.random
+
+        self.instances = [{
+            "InstanceId": f"i-{n:017x}",
+            "InstanceType": rnd.choice(["t3.micro", "t3.large", "m5.large", "m5.xlarge", "c5.2xlarge"]),
+            "LaunchTime": self._age(365),
+            "State": {"Name": "running"},
+        } for n in range(sizes["instances"])]
+
+        self.volumes = []
+        for n in range(sizes["volumes"]):
+            attached = rnd.random() < 0.7 and self.instances
+            self.volumes.append({
+                "VolumeId": f"vol-{n:017x}",
+                "Size": rnd.choice([8, 20, 100, 500]),
+                "VolumeType": rnd.choice(["gp2", "gp3", "io1"]),
+                "CreateTime": self._age(400),
+                "State": "in-use" if attached else "available",
+                "Attachments": [{"InstanceId": rnd.choice(self.instances)["InstanceId"]}] if attached else [],
+            })
+
+        self.snapshots = [{
+            "SnapshotId": f"snap-{n:017x}",
+            "VolumeId": f"vol-{rnd.randrange(sizes['volumes'] * 2 or 1):017x}",
+            "VolumeSize": rnd.choice([8, 20, 100, 500]),
+            "StartTime": self._age(720),
+            "State": "completed",
+        } for n in range(sizes["snapshots"])]
+        self.snapshots_by_volume = {}
+        for snapshot in self.snapshots:
+            self.snapshots_by_volume.setdefault(snapshot["VolumeId"], []).append(snapshot)
+
+        self.images = [{
+            "ImageId": f"ami-{n:017x}",
+            "Name": f"image-{n}",
+            "CreationDate": self._age(400).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            "BlockDeviceMappings": [{"Ebs": {"SnapshotId": self.snapshots[n]["SnapshotId"]}}] if n < len(self.snapshots) else [],
+        } for n in range(sizes["amis"])]
+
+        self.addresses = [{
+            "AllocationId": f"eipalloc-{n:017x}",
+            "PublicIp": f"203.0.{n // 256 % 256}.{n % 256}",
+            **({"NetworkInterfaceId": f"eni-{n:017x}"} if rnd.random() < 0.8 else {}),
+        } for n in range(max(1, sizes["load_balancers"]))]
+
+        self.load_balancers = []
+        self.target_groups = []
+        self.tg_has_targets = {}
+        for n in range(sizes["load_balancers"]):
+            lb_arn = f"arn:aws:elasticloadbalancing:us-east-1:123456789012:loadbalancer/app/lb-{n}/{n:016x}"
+            self.load_balancers.append({"LoadBalancerArn": lb_arn, "LoadBalancerName": f"lb-{n}", "CreatedTime": self._age(400)})
+            for m in range(rnd.randint(0, 3)):
+                tg_arn = f"arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/tg-{n}-{m}/{n:016x}"
+                self.target_groups.append({"TargetGroupArn": tg_arn, "LoadBalancerArns": [lb_arn]})
+                self.tg_has_targets[tg_arn] = rnd.random() < 0.8
+
+        self.classic_load_balancers = [{
+            "LoadBalancerName": f"classic-{n}",
+            "CreatedTime": self._age(400),
+            "Instances": [{"InstanceId": self.instances[0]["InstanceId"]}] if self.instances and rnd.random() < 0.8 else [],
+        } for n in range(sizes["load_balancers"] // 10)]
+
+    def _listing(self, operation, params):
+
+        if operation == "DescribeVolumes":
+            wanted = {v for f in params.get("Filters", []) if f["Name"] == "status" for v in f["Values"]}
+            return [v for v in self.volumes if v["VolumeId"] not in self.deleted and (not wanted or v["State"] in wanted)]
+        if operation == "DescribeSnapshots":
+            volume_ids = [v for f in params.get("Filters", []) if f["Name"] == "volume-id" for v in f["Values"]]
+            snapshot_ids = {v for f in params.get("Filters", []) if f["Name"] == "snapshot-id" for v in f["Values"]}
+            if volume_ids:
+                snapshots = [s for v in volume_ids for s in self.snapshots_by_volume.get(v, [])]
+            else:
+                snapshots = self.snapshots
+            return [s for s in snapshots if s["SnapshotId"] not in self.deleted
+                    and (not snapshot_ids or s["SnapshotId"] in snapshot_ids)]
+        if operation == "DescribeImages":
+            snapshot_ids = {v for f in params.get("Filters", []) if f["Name"] == "block-device-mapping.snapshot-id"
+                            for v in f["Values"]}
+            return [i for i in self.images if i["ImageId"] not in self.deleted and (not snapshot_ids or any(
+                m["Ebs"]["SnapshotId"] in snapshot_ids for m in i["BlockDeviceMappings"]))]
+        if operation == "DescribeInstances":
+            return [{"Instances": [i]} for i in self.instances]
+        if operation == "DescribeTargetGroups":
+            lb_arn = params.get("LoadBalancerArn")
+            return [tg for tg in self.target_groups if not lb_arn or lb_arn in tg["LoadBalancerArns"]]
+        return []
+
+    def _paginate(self, operation, params):
+
+        token_key = "Marker" if operation == "DescribeTargetGroups" else "NextToken"
+        next_key = "NextMarker" if operation == "DescribeTargetGroups" else "NextToken"
+        offset = int(params.get(token_key) or 0)
+
+        # Later pages read the listing taken for the first page, like a real pagination token.
+        listing_key = (operation, json.dumps([params.get("Filters", []), params.get("LoadBalancerArn")], sort_keys=True))
+        with self.lock:
+            if offset == 0 or listing_key not in self.listings:
+                self.listings[listing_key] = self._listing(operation, params)
+            items = self.listings[listing_key]
+        page_size = params.get("MaxResults") or params.get("PageSize") or PAGE_SIZE
+
+        response = {PAGINATED_KEYS[operation]: items[offset:offset + page_size]}
+        if offset + page_size < len(items):
+            response[next_key] = str(offset + page_size)
+        return response
+
+    def respond(self, service, operation, params):
+
+        if operation in PAGINATED_KEYS:
+            return 200, self._paginate(operation, params)
+
+        if operation == "DescribeAddresses":
+            return 200, {"Addresses": [a for a in self.addresses if a["AllocationId"] not in self.deleted]}
+        if operation == "DescribeLoadBalancers" and service == "elastic-load-balancing-v2":
+            return 200, {"LoadBalancers": [lb for lb in self.load_balancers if lb["LoadBalancerArn"] not in self.deleted]}
+        if operation == "DescribeLoadBalancers":
+            return 200, {"LoadBalancerDescriptions": [lb for lb in self.classic_load_balancers if lb["LoadBalancerName"] not in self.deleted]}
+        if operation == "DescribeTargetHealth":
+            has_targets = self.tg_has_targets.get(params["TargetGroupArn"])
+            return 200, {"TargetHealthDescriptions": [{"Target": {"Id": "i-0"}}] if has_targets else []}
+        if operation == "GetMetricData":
+            results = [{"Id": q["Id"], "Values": [self.random.uniform(0, 20) for _ in range(7)]} for q in params["MetricDataQueries"]]
+            return 200, {"MetricDataResults": results}
+        if operation == "GetObject":
+            return 404, {"Error": {"Code": "NoSuchKey", "Message": "Not found"}}
+        if operation in ("ListSnapshotBlocks", "ListChangedBlocks"):
+            # Stable per snapshot pair, so repeated runs see the same diffs.
+            pair = random.Random(f"{params.get('FirstSnapshotId')}:{params.get('SecondSnapshotId') or params.get('SnapshotId')}")
+            blocks = pair.sample(range(4096), pair.randint(0, 512))
+            key = "Blocks" if operation == "ListSnapshotBlocks" else "ChangedBlocks"
+            return 200, {key: [{"BlockIndex": index} for index in blocks], "BlockSize": 524288}
+        if operation == "CreateMultipartUpload":
+            return 200, {"UploadId": "benchmark"}
+        if operation == "UploadPart":
+            return 200, {"ETag": f"\"{params['PartNumber']}\""}
+
+        for key in ("VolumeId", "SnapshotId", "ImageId", "AllocationId", "LoadBalancerArn", "LoadBalancerName"):
+            if key in params:
+                with self.lock:
+                    self.deleted.add(params[key])
+        return 200, {}
+
+    def stash_params(self, params, context, **kwargs):
+        context["benchmark_params"] = params
+
+    def before_call(self, model, context, **kwargs):
+
+        service = model.service_model.service_id.hyphenize()
+        operation = model.name
+        self.local.pending = None
+
+        with self.lock:
+            self.calls[f"{service}.{operation}"] += 1
+            throttled = self.random.random() < self.throttle_rate
+
+        status, body = self.respond(service, operation, context.get("benchmark_params", {}))
+        if throttled and status == 200:
+            # Let the call reach the HTTP layer, where before_send throttles its first attempt.
+            self.local.pending = {
+                "protocol": model.service_model.resolved_protocol,
+                "operation": operation,
+                "body": body,
+                "throttles": 1,
+            }
+            return None
+
+        if self.latency:
+            time.sleep(self.latency)
+        return _Response(status), body
+
+    def before_send(self, request, **kwargs):
+
+        pending = getattr(self.local, "pending", None)
+        if pending is None:
+            return None
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if pending["throttles"]:
+            pending["throttles"] -= 1
+            scanner = getattr(self.local, "scanner", None) or threading.current_thread().name.rsplit("_", 1)[0]
+            with self.lock:
+                self.throttles[scanner] += 1
+            return AWSResponse(request.url, 400, {}, _RawBody(THROTTLE_BODIES[pending["protocol"]]))
+        return AWSResponse(request.url, 200, {}, _RawBody(_empty_body(pending["protocol"], pending["operation"])))
+
+    def before_parse(self, response_dict, customized_response_dict, **kwargs):
+        """Put the stand-in's answer into the parsed response of a call that went through before_send."""
+
+        pending = getattr(self.local, "pending", None)
+        if pending is not None and response_dict["status_code"] == 200:
+            customized_response_dict.update(pending["body"])
+            self.local.pending = None
+
+    def attach(self, client):
+        client.meta.events.register("before-parameter-build", self.stash_params)
+        client.meta.events.register("before-call", self.before_call)
+        client.meta.events.register("before-send", self.before_send)
+        client.meta.events.register("before-parse", self.before_parse)
+
+    def track(self, name, func):
+        """Wrap a scanner so calls made from its thread are attributed to it."""
+
+        def wrapper(**kwargs):
+            from scheduler import load_scanner
+
+            self.local.scanner = name
+            try:
+                return load_scanner(func)(**kwargs)
+            finally:
+                self.local.scanner = None
+        return wrapper
+
+
+class _Context:
+
+    invoked_function_arn = ""
+
+    def __init__(self, budget_seconds=900):
+        self.deadline = time.monotonic() + budget_seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def _peak_rss_mb():
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_benchmark(sizes, seed=1, latency_ms=0.0, throttle_rate=0.0, dry_run=True):
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("SNS_TOPIC_ARN", "arn:aws:sns:us-east-1:123456789012:benchmark")
+    os.environ.setdefault("STATE_STORE_PATH", os.path.join(tempfile.mkdtemp(), "state.json.gz"))
+
+    account = FakeAccount(sizes, seed=seed, latency_ms=latency_ms, throttle_rate=throttle_rate)
+    rss_after_setup = _peak_rss_mb()
+
+    import aws_clients
+    import instrumentation
+    import main
+
+    aws_clients.register_client_hook(account.attach)
+    for name, spec in main.SCANNERS.items():
+        spec["func"] = account.track(name, spec["func"])
+
+    started = time.perf_counter()
+    # Keep the handler's EMF lines out of the JSON result on stdout.
+    with contextlib.redirect_stdout(sys.stderr):
+        main.lambda_handler({"dry_run": dry_run}, _Context())
+    wall_time = time.perf_counter() - started
+    spans = instrumentation.get_run_metrics()["spans"]
+    api_stats = aws_clients.get_api_stats()
+
+    return {
+        "sizes": sizes,
+        "dry_run": dry_run,
+        "latency_ms": latency_ms,
+        "throttle_rate": throttle_rate,
+        "wall_time_seconds": round(wall_time, 3),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "rss_after_setup_mb": round(rss_after_setup, 1),
+        "api_calls": dict(sorted(account.calls.items())),
+        "throttles_by_scanner": dict(sorted(account.throttles.items())),
+        # As seen by the retry handler in aws_clients, which the throttled calls go through.
+        "throttles_by_api": {api: stats["throttles"] for api, stats in sorted(api_stats.items()) if stats["throttles"]},
+        "retries_by_api": {api: stats["retries"] for api, stats in sorted(api_stats.items()) if stats["retries"]},
+        "span_ms": {name: round(stats["duration_ms"], 1) for name, stats in sorted(spans.items())},
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Regressions of `result` against `baseline`, as readable strings."""
+
+    regressions = []
+
+    for metric in ("wall_time_seconds", "peak_rss_mb"):
+        if result[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(f"{metric}: {result[metric]} > {baseline[metric]} (+{tolerance:.0%})")
+
+    for api, count in result["api_calls"].items():
+        expected = baseline["api_calls"].get(api, 0)
+        if count > expected * (1 + tolerance):
+            regressions.append(f"calls to {api}: {count} > {expected} (+{tolerance:.0%})")
+
+    for api, count in result["throttles_by_api"].items():
+        expected = baseline.get("throttles_by_api", {}).get(api, 0)
+        if count > expected * (1 + tolerance):
+            regressions.append(f"throttles on {api}: {count} > {expected} (+{tolerance:.0%})")
+
+    return regressions
+
+
+def main_cli(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    for name, default in DEFAULT_SIZES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=default)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every resource count")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="latency added to every API call")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of calls whose first attempt is throttled")
+    parser.add_argument("--apply", action="store_true", help="run the executor instead of a dry run")
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    sizes = {name: int(getattr(args, name) * args.scale) for name in DEFAULT_SIZES}
+    result = run_benchmark(sizes, seed=args.seed, latency_ms=args.latency_ms,
+                           throttle_rate=args.throttle_rate, dry_run=not args.apply)
+    print(json.dumps(result, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,292 @@
+import os
+import gzip
+import json
+import time
+import uuid
+import zlib
+import logging
+import threading
+from botocore.exceptions import ClientError, BotoCoreError
+from aws_clients import get_client
+from config import (
+    CHECKPOINT_ENABLED, CHECKPOINT_PATH, CHECKPOINT_PREFIX, CHECKPOINT_INTERVAL_SECONDS,
+    CHECKPOINT_MARGIN_SECONDS, CHECKPOINT_MAX_RESUMES, LOG_S3_BUCKET
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+FORMAT_VERSION = 1
+
+_lock = threading.Lock()
+_run_id = None
+_resumes = 0
+_resuming = False
+_deadline = None
+# (account_id, region) -> Progress, for the targets this invocation touched.
+_progress = {}
+
+
+class RunSuspended(Exception):
+    """Raised by a scanner that saved its position because the invocation is about to run out of time."""
+
+
+class ScanCursor:
+    """
+    Where a resumable scanner is in its listing: the token to continue
+    from and what it planned before it. Without a Progress it only tracks
+    the position and never suspends.
+    """
+
+    def __init__(self, progress=None, name=None, token=None, planned=None):
+        self.progress = progress
+        self.name = name
+        self.token = token
+        self.planned = planned if planned is not None else []
+
+    def advance(self, token):
+        """
+        Record that everything before `token` is planned. Raises
+        RunSuspended, after saving, when more remains and time is short.
+        """
+
+        self.token = token
+        if self.progress is None:
+            return
+        self.progress.update_cursor(self.name, token, list(self.planned))
+        if token and time_is_short():
+            self.progress.suspend(f"scanner {self.name}")
+            raise RunSuspended(self.name)
+
+
+class Progress:
+    """
+    The durable progress of one (account, region) target within a run:
+    plans of finished scanners, positions of unfinished ones and actions
+    already applied. Saved at most every CHECKPOINT_INTERVAL_SECONDS, and
+    always when suspending, so runs that finish quickly never write one.
+    """
+
+    def __init__(self, run_id, account_id, region, document=None):
+        self.run_id = run_id
+        self.account_id = account_id
+        self.region = region
+        self.scanners = (document or {}).get("scanners", {})
+        self.cursors = (document or {}).get("cursors", {})
+        self.done = (document or {}).get("done", {})
+        self.suspended = False
+        # Only a loaded or saved checkpoint has an object to delete.
+        self.stored = document is not None
+        self.saved_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def key(self):
+
+        return f"{CHECKPOINT_PREFIX}/{self.run_id}/{self.account_id or 'self'}/{self.region}.json.gz"
+
+    def completed_scanner(self, name):
+        """The plan of a scanner that finished in an earlier invocation, or None."""
+
+        return self.scanners.get(name)
+
+    def complete_scanner(self, name, plan):
+
+        with self.lock:
+            self.scanners[name] = plan
+            self.cursors.pop(name, None)
+        self.save()
+
+    def cursor(self, name):
+
+        saved = self.cursors.get(name, {})
+        return ScanCursor(self, name, saved.get("token"), saved.get("planned"))
+
+    def update_cursor(self, name, token, planned):
+
+        with self.lock:
+            self.cursors[name] = {"token": token, "planned": planned}
+        self.save()
+
+    def record_done(self, entry):
+
+        with self.lock:
+            self.done[entry["resource_id"]] = entry
+        self.save()
+
+    def suspend(self, reason):
+
+        logger.warning(f"Suspending {self.account_id or 'self'}/{self.region} at {reason}: not enough time left")
+        self.suspended = True
+        self.save(force=True)
+
+    def save(self, force=False):
+
+        with self.lock:
+            # Once suspended, every change must reach the next invocation.
+            if not force and not self.suspended and time.monotonic() - self.saved_at < CHECKPOINT_INTERVAL_SECONDS:
+                return
+            self.saved_at = time.monotonic()
+            document = {
+                "version": FORMAT_VERSION,
+                "scanners": self.scanners,
+                "cursors": self.cursors,
+                "done": self.done,
+            }
+            data = gzip.compress(json.dumps(document, separators=(",", ":"), default=str).encode("utf-8"))
+
+        try:
+            _write(self.key(), data)
+            self.stored = True
+        except (ClientError, BotoCoreError, OSError) as e:
+            logger.error(f"Failed to save checkpoint {self.key()}: {str(e)}")
+
+    def clear(self):
+        """Delete the checkpoint once the target is finished; a run that never saved one costs nothing."""
+
+        if not self.stored:
+            return
+        try:
+            _delete(self.key())
+        except FileNotFoundError:
+            pass
+        except (ClientError, BotoCoreError, OSError) as e:
+            logger.warning(f"Failed to delete checkpoint {self.key()}: {str(e)}")
+
+
+def _local_path(key):
+
+    return os.path.join(CHECKPOINT_PATH, key.replace("/", "_"))
+
+
+def _read(key):
+
+    if CHECKPOINT_PATH:
+        with open(_local_path(key), "rb") as f:
+            return f.read()
+
+    s3 = get_client("s3")
+    return s3.get_object(Bucket=LOG_S3_BUCKET, Key=key)["Body"].read()
+
+
+def _write(key, data):
+
+    if CHECKPOINT_PATH:
+        with open(_local_path(key), "wb") as f:
+            f.write(data)
+        return
+
+    s3 = get_client("s3")
+    s3.put_object(Bucket=LOG_S3_BUCKET, Key=key, Body=data, ContentEncoding="gzip")
+
+
+def _delete(key):
+
+    if CHECKPOINT_PATH:
+        os.remove(_local_path(key))
+        return
+
+    s3 = get_client("s3")
+    s3.delete_object(Bucket=LOG_S3_BUCKET, Key=key)
+
+
+def begin_run(event, deadline):
+    """
+    Start checkpointing this invocation, which must finish by the monotonic
+    `deadline`: a new run, or the run named by the event's "resume" field.
+    Returns the run ID.
+    """
+
+    global _run_id, _resumes, _resuming, _deadline, _progress
+
+    event = event or {}
+    with _lock:
+        _resuming = bool(event.get("resume"))
+        _run_id = event.get("resume") or f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        _resumes = int(event.get("resume_count", 0))
+        _deadline = deadline
+        _progress = {}
+
+    if _resuming:
+        logger.info(f"Resuming run {_run_id} (continuation {_resumes})")
+    if not can_resume():
+        logger.warning(f"Run {_run_id} has used all {CHECKPOINT_MAX_RESUMES} continuations; "
+                       f"work left at the deadline is reported as not run")
+    return _run_id
+
+
+def can_resume():
+    """Whether this run may still hand off to another invocation."""
+
+    return CHECKPOINT_ENABLED and _resumes < CHECKPOINT_MAX_RESUMES
+
+
+def get_progress(account_id, region):
+    """The target's progress in the current run, loaded on first use; None when checkpointing is off."""
+
+    if not CHECKPOINT_ENABLED or _run_id is None:
+        return None
+
+    with _lock:
+        if (account_id, region) in _progress:
+            return _progress[(account_id, region)]
+
+        progress = Progress(_run_id, account_id, region)
+        try:
+            # A new run has nothing to load.
+            if not _resuming:
+                raise FileNotFoundError(progress.key())
+            document = json.loads(gzip.decompress(_read(progress.key())))
+            if document.get("version") != FORMAT_VERSION:
+                raise ValueError(f"unsupported version {document.get('version')}")
+            progress = Progress(_run_id, account_id, region, document)
+            logger.info(f"Loaded checkpoint with {len(progress.scanners)} finished scanners, "
+                        f"{len(progress.cursors)} scanner positions and {len(progress.done)} applied actions")
+        except FileNotFoundError:
+            pass
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in {"NoSuchKey", "404"}:
+                logger.error(f"Failed to load checkpoint, starting the target over: {str(e)}")
+        except (BotoCoreError, OSError, EOFError, zlib.error, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Checkpoint is unreadable, starting the target over: {str(e)}")
+
+        _progress[(account_id, region)] = progress
+        return progress
+
+
+def time_is_short():
+    """Whether the invocation should stop starting work and save its position."""
+
+    return (_deadline is not None and can_resume()
+            and time.monotonic() >= _deadline - CHECKPOINT_MARGIN_SECONDS)
+
+
+def suspended_targets():
+    """Targets of this invocation that saved their progress and need another invocation."""
+
+    with _lock:
+        return [
+            {"account_id": progress.account_id, "region": progress.region}
+            for progress in _progress.values() if progress.suspended
+        ]
+
+
+def continuation(event):
+    """The event that continues this run in a new invocation."""
+
+    return dict(event or {}, resume=_run_id, resume_count=_resumes + 1)
+
+
+def resume_run(event, context):
+    """Continue this run in a new asynchronous invocation of this function."""
+
+    function_name = getattr(context, "invoked_function_arn", None)
+    if not function_name:
+        logger.error(f"Cannot resume run {_run_id}: no function ARN in context")
+        return
+
+    try:
+        lambda_client = get_client("lambda")
+        lambda_client.invoke(FunctionName=function_name, InvocationType="Event", Payload=json.dumps(continuation(event)))
+        logger.info(f"Handed run {_run_id} off to a new invocation")
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f"Failed to resume run {_run_id}: {str(e)}")
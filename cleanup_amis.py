@@ -1,74 +1,93 @@
-import boto3
 import logging
-from datetime import datetime, timezone
 from botocore.exceptions import ClientError, BotoCoreError
-from config import AMI_RETENTION_DAYS
+from aws_clients import get_client
+from inventory import iter_image_pages
+from executor import plan_action
+from state_store import needs_evaluation, record_kept
+from retention import evaluate_ages, AGE_BATCH_SIZE
+from policy import get_policy
+from checkpoint import ScanCursor
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def cleanup_old_amis():
+def cleanup_old_amis(ec2=None, policy=None, cursor=None):
 
-    ec2 = boto3.client("ec2")
-    cleaned_amis = []
+    ec2 = ec2 or get_client("ec2")
+    policy = policy or get_policy(region=ec2.meta.region_name)
+    cursor = cursor or ScanCursor()
+    planned_amis = cursor.planned
 
     try:
 
-        image_response = ec2.describe_images(Owners=["self"])
-        images = image_response.get("Images", [])
-
-        for image in images:
-            image_id = image.get("ImageId")
-            creation_date_str = image.get("CreationDate")
-            name = image.get("Name", "Unnamed")
-
-            if not image_id or not creation_date_str:
-                logger.warning("AMI missing ID or CreationDate. Skipping.")
-                continue
-
-
-            creation_date = datetime.strptime(creation_date_str, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
-            age_days = (datetime.now(timezone.utc) - creation_date).days
-
-            if age_days >= AMI_RETENTION_DAYS:
-                try:
-
-                    ec2.deregister_image(ImageId=image_id)
-                    logger.info(f"Deregistered AMI {image_id} (Name: {name}, Age: {age_days} days)")
-
-                    cleaned_amis.append({
-                        "resource_id": image_id,
-                        "action": "deleted",
-                        "resource_type": "AMI",
-                        "reason": f"Older than {AMI_RETENTION_DAYS} days",
-                        "timestamp": datetime.utcnow().isoformat()
-                    })
-
-
-                    for mapping in image.get("BlockDeviceMappings", []):
-                        ebs = mapping.get("Ebs")
-                        if ebs and "SnapshotId" in ebs:
-                            snapshot_id = ebs["SnapshotId"]
-                            try:
-                                ec2.delete_snapshot(SnapshotId=snapshot_id)
-                                logger.info(f"Deleted snapshot {snapshot_id} from AMI {image_id}")
-
-                                cleaned_amis.append({
-                                    "resource_id": snapshot_id,
-                                    "action": "deleted",
-                                    "resource_type": "EBS Snapshot",
-                                    "reason": f"Snapshot associated with deregistered AMI {image_id}",
-                                    "timestamp": datetime.utcnow().isoformat()
-                                })
-                            except ClientError as snap_error:
-                                logger.error(f"Failed to delete snapshot {snapshot_id}: {str(snap_error)}")
-
-                except ClientError as e:
-                    logger.error(f"Failed to deregister AMI {image_id}: {str(e)}")
-            else:
-                logger.info(f"Skipping AMI {image_id}: age {age_days} days")
+        for batch, token in iter_image_pages(ec2, AGE_BATCH_SIZE, cursor.token):
+            planned_amis.extend(plan_images(batch, policy))
+            cursor.advance(token)
 
     except (ClientError, BotoCoreError) as e:
         logger.error(f"Error describing AMIs: {str(e)}")
 
-    return cleaned_amis
+    return planned_amis
+
+
+def plan_images(images, policy, on_kept=record_kept):
+    """
+    Deregistration plans for a batch of AMIs; their snapshots are left to
+    resource_graph.cascade_plan. AMIs kept
+    only because they are too young are passed to
+    `on_kept(image_id, fingerprint, recheck_at)`.
+    """
+
+    planned_amis = []
+    pending = []
+    for image in images:
+        if not image.get("ImageId") or not image.get("CreationDate"):
+            logger.warning("AMI missing ID or CreationDate. Skipping.")
+            continue
+
+        verdict = policy.evaluate("ami", image.get("Tags"))
+        if verdict.excluded:
+            logger.info(f"Skipping AMI {image['ImageId']}: excluded by policy rule {verdict.rule}")
+        elif needs_evaluation(image["ImageId"], str(verdict.retention_days)):
+            pending.append((image, verdict))
+
+    ages, expired, recheck_at = evaluate_ages(
+        "ami",
+        [image["CreationDate"] for image, _ in pending],
+        [verdict.retention_days * 86400 for _, verdict in pending]
+    )
+    for (image, verdict), age_days, is_expired, image_recheck_at in zip(pending, ages, expired, recheck_at):
+        planned_amis.extend(_plan_image(image, verdict, age_days, is_expired, image_recheck_at, on_kept))
+
+    return planned_amis
+
+
+def _plan_image(image, verdict, age_days, is_expired, recheck_at, on_kept):
+
+    planned = []
+    image_id = image["ImageId"]
+    name = image.get("Name", "Unnamed")
+
+    if is_expired:
+        logger.info(f"Planning deregistration of AMI {image_id} (Name: {name}, Age: {age_days} days)")
+
+        # The snapshots are deleted by the cascade once no other AMI uses them.
+        snapshot_ids = [
+            mapping["Ebs"]["SnapshotId"] for mapping in image.get("BlockDeviceMappings", [])
+            if "SnapshotId" in (mapping.get("Ebs") or {})
+        ]
+        planned.append(plan_action(
+            image_id,
+            "AMI",
+            "deleted",
+            f"Older than {verdict.retention_days} days",
+            "ec2",
+            "deregister_image",
+            {"ImageId": image_id},
+            details={"snapshot_ids": snapshot_ids, **verdict.details()}
+        ))
+    else:
+        logger.info(f"Skipping AMI {image_id}: age {age_days} days")
+        on_kept(image_id, str(verdict.retention_days), recheck_at)
+
+    return planned
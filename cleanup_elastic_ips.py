@@ -1,46 +1,57 @@
-import boto3
 import logging
-from datetime import datetime
 from botocore.exceptions import ClientError, BotoCoreError
+from aws_clients import get_client
+from inventory import iter_addresses
+from executor import plan_action
+from policy import get_policy
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def cleanup_unattached_elastic_ips():
+def cleanup_unattached_elastic_ips(ec2=None, policy=None):
 
-    ec2 = boto3.client("ec2")
-    released_ips = []
+    ec2 = ec2 or get_client("ec2")
+    policy = policy or get_policy(region=ec2.meta.region_name)
+    planned_ips = []
 
     try:
 
-        response = ec2.describe_addresses()
-        addresses = response.get("Addresses", [])
-
-        for address in addresses:
-            allocation_id = address.get("AllocationId")
-            public_ip = address.get("PublicIp")
-            instance_id = address.get("InstanceId")
-            network_interface_id = address.get("NetworkInterfaceId")
-
-
-            if not instance_id and not network_interface_id:
-                try:
-                    ec2.release_address(AllocationId=allocation_id)
-                    logger.info(f"Released Elastic IP {public_ip} (AllocationId: {allocation_id})")
-
-                    released_ips.append({
-                        "resource_id": allocation_id,
-                        "action": "released",
-                        "resource_type": "Elastic IP",
-                        "reason": "Unattached Elastic IP consuming cost",
-                        "timestamp": datetime.utcnow().isoformat()
-                    })
-                except ClientError as e:
-                    logger.error(f"Failed to release Elastic IP {public_ip}: {str(e)}")
-            else:
-                logger.info(f"Skipping Elastic IP {public_ip}: still in use")
+        planned_ips.extend(plan_addresses(iter_addresses(ec2), policy))
 
     except (ClientError, BotoCoreError) as e:
         logger.error(f"Error describing Elastic IPs: {str(e)}")
 
-    return released_ips
+    return planned_ips
+
+
+def plan_addresses(addresses, policy):
+    """Release plans for the addresses that are associated with nothing."""
+
+    planned_ips = []
+    for address in addresses:
+        allocation_id = address.get("AllocationId")
+        public_ip = address.get("PublicIp")
+        instance_id = address.get("InstanceId")
+        network_interface_id = address.get("NetworkInterfaceId")
+
+        verdict = policy.evaluate("elastic_ip", address.get("Tags"))
+
+        if verdict.excluded:
+            logger.info(f"Skipping Elastic IP {public_ip}: excluded by policy rule {verdict.rule}")
+        elif not instance_id and not network_interface_id:
+            logger.info(f"Planning release of Elastic IP {public_ip} (AllocationId: {allocation_id})")
+
+            planned_ips.append(plan_action(
+                allocation_id,
+                "Elastic IP",
+                "released",
+                "Unattached Elastic IP consuming cost",
+                "ec2",
+                "release_address",
+                {"AllocationId": allocation_id},
+                details=verdict.details()
+            ))
+        else:
+            logger.info(f"Skipping Elastic IP {public_ip}: still in use")
+
+    return planned_ips
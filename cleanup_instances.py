@@ -1,69 +1,100 @@
-import boto3
 import logging
-from datetime import datetime, timedelta, timezone
+from datetime import timedelta
 from botocore.exceptions import ClientError, BotoCoreError
-from config import IDLE_CPU_THRESHOLD
+from aws_clients import get_client
+from config import IDLE_CPU_THRESHOLD, IDLE_IO_THRESHOLD_MB
+from metrics import get_instance_metrics, CPU_METRIC, IO_METRICS, MAX_QUERIES_PER_REQUEST
+from inventory import iter_instances, iter_batches
+from retention import run_time, run_timestamp
+from policy import get_policy
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def cleanup_idle_instances():
+LOOKBACK_DAYS = 7
+METRIC_NAMES = [CPU_METRIC] + IO_METRICS
+# Instances per GetMetricData request, so each batch is a single call.
+INSTANCE_BATCH_SIZE = MAX_QUERIES_PER_REQUEST // len(METRIC_NAMES)
 
-    ec2 = boto3.client("ec2")
-    cloudwatch = boto3.client("cloudwatch")
+def cleanup_idle_instances(ec2=None, cloudwatch=None, policy=None):
+
+    ec2 = ec2 or get_client("ec2")
+    cloudwatch = cloudwatch or get_client("cloudwatch")
+    policy = policy or get_policy(region=ec2.meta.region_name)
     idle_instances = []
 
     try:
 
-        reservations = ec2.describe_instances(Filters=[
+        instances = iter_instances(ec2, filters=[
             {"Name": "instance-state-name", "Values": ["running"]}
-        ]).get("Reservations", [])
-
-        instances = [inst for r in reservations for inst in r.get("Instances", [])]
-
-        for instance in instances:
-            instance_id = instance.get("InstanceId")
-            launch_time = instance.get("LaunchTime")
-
-            if not instance_id or not launch_time:
-                logger.warning("Instance missing ID or launch time. Skipping.")
-                continue
-
-
-            end_time = datetime.utcnow().replace(tzinfo=timezone.utc)
-            start_time = end_time - timedelta(days=7)
-
-            try:
+        ])
 
-                cpu_response = cloudwatch.get_metric_statistics(
-                    Namespace="AWS/EC2",
-                    MetricName="CPUUtilization",
-                    Dimensions=[{"Name": "InstanceId", "Value": instance_id}],
-                    StartTime=start_time,
-                    EndTime=end_time,
-                    Period=86400,
-                    Statistics=["Average"]
-                )
+        end_time = run_time()
+        start_time = end_time - timedelta(days=LOOKBACK_DAYS)
 
-                cpu_datapoints = cpu_response.get("Datapoints", [])
-                avg_cpu = sum(dp["Average"] for dp in cpu_datapoints) / len(cpu_datapoints) if cpu_datapoints else 0
+        for batch in iter_batches(instances, INSTANCE_BATCH_SIZE):
+            idle_instances.extend(_find_idle(cloudwatch, policy, batch, start_time, end_time))
 
+    except (ClientError, BotoCoreError) as ec2_error:
+        logger.error(f"Error describing instances: {str(ec2_error)}")
 
-                if avg_cpu <= IDLE_CPU_THRESHOLD:
-                    logger.info(f"Instance {instance_id} is idle: CPU={avg_cpu:.2f}%")
+    return idle_instances
 
-                    idle_instances.append({
-                        "resource_id": instance_id,
-                        "action": "notify",
-                        "resource_type": "EC2 Instance",
-                        "reason": f"Idle: CPU <= {IDLE_CPU_THRESHOLD}% over 7 days",
-                        "timestamp": datetime.utcnow().isoformat()
-                    })
 
-            except (ClientError, BotoCoreError) as metric_error:
-                logger.error(f"Error fetching metrics for {instance_id}: {str(metric_error)}")
+def _find_idle(cloudwatch, policy, instances, start_time, end_time):
 
-    except (ClientError, BotoCoreError) as ec2_error:
-        logger.error(f"Error describing instances: {str(ec2_error)}")
+    idle_instances = []
+    instance_ids = []
+    instance_types = {}
+
+    for instance in instances:
+        instance_id = instance.get("InstanceId")
+        launch_time = instance.get("LaunchTime")
+
+        if not instance_id or not launch_time:
+            logger.warning("Instance missing ID or launch time. Skipping.")
+            continue
+
+        verdict = policy.evaluate("instance", instance.get("Tags"))
+        if verdict.excluded:
+            logger.info(f"Skipping instance {instance_id}: excluded by policy rule {verdict.rule}")
+            continue
+
+        instance_ids.append(instance_id)
+        instance_types[instance_id] = instance.get("InstanceType")
+
+    instance_metrics = get_instance_metrics(
+        cloudwatch,
+        instance_ids,
+        METRIC_NAMES,
+        start_time,
+        end_time,
+        period=86400
+    )
+
+    for instance_id in instance_ids:
+        datapoints = instance_metrics.get(instance_id)
+        if datapoints is None:
+            logger.error(f"Error fetching metrics for {instance_id}: no metric data returned")
+            continue
+
+        cpu_datapoints = datapoints[CPU_METRIC]
+        avg_cpu = sum(cpu_datapoints) / len(cpu_datapoints) if cpu_datapoints else 0
+
+        io_bytes = sum(sum(datapoints[name]) for name in IO_METRICS)
+        avg_io_mb = io_bytes / (1024 * 1024) / LOOKBACK_DAYS
+
+
+        if avg_cpu <= IDLE_CPU_THRESHOLD and avg_io_mb <= IDLE_IO_THRESHOLD_MB:
+            logger.info(f"Instance {instance_id} is idle: CPU={avg_cpu:.2f}%, IO={avg_io_mb:.2f} MB/day")
+
+            idle_instances.append({
+                "resource_id": instance_id,
+                "action": "notify",
+                "resource_type": "EC2 Instance",
+                "instance_type": instance_types[instance_id],
+                "reason": f"Idle: CPU <= {IDLE_CPU_THRESHOLD}% and IO <= {IDLE_IO_THRESHOLD_MB} MB/day over {LOOKBACK_DAYS} days",
+                "timestamp": run_timestamp()
+            })
 
     return idle_instances
@@ -1,84 +1,253 @@
-import boto3
 import logging
-from datetime import datetime, timezone
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError, BotoCoreError
-from config import LB_MIN_AGE_MINUTES
+from aws_clients import get_client
+from config import TARGET_HEALTH_CONCURRENCY
+from inventory import iter_load_balancers, iter_target_groups, iter_classic_load_balancers
+from executor import plan_action
+from retention import evaluate_ages
+from policy import get_policy
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def cleanup_unused_load_balancers():
-    
-    elb = boto3.client("elbv2")
-    deleted_lbs = []
+# Load balancers per DescribeTags call.
+TAGS_BATCH_SIZE = 20
+
+
+def _has_registered_targets(elb, tg_arn):
+
+    try:
+        response = elb.describe_target_health(TargetGroupArn=tg_arn)
+        return bool(response.get("TargetHealthDescriptions", []))
+    except (ClientError, BotoCoreError) as e:
+        # Unknown health must never make a load balancer look unused.
+        logger.error(f"Failed to describe target health for {tg_arn}: {str(e)}")
+        return True
+
+
+def build_lb_topology(elb, lb_arns=None):
+    """
+    Map every ALB/NLB ARN to whether any of its target groups has registered targets.
+
+    Target groups are read in one paginated sweep, or per load balancer when
+    `lb_arns` is given, and target health is fetched concurrently; the
+    client's ELB rate limiter paces the calls. Load balancers without target
+    groups are absent from the map.
+    """
+
+    if lb_arns is None:
+        target_groups = iter_target_groups(elb)
+    else:
+        target_groups = (tg for lb_arn in lb_arns for tg in iter_target_groups(elb, load_balancer_arn=lb_arn))
+
+    target_groups_by_lb = defaultdict(list)
+    for tg in target_groups:
+        for lb_arn in tg.get("LoadBalancerArns", []):
+            target_groups_by_lb[lb_arn].append(tg["TargetGroupArn"])
+
+    tg_arns = sorted({arn for arns in target_groups_by_lb.values() for arn in arns})
+
+    with ThreadPoolExecutor(max_workers=TARGET_HEALTH_CONCURRENCY, thread_name_prefix="target_health") as executor:
+        tg_has_targets = dict(zip(tg_arns, executor.map(lambda arn: _has_registered_targets(elb, arn), tg_arns)))
+
+    return {
+        lb_arn: any(tg_has_targets[arn] for arn in arns)
+        for lb_arn, arns in target_groups_by_lb.items()
+    }
+
+
+def fetch_tags(client, id_param, id_field, ids):
+    """
+    Tags of the given load balancers, keyed by ARN (elbv2, id_param
+    "ResourceArns") or by name (classic, id_param "LoadBalancerNames").
+    """
+
+    tags = {}
+    for offset in range(0, len(ids), TAGS_BATCH_SIZE):
+        response = client.describe_tags(**{id_param: ids[offset:offset + TAGS_BATCH_SIZE]})
+        for description in response.get("TagDescriptions", []):
+            tags[description[id_field]] = description.get("Tags", [])
+    return tags
+
+
+def _min_age_minutes(verdict):
+
+    return round(verdict.retention_days * 24 * 60)
+
+
+def _allocation_ids(lb):
+    """Elastic IPs of an NLB's network interfaces, for resource_graph to release after the NLB."""
+
+    allocation_ids = [
+        address["AllocationId"]
+        for zone in lb.get("AvailabilityZones", [])
+        for address in zone.get("LoadBalancerAddresses", [])
+        if address.get("AllocationId")
+    ]
+    return {"allocation_ids": allocation_ids} if allocation_ids else {}
+
+
+def _old_enough(pending, id_field, label, on_kept):
+    """
+    The (lb, verdict) pairs past their retention, aged in one batch; too new
+    ones go to `on_kept(id, None, recheck_at)`.
+    """
+
+    _, expired, recheck_at = evaluate_ages(
+        "load_balancer",
+        [lb["CreatedTime"] for lb, _ in pending],
+        [verdict.retention_days * 86400 for _, verdict in pending]
+    )
+
+    old = []
+    for (lb, verdict), is_old, due in zip(pending, expired, recheck_at):
+        if is_old:
+            old.append((lb, verdict))
+            continue
+        logger.info(f"Skipping {label} {lb['LoadBalancerName']}: too new")
+        if on_kept:
+            on_kept(lb[id_field], None, due)
+    return old
+
+
+def cleanup_unused_load_balancers(elb=None, classic_elb=None, policy=None):
+
+    elb = elb or get_client("elbv2")
+    classic_elb = classic_elb or get_client("elb")
+    policy = policy or get_policy(region=elb.meta.region_name)
+    planned_lbs = []
 
     try:
-        
-        lb_response = elb.describe_load_balancers()
-        load_balancers = lb_response.get("LoadBalancers", [])
-
-        for lb in load_balancers:
-            lb_arn = lb.get("LoadBalancerArn")
-            lb_name = lb.get("LoadBalancerName")
-            created_time = lb.get("CreatedTime")
-
-            if not lb_arn or not lb_name or not created_time:
-                logger.warning("Load balancer missing ARN, Name, or CreatedTime. Skipping.")
-                continue
-
-            age_minutes = (datetime.now(timezone.utc) - created_time).total_seconds() / 60
-
-            try:
-                
-                tg_response = elb.describe_target_groups(LoadBalancerArn=lb_arn)
-                target_groups = tg_response.get("TargetGroups", [])
-
-                has_registered_targets = False
-
-                
-                for tg in target_groups:
-                    tg_arn = tg.get("TargetGroupArn")
-                    if not tg_arn:
-                        continue
-
-                    th_response = elb.describe_target_health(TargetGroupArn=tg_arn)
-                    targets = th_response.get("TargetHealthDescriptions", [])
-
-                    if targets:
-                        has_registered_targets = True
-                        break
-
-                
-                if not has_registered_targets and age_minutes >= LB_MIN_AGE_MINUTES:
-
-                    try:
-                        listeners_response = elb.describe_listeners(LoadBalancerArn=lb_arn)
-                        listeners = listeners_response.get("Listeners", [])
-                        for listener in listeners:
-                            listener_arn = listener["ListenerArn"]
-                            elb.delete_listener(ListenerArn=listener_arn)
-                            logger.info(f"Deleted listener {listener_arn} from LB {lb_name}")
-                    except Exception as listener_error:
-                        logger.error(f"Failed to delete listeners for {lb_name}: {str(listener_error)}")
-
-
-                    elb.delete_load_balancer(LoadBalancerArn=lb_arn)
-                    logger.info(f"Deleted load balancer {lb_name} (ARN: {lb_arn})")
-
-                    deleted_lbs.append({
-                        "resource_id": lb_arn,
-                        "action": "deleted",
-                        "resource_type": "Load Balancer",
-                        "reason": f"No registered targets and older than {LB_MIN_AGE_MINUTES} minutes",
-                        "timestamp": datetime.utcnow().isoformat()
-                    })
-                else:
-                    logger.info(f"Skipping load balancer {lb_name}: either has targets or is too new")
-
-            except (ClientError, BotoCoreError) as inner_error:
-                logger.error(f"Failed checking/deleting load balancer {lb_name}: {str(inner_error)}")
+
+        lb_has_targets = build_lb_topology(elb)
+        planned_lbs.extend(plan_load_balancers(elb, iter_load_balancers(elb), lb_has_targets, policy))
 
     except (ClientError, BotoCoreError) as outer_error:
         logger.error(f"Error describing load balancers: {str(outer_error)}")
 
-    return deleted_lbs
+    planned_lbs.extend(cleanup_unused_classic_load_balancers(classic_elb, policy))
+
+    return planned_lbs
+
+
+def cleanup_unused_classic_load_balancers(classic_elb, policy):
+
+    planned_lbs = []
+
+    try:
+
+        planned_lbs.extend(plan_classic_load_balancers(classic_elb, iter_classic_load_balancers(classic_elb), policy))
+
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f"Error describing classic load balancers: {str(e)}")
+
+    return planned_lbs
+
+
+def plan_load_balancers(elb, lbs, lb_has_targets, policy, on_kept=None):
+    """
+    Deletion plans for the ALBs/NLBs in `lbs` without registered targets.
+    Load balancers kept only because they are too new are passed to
+    `on_kept(arn, None, recheck_at)`.
+    """
+
+    planned_lbs = []
+    unused = []
+
+    for lb in lbs:
+        lb_arn = lb.get("LoadBalancerArn")
+        lb_name = lb.get("LoadBalancerName")
+
+        if not lb_arn or not lb_name or not lb.get("CreatedTime"):
+            logger.warning("Load balancer missing ARN, Name, or CreatedTime. Skipping.")
+        elif lb_has_targets.get(lb_arn, False):
+            logger.info(f"Skipping load balancer {lb_name}: has registered targets")
+        else:
+            unused.append(lb)
+
+    # Tags cost extra calls, so they are only read for unused load balancers and only if a rule needs them.
+    tags = {}
+    if unused and policy.uses_tags("load_balancer"):
+        tags = fetch_tags(elb, "ResourceArns", "ResourceArn", [lb["LoadBalancerArn"] for lb in unused])
+
+    pending = []
+    for lb in unused:
+        verdict = policy.evaluate("load_balancer", tags.get(lb["LoadBalancerArn"]))
+        if verdict.excluded:
+            logger.info(f"Skipping load balancer {lb['LoadBalancerName']}: excluded by policy rule {verdict.rule}")
+        else:
+            pending.append((lb, verdict))
+
+    for lb, verdict in _old_enough(pending, "LoadBalancerArn", "load balancer", on_kept):
+        lb_arn = lb["LoadBalancerArn"]
+        lb_name = lb["LoadBalancerName"]
+
+        # Deleting a load balancer also deletes its listeners.
+        logger.info(f"Planning deletion of load balancer {lb_name} (ARN: {lb_arn})")
+
+        planned_lbs.append(plan_action(
+            lb_arn,
+            "Load Balancer",
+            "deleted",
+            f"No registered targets and older than {_min_age_minutes(verdict)} minutes",
+            "elbv2",
+            "delete_load_balancer",
+            {"LoadBalancerArn": lb_arn},
+            details={"lb_type": lb.get("Type"), **_allocation_ids(lb), **verdict.details()}
+        ))
+
+    return planned_lbs
+
+
+def plan_classic_load_balancers(classic_elb, lbs, policy, on_kept=None):
+    """
+    Deletion plans for the classic load balancers in `lbs` without
+    registered instances; too new ones go to `on_kept(name, None, recheck_at)`.
+    """
+
+    planned_lbs = []
+    unused = []
+
+    for lb in lbs:
+        lb_name = lb.get("LoadBalancerName")
+
+        if not lb_name or not lb.get("CreatedTime"):
+            logger.warning("Classic load balancer missing Name or CreatedTime. Skipping.")
+        elif lb.get("Instances"):
+            logger.info(f"Skipping classic load balancer {lb_name}: has registered instances")
+        else:
+            unused.append(lb)
+
+    tags = {}
+    if unused and policy.uses_tags("load_balancer"):
+        tags = fetch_tags(classic_elb, "LoadBalancerNames", "LoadBalancerName",
+                          [lb["LoadBalancerName"] for lb in unused])
+
+    pending = []
+    for lb in unused:
+        verdict = policy.evaluate("load_balancer", tags.get(lb["LoadBalancerName"]))
+        if verdict.excluded:
+            logger.info(f"Skipping classic load balancer {lb['LoadBalancerName']}: "
+                        f"excluded by policy rule {verdict.rule}")
+        else:
+            pending.append((lb, verdict))
+
+    for lb, verdict in _old_enough(pending, "LoadBalancerName", "classic load balancer", on_kept):
+        lb_name = lb["LoadBalancerName"]
+
+        logger.info(f"Planning deletion of classic load balancer {lb_name}")
+
+        planned_lbs.append(plan_action(
+            lb_name,
+            "Classic Load Balancer",
+            "deleted",
+            f"No registered instances and older than {_min_age_minutes(verdict)} minutes",
+            "elb",
+            "delete_load_balancer",
+            {"LoadBalancerName": lb_name},
+            details={"lb_type": "classic", **verdict.details()}
+        ))
+
+    return planned_lbs
@@ -1,86 +1,158 @@
-import boto3
 import logging
-from datetime import datetime, timezone
 from botocore.exceptions import ClientError, BotoCoreError
-from config import SNAPSHOT_RETENTION_DAYS
+from aws_clients import get_client
+from config import SNAPSHOT_LINEAGE_ENABLED, SNAPSHOT_MAX_DELETIONS_PER_RUN
+from inventory import iter_snapshot_pages, iter_volumes, iter_images, iter_filtered
+from executor import plan_action
+from state_store import needs_evaluation, record_kept
+from retention import evaluate_ages, AGE_BATCH_SIZE
+from snapshot_lineage import select_deletions
+from policy import get_policy
+from checkpoint import ScanCursor
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def cleanup_old_snapshots():
-    
-    ec2 = boto3.client("ec2")
-    deleted_snapshots = []
+def build_snapshot_index(ec2, snapshots=None):
+    """
+    Everything the snapshot scanner needs to know about volumes and AMIs,
+    from one paginated pass over each, or, given `snapshots`, only about
+    their volumes and the AMIs that use them.
+
+    Returns (volume_attached, ami_snapshot_ids): a map of VolumeId -> whether
+    the volume has attachments, and the set of snapshot IDs still backing a
+    registered AMI.
+    """
+
+    if snapshots is None:
+        volumes = iter_volumes(ec2)
+        images = iter_images(ec2)
+    else:
+        volume_ids = {snapshot["VolumeId"] for snapshot in snapshots if snapshot.get("VolumeId")}
+        snapshot_ids = {snapshot["SnapshotId"] for snapshot in snapshots}
+        volumes = iter_filtered(ec2, iter_volumes, "volume-id", volume_ids)
+        images = iter_filtered(ec2, iter_images, "block-device-mapping.snapshot-id", snapshot_ids)
+
+    volume_attached = {
+        volume["VolumeId"]: bool(volume.get("Attachments"))
+        for volume in volumes
+    }
+
+    ami_snapshot_ids = set()
+    for image in images:
+        for mapping in image.get("BlockDeviceMappings", []):
+            snapshot_id = mapping.get("Ebs", {}).get("SnapshotId")
+            if snapshot_id:
+                ami_snapshot_ids.add(snapshot_id)
+
+    logger.info(f"Indexed {len(volume_attached)} volumes and {len(ami_snapshot_ids)} AMI snapshots")
+    return volume_attached, ami_snapshot_ids
+
+
+def cleanup_old_snapshots(ec2=None, ebs=None, policy=None, cursor=None):
+
+    ec2 = ec2 or get_client("ec2")
+    ebs = ebs or get_client("ebs")
+    policy = policy or get_policy(region=ec2.meta.region_name)
+    cursor = cursor or ScanCursor()
+    # (volume_id, action) for every planned deletion; the volume is needed for lineage analysis.
+    candidates = cursor.planned
 
     try:
-        snapshot_response = ec2.describe_snapshots(OwnerIds=["self"])
-        snapshots = snapshot_response.get("Snapshots", [])
-
-        for snapshot in snapshots:
-            snapshot_id = snapshot.get("SnapshotId")
-            volume_id = snapshot.get("VolumeId")
-            start_time = snapshot.get("StartTime")
-
-            if not snapshot_id or not start_time:
-                logger.warning(f"Skipping snapshot with missing ID or time.")
-                continue
-
-            age_days = (datetime.now(timezone.utc) - start_time).days
-
-            if age_days >= SNAPSHOT_RETENTION_DAYS:
-                if not volume_id:
-                   
-                    try:
-                        ec2.delete_snapshot(SnapshotId=snapshot_id)
-                        logger.info(f"Deleted snapshot {snapshot_id}: no volume attached, age {age_days} days")
-                        deleted_snapshots.append({
-                            "resource_id": snapshot_id,
-                            "action": "deleted",
-                            "resource_type": "EBS Snapshot",
-                            "reason": f"Not linked to any volume, age {age_days} days",
-                            "timestamp": datetime.utcnow().isoformat()
-                        })
-                    except ClientError as e:
-                        logger.error(f"Failed to delete snapshot {snapshot_id}: {str(e)}")
-                    continue
-
-                
-                try:
-                    volume_response = ec2.describe_volumes(VolumeIds=[volume_id])
-                    volume = volume_response['Volumes'][0]
-                    attachments = volume.get("Attachments", [])
-
-                    if not attachments:
-                        ec2.delete_snapshot(SnapshotId=snapshot_id)
-                        logger.info(f"Deleted snapshot {snapshot_id}: linked volume is detached, age {age_days} days")
-                        deleted_snapshots.append({
-                            "resource_id": snapshot_id,
-                            "action": "deleted",
-                            "resource_type": "EBS Snapshot",
-                            "reason": f"Volume not attached to any instance, age {age_days} days",
-                            "timestamp": datetime.utcnow().isoformat()
-                        })
-                    else:
-                        logger.info(f"Skipping snapshot {snapshot_id}: volume attached")
-
-                except ec2.exceptions.ClientError as e:
-                    if e.response["Error"]["Code"] == "InvalidVolume.NotFound":
-                        ec2.delete_snapshot(SnapshotId=snapshot_id)
-                        logger.info(f"Deleted snapshot {snapshot_id}: volume missing, age {age_days} days")
-                        deleted_snapshots.append({
-                            "resource_id": snapshot_id,
-                            "action": "deleted",
-                            "resource_type": "EBS Snapshot",
-                            "reason": f"Linked volume not found (possibly deleted), age {age_days} days",
-                            "timestamp": datetime.utcnow().isoformat()
-                        })
-                    else:
-                        logger.error(f"Error describing volume {volume_id}: {str(e)}")
-
-            else:
-                logger.info(f"Skipping snapshot {snapshot_id}: only {age_days} days old")
+        volume_attached, ami_snapshot_ids = build_snapshot_index(ec2)
+        pages = iter_snapshot_pages(ec2, AGE_BATCH_SIZE, cursor.token,
+                                    filters=[{"Name": "status", "Values": ["completed"]}])
+
+        for batch, token in pages:
+            candidates.extend(plan_snapshots(batch, policy, volume_attached, ami_snapshot_ids))
+            cursor.advance(token)
 
     except (ClientError, BotoCoreError) as err:
         logger.error(f"Failed to describe snapshots: {str(err)}")
 
-    return deleted_snapshots
+    return rank_snapshot_deletions(ec2, ebs, candidates)
+
+
+def rank_snapshot_deletions(ec2, ebs, candidates):
+    """
+    The actions of (volume_id, action) candidates, cut to
+    SNAPSHOT_MAX_DELETIONS_PER_RUN. Lineages and block diffs are only read
+    when the cap is hit, to choose what to delete; otherwise every
+    candidate goes and keeps its volume-size estimate.
+    """
+
+    actions = [action for _, action in candidates]
+    if not SNAPSHOT_MAX_DELETIONS_PER_RUN or len(actions) <= SNAPSHOT_MAX_DELETIONS_PER_RUN:
+        return actions
+
+    if SNAPSHOT_LINEAGE_ENABLED:
+        return select_deletions(ec2, ebs, candidates)
+
+    logger.info(f"Deferring {len(actions) - SNAPSHOT_MAX_DELETIONS_PER_RUN} snapshot deletions from the smallest volumes")
+    return sorted(actions, key=lambda action: action.get("size_gb") or 0, reverse=True)[:SNAPSHOT_MAX_DELETIONS_PER_RUN]
+
+
+def plan_snapshots(snapshots, policy, volume_attached, ami_snapshot_ids, on_kept=record_kept):
+    """
+    Deletion candidates, as (volume_id, action), for a batch of snapshots.
+    Snapshots kept only because they are too young are passed to
+    `on_kept(snapshot_id, fingerprint, recheck_at)`.
+    """
+
+    candidates = []
+    pending = []
+    for snapshot in snapshots:
+        if not snapshot.get("SnapshotId") or not snapshot.get("StartTime"):
+            logger.warning(f"Skipping snapshot with missing ID or time.")
+            continue
+
+        verdict = policy.evaluate("snapshot", snapshot.get("Tags"))
+        if verdict.excluded:
+            logger.info(f"Skipping snapshot {snapshot['SnapshotId']}: excluded by policy rule {verdict.rule}")
+        # Snapshots are immutable: a young one only needs a look once it reaches retention age.
+        elif needs_evaluation(snapshot["SnapshotId"], str(verdict.retention_days)):
+            pending.append((snapshot, verdict))
+
+    ages, expired, recheck_at = evaluate_ages(
+        "snapshot",
+        [snapshot["StartTime"] for snapshot, _ in pending],
+        [verdict.retention_days * 86400 for _, verdict in pending]
+    )
+
+    for (snapshot, verdict), age_days, is_expired, snapshot_recheck_at in zip(pending, ages, expired, recheck_at):
+        snapshot_id = snapshot["SnapshotId"]
+        volume_id = snapshot.get("VolumeId")
+
+        if not is_expired:
+            logger.info(f"Skipping snapshot {snapshot_id}: only {age_days} days old")
+            on_kept(snapshot_id, str(verdict.retention_days), snapshot_recheck_at)
+            continue
+
+        if snapshot_id in ami_snapshot_ids:
+            logger.info(f"Skipping snapshot {snapshot_id}: backs a registered AMI")
+            continue
+
+        if not volume_id:
+            reason = f"Not linked to any volume, age {age_days} days"
+        elif volume_id not in volume_attached:
+            reason = f"Linked volume not found (possibly deleted), age {age_days} days"
+        elif not volume_attached[volume_id]:
+            reason = f"Volume not attached to any instance, age {age_days} days"
+        else:
+            logger.info(f"Skipping snapshot {snapshot_id}: volume attached")
+            continue
+
+        logger.info(f"Planning deletion of snapshot {snapshot_id}: {reason}")
+        candidates.append((volume_id, plan_action(
+            snapshot_id,
+            "EBS Snapshot",
+            "deleted",
+            reason,
+            "ec2",
+            "delete_snapshot",
+            {"SnapshotId": snapshot_id},
+            details={"size_gb": snapshot.get("VolumeSize"), "reclaim_estimate": "volume_size",
+                     **verdict.details()}
+        )))
+
+    return candidates
@@ -1,48 +1,81 @@
-import boto3
 import logging
-from datetime import datetime, timezone
 from botocore.exceptions import ClientError, BotoCoreError
-from config import EBS_VOLUME_AGE_DAYS
+from aws_clients import get_client
+from inventory import iter_volume_pages
+from executor import plan_action
+from state_store import needs_evaluation, record_kept
+from retention import evaluate_ages, AGE_BATCH_SIZE
+from policy import get_policy
+from checkpoint import ScanCursor
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def cleanup_unattached_volumes():
+def cleanup_unattached_volumes(ec2=None, policy=None, cursor=None):
     
-    ec2 = boto3.client("ec2")
-    deleted_volumes = []
+    ec2 = ec2 or get_client("ec2")
+    policy = policy or get_policy(region=ec2.meta.region_name)
+    cursor = cursor or ScanCursor()
+    planned_volumes = cursor.planned
 
     try:
-        response = ec2.describe_volumes()
-        volumes = response.get("Volumes", [])
-
-        for volume in volumes:
-            volume_id = volume.get("VolumeId")
-            state = volume.get("State")
-            create_time = volume.get("CreateTime")
-
-            if state == "available":
-               
-                age_days = (datetime.now(timezone.utc) - create_time).days
-
-                if age_days >= EBS_VOLUME_AGE_DAYS:
-                    try:
-                        ec2.delete_volume(VolumeId=volume_id)
-                        logger.info(f"Deleted volume {volume_id} (age: {age_days} days)")
-
-                        deleted_volumes.append({
-                            "resource_id": volume_id,
-                            "action": "deleted",
-                            "resource_type": "EBS Volume",
-                            "reason": f"Unattached and older than {EBS_VOLUME_AGE_DAYS} days",
-                            "timestamp": datetime.utcnow().isoformat()
-                        })
-                    except ClientError as e:
-                        logger.error(f"Failed to delete volume {volume_id}: {str(e)}")
-            else:
-                logger.info(f"Skipping volume {volume_id}: state is {state}")
+        pages = iter_volume_pages(ec2, AGE_BATCH_SIZE, cursor.token,
+                                  filters=[{"Name": "status", "Values": ["available"]}])
+
+        for batch, token in pages:
+            planned_volumes.extend(plan_volumes(batch, policy))
+            cursor.advance(token)
 
     except (ClientError, BotoCoreError) as e:
         logger.error(f"Error describing volumes: {str(e)}")
 
-    return deleted_volumes
+    return planned_volumes
+
+
+def plan_volumes(volumes, policy, on_kept=record_kept):
+    """
+    Deletion plans for a batch of volumes. Volumes kept only because they
+    are too young are passed to `on_kept(volume_id, fingerprint, recheck_at)`.
+    """
+
+    planned_volumes = []
+    pending = []
+    for volume in volumes:
+        volume_id = volume.get("VolumeId")
+        state = volume.get("State")
+        verdict = policy.evaluate("volume", volume.get("Tags"))
+
+        if state != "available":
+            logger.info(f"Skipping volume {volume_id}: state is {state}")
+        elif verdict.excluded:
+            logger.info(f"Skipping volume {volume_id}: excluded by policy rule {verdict.rule}")
+        elif needs_evaluation(volume_id, f"{verdict.retention_days}|{state}"):
+            pending.append((volume, verdict))
+
+    ages, expired, recheck_at = evaluate_ages(
+        "volume",
+        [volume["CreateTime"] for volume, _ in pending],
+        [verdict.retention_days * 86400 for _, verdict in pending]
+    )
+
+    for (volume, verdict), age_days, is_expired, volume_recheck_at in zip(pending, ages, expired, recheck_at):
+        volume_id = volume["VolumeId"]
+
+        if is_expired:
+            logger.info(f"Planning deletion of volume {volume_id} (age: {age_days} days)")
+
+            planned_volumes.append(plan_action(
+                volume_id,
+                "EBS Volume",
+                "deleted",
+                f"Unattached and older than {verdict.retention_days} days",
+                "ec2",
+                "delete_volume",
+                {"VolumeId": volume_id},
+                details={"size_gb": volume.get("Size"), "volume_type": volume.get("VolumeType"),
+                         **verdict.details()}
+            ))
+        else:
+            on_kept(volume_id, f"{verdict.retention_days}|{volume['State']}", volume_recheck_at)
+
+    return planned_volumes
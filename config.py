@@ -8,3 +8,61 @@ IDLE_IO_THRESHOLD_MB = float(os.environ.get("IDLE_IO_THRESHOLD_MB", "1.0"))
 LOG_S3_BUCKET = os.environ.get("LOG_S3_BUCKET", "ec2-cost-logs")
 LB_MIN_AGE_MINUTES = int(os.environ.get("LB_MIN_AGE_MINUTES", "60"))
 SNS_TOPIC_ARN = os.environ.get("SNS_TOPIC_ARN", "")
+SCANNER_MAX_WORKERS = int(os.environ.get("SCANNER_MAX_WORKERS", "6"))
+SCANNER_TIMEOUT_SECONDS = int(os.environ.get("SCANNER_TIMEOUT_SECONDS", "600"))
+HANDLER_RESERVED_SECONDS = int(os.environ.get("HANDLER_RESERVED_SECONDS", "30"))
+TARGET_ACCOUNTS = [a.strip() for a in os.environ.get("TARGET_ACCOUNTS", "").split(",") if a.strip()]
+TARGET_REGIONS = [r.strip() for r in os.environ.get("TARGET_REGIONS", "").split(",") if r.strip()]
+ASSUME_ROLE_NAME = os.environ.get("ASSUME_ROLE_NAME", "EC2CostOptimizationRole")
+FANOUT_CONCURRENCY = int(os.environ.get("FANOUT_CONCURRENCY", "4"))
+FANOUT_MAX_TARGETS_PER_INVOCATION = int(os.environ.get("FANOUT_MAX_TARGETS_PER_INVOCATION", "0"))
+FANOUT_MIN_SECONDS_PER_TARGET = int(os.environ.get("FANOUT_MIN_SECONDS_PER_TARGET", "120"))
+TARGET_HEALTH_CONCURRENCY = int(os.environ.get("TARGET_HEALTH_CONCURRENCY", "8"))
+AWS_MAX_ATTEMPTS = int(os.environ.get("AWS_MAX_ATTEMPTS", "8"))
+RETRY_BUDGET = int(os.environ.get("RETRY_BUDGET", "500"))
+RATE_LIMIT_EC2_DESCRIBE = float(os.environ.get("RATE_LIMIT_EC2_DESCRIBE", "20"))
+RATE_LIMIT_EC2_MUTATE = float(os.environ.get("RATE_LIMIT_EC2_MUTATE", "5"))
+RATE_LIMIT_CLOUDWATCH = float(os.environ.get("RATE_LIMIT_CLOUDWATCH", "20"))
+RATE_LIMIT_ELB = float(os.environ.get("RATE_LIMIT_ELB", "10"))
+RATE_LIMIT_DEFAULT = float(os.environ.get("RATE_LIMIT_DEFAULT", "20"))
+DRY_RUN = os.environ.get("DRY_RUN", "false").lower() in ("1", "true", "yes")
+EXECUTOR_MAX_WORKERS = int(os.environ.get("EXECUTOR_MAX_WORKERS", "8"))
+STATE_STORE_ENABLED = os.environ.get("STATE_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+STATE_STORE_PATH = os.environ.get("STATE_STORE_PATH", "")
+STATE_STORE_KEY = os.environ.get("STATE_STORE_KEY", "state/resource-state.json.gz")
+STATE_TTL_DAYS = int(os.environ.get("STATE_TTL_DAYS", "30"))
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "EC2CostOptimization")
+REPORT_PREFIX = os.environ.get("REPORT_PREFIX", "reports")
+REPORT_FORMAT = os.environ.get("REPORT_FORMAT", "jsonl").lower()
+REPORT_COMPRESSION = os.environ.get("REPORT_COMPRESSION", "gzip").lower()
+REPORT_PART_SIZE_MB = int(os.environ.get("REPORT_PART_SIZE_MB", "8"))
+PRICE_FILE = os.environ.get("PRICE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "prices.json"))
+PRICE_CACHE_PATH = os.environ.get("PRICE_CACHE_PATH", "")
+PRICE_CACHE_KEY = os.environ.get("PRICE_CACHE_KEY", "state/price-cache.json")
+PRICE_CACHE_TTL_DAYS = int(os.environ.get("PRICE_CACHE_TTL_DAYS", "7"))
+PRICING_API_ENABLED = os.environ.get("PRICING_API_ENABLED", "true").lower() in ("1", "true", "yes")
+SNAPSHOT_LINEAGE_ENABLED = os.environ.get("SNAPSHOT_LINEAGE_ENABLED", "true").lower() in ("1", "true", "yes")
+LINEAGE_MAX_DIFF_CALLS = int(os.environ.get("LINEAGE_MAX_DIFF_CALLS", "1000"))
+SNAPSHOT_MAX_DELETIONS_PER_RUN = int(os.environ.get("SNAPSHOT_MAX_DELETIONS_PER_RUN", "0"))
+RIGHTSIZING_ENABLED = os.environ.get("RIGHTSIZING_ENABLED", "true").lower() in ("1", "true", "yes")
+RIGHTSIZING_LOOKBACK_DAYS = int(os.environ.get("RIGHTSIZING_LOOKBACK_DAYS", "14"))
+RIGHTSIZING_TARGET_CPU_PERCENT = float(os.environ.get("RIGHTSIZING_TARGET_CPU_PERCENT", "70"))
+RIGHTSIZING_TARGET_MEMORY_PERCENT = float(os.environ.get("RIGHTSIZING_TARGET_MEMORY_PERCENT", "80"))
+RIGHTSIZING_MIN_SAVINGS_PERCENT = float(os.environ.get("RIGHTSIZING_MIN_SAVINGS_PERCENT", "10"))
+RIGHTSIZING_BATCH_SIZE = int(os.environ.get("RIGHTSIZING_BATCH_SIZE", "1000"))
+INSTANCE_CATALOG_FILE = os.environ.get("INSTANCE_CATALOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "instance_types.json"))
+POLICY_FILE = os.environ.get("POLICY_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "policy.json"))
+RECHECK_SCHEDULER_ROLE_ARN = os.environ.get("RECHECK_SCHEDULER_ROLE_ARN", "")
+RECHECK_SCHEDULE_GROUP = os.environ.get("RECHECK_SCHEDULE_GROUP", "default")
+TARGET_DRAIN_RECHECK_MINUTES = int(os.environ.get("TARGET_DRAIN_RECHECK_MINUTES", "10"))
+DETACH_GRACE_MINUTES = int(os.environ.get("DETACH_GRACE_MINUTES", "60"))
+CHECKPOINT_ENABLED = os.environ.get("CHECKPOINT_ENABLED", "true").lower() in ("1", "true", "yes")
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH", "")
+CHECKPOINT_PREFIX = os.environ.get("CHECKPOINT_PREFIX", "checkpoints")
+CHECKPOINT_INTERVAL_SECONDS = int(os.environ.get("CHECKPOINT_INTERVAL_SECONDS", "60"))
+CHECKPOINT_MARGIN_SECONDS = int(os.environ.get("CHECKPOINT_MARGIN_SECONDS", "60"))
+CHECKPOINT_MAX_RESUMES = int(os.environ.get("CHECKPOINT_MAX_RESUMES", "10"))
+NOTIFY_COOLDOWN_HOURS = float(os.environ.get("NOTIFY_COOLDOWN_HOURS", "24"))
+NOTIFY_MAX_ITEMS_PER_GROUP = int(os.environ.get("NOTIFY_MAX_ITEMS_PER_GROUP", "20"))
+NOTIFY_STATE_PATH = os.environ.get("NOTIFY_STATE_PATH", "")
+NOTIFY_STATE_KEY = os.environ.get("NOTIFY_STATE_KEY", "state/notified.json.gz")
@@ -0,0 +1,173 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, BotoCoreError
+from config import DRY_RUN, EXECUTOR_MAX_WORKERS
+from scheduler import get_deadline
+from retention import run_timestamp
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# The resource is already gone, so a repeated delete has done its job.
+ALREADY_DONE_CODES = {
+    "InvalidVolume.NotFound", "InvalidSnapshot.NotFound", "InvalidAMIID.NotFound",
+    "InvalidAMIID.Unavailable", "InvalidAllocationID.NotFound", "LoadBalancerNotFound",
+    "TargetGroupNotFound"
+}
+
+# Usually eventual consistency after a dependency was removed, e.g. a
+# snapshot still "in use" right after its AMI was deregistered, or an
+# Elastic IP right after its load balancer was deleted.
+RETRYABLE_CODES = {"InvalidSnapshot.InUse", "DependencyViolation", "ResourceInUse", "InvalidIPAddress.InUse"}
+MAX_ATTEMPTS = 4
+RETRY_DELAY_SECONDS = 2
+
+PLAN_ONLY_KEYS = {"service", "params", "depends_on"}
+
+# Error of actions left for a later invocation because the deadline passed.
+OUT_OF_TIME = "Not run: out of time"
+
+
+def plan_action(resource_id, resource_type, action, reason, service, operation, params, depends_on=None,
+                details=None):
+    """
+    A mutating call a scanner wants made. `depends_on` lists resource IDs
+    whose actions must succeed first. `details` (e.g. size or type, used
+    for cost estimates) are copied into the log entry.
+    """
+
+    return {
+        **(details or {}),
+        "resource_id": resource_id,
+        "action": action,
+        "resource_type": resource_type,
+        "reason": reason,
+        "service": service,
+        "operation": operation,
+        "params": params,
+        "depends_on": depends_on or []
+    }
+
+
+def _log_entry(action, status, error=None):
+
+    entry = {key: value for key, value in action.items() if key not in PLAN_ONLY_KEYS}
+    entry["status"] = status
+    entry["timestamp"] = run_timestamp()
+    if error:
+        entry["error"] = error
+    return entry
+
+
+def _apply(action, clients, deadline):
+
+    if time.monotonic() >= deadline:
+        return _log_entry(action, "failed", OUT_OF_TIME)
+
+    client = clients[action["service"]]
+    operation = getattr(client, action["operation"])
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            operation(**action["params"])
+            logger.info(f"{action['operation']} {action['resource_id']}: {action['reason']}")
+            return _log_entry(action, "succeeded")
+
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ALREADY_DONE_CODES:
+                logger.info(f"{action['operation']} {action['resource_id']}: already done ({code})")
+                return _log_entry(action, "succeeded")
+            if code in RETRYABLE_CODES and attempt < MAX_ATTEMPTS:
+                time.sleep(RETRY_DELAY_SECONDS * attempt)
+                continue
+            logger.error(f"Failed to {action['operation']} {action['resource_id']}: {str(e)}")
+            return _log_entry(action, "failed", str(e))
+
+        except BotoCoreError as e:
+            logger.error(f"Failed to {action['operation']} {action['resource_id']}: {str(e)}")
+            return _log_entry(action, "failed", str(e))
+
+
+def _waves(actions):
+    """Split actions into waves so every action runs after the actions it depends on."""
+
+    by_id = {action["resource_id"]: action for action in actions}
+    level = {}
+
+    def depth(resource_id, seen=()):
+        if resource_id in level:
+            return level[resource_id]
+        deps = [dep for dep in by_id[resource_id]["depends_on"] if dep in by_id and dep not in seen]
+        level[resource_id] = 1 + max((depth(dep, seen + (resource_id,)) for dep in deps), default=-1)
+        return level[resource_id]
+
+    waves = {}
+    for resource_id in by_id:
+        waves.setdefault(depth(resource_id), []).append(by_id[resource_id])
+    return [waves[key] for key in sorted(waves)]
+
+
+def execute_plan(plan, clients, context=None, dry_run=DRY_RUN, max_workers=EXECUTOR_MAX_WORKERS,
+                 done=None, on_done=None):
+    """
+    Apply planned actions on a bounded worker pool and return log entries.
+
+    Entries without an "operation" (e.g. notify-only findings) pass through
+    unchanged. Every action is logged with status "planned" (dry run),
+    "succeeded" or "failed". An action whose dependency failed is not run.
+
+    `done` maps resource IDs to the entries of actions an earlier invocation
+    of the same run already applied; those are not run again. `on_done` is
+    called with each entry of an action that ran to an outcome, i.e. not
+    one left with OUT_OF_TIME.
+    """
+
+    done = done or {}
+    log_entries = [entry for entry in plan if "operation" not in entry]
+    actions = []
+    seen = set()
+    for entry in plan:
+        if "operation" in entry and entry["resource_id"] not in seen:
+            seen.add(entry["resource_id"])
+            if entry["resource_id"] in done:
+                log_entries.append(done[entry["resource_id"]])
+            else:
+                actions.append(entry)
+
+    if dry_run:
+        logger.info(f"Dry run: {len(actions)} actions planned, none applied")
+        return log_entries + [_log_entry(action, "planned") for action in actions]
+
+    deadline = get_deadline(context)
+    failed = {resource_id for resource_id, entry in done.items() if entry.get("status") == "failed"}
+    late = set()
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="executor") as executor:
+        for wave in _waves(actions):
+            runnable = []
+            for action in wave:
+                blocked = [dep for dep in action["depends_on"] if dep in failed]
+                if any(dep in late for dep in blocked):
+                    failed.add(action["resource_id"])
+                    late.add(action["resource_id"])
+                    log_entries.append(_log_entry(action, "failed", OUT_OF_TIME))
+                elif blocked:
+                    failed.add(action["resource_id"])
+                    log_entries.append(_log_entry(action, "failed", f"Dependency {blocked[0]} failed"))
+                    if on_done:
+                        on_done(log_entries[-1])
+                else:
+                    runnable.append(action)
+
+            for entry in executor.map(lambda action: _apply(action, clients, deadline), runnable):
+                if entry["status"] == "failed":
+                    failed.add(entry["resource_id"])
+                if entry.get("error") == OUT_OF_TIME:
+                    late.add(entry["resource_id"])
+                elif on_done:
+                    on_done(entry)
+                log_entries.append(entry)
+
+    return log_entries
@@ -0,0 +1,184 @@
+import json
+import time
+import boto3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from botocore.exceptions import ClientError, BotoCoreError
+from config import (
+    TARGET_ACCOUNTS, TARGET_REGIONS, ASSUME_ROLE_NAME, FANOUT_CONCURRENCY,
+    FANOUT_MAX_TARGETS_PER_INVOCATION, FANOUT_MIN_SECONDS_PER_TARGET
+)
+from scheduler import get_deadline
+from aws_clients import get_client
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+ROLE_SESSION_NAME = "ec2-cost-optimization"
+
+_credentials_lock = threading.Lock()
+_credentials_cache = {}
+# (account_id, region, access key) -> session; a fresh session reloads botocore's
+# service models, which costs more than the clients it creates.
+_sessions = {}
+
+
+def is_fanout_event(event):
+
+    return bool(event) and (event.get("fanout") or "targets" in event)
+
+
+def build_targets(accounts=None, regions=None):
+    """Every (account, region) pair to scan. An account of None means the Lambda's own account."""
+
+    accounts = accounts or TARGET_ACCOUNTS or [None]
+    regions = regions or TARGET_REGIONS or [boto3.Session().region_name]
+    return [{"account_id": account_id, "region": region} for account_id in accounts for region in regions]
+
+
+def _assume_role_credentials(account_id):
+
+    with _credentials_lock:
+        credentials = _credentials_cache.get(account_id)
+        if credentials and credentials["Expiration"].timestamp() - time.time() > 300:
+            return credentials
+
+        sts = get_client("sts")
+        response = sts.assume_role(
+            RoleArn=f"arn:aws:iam::{account_id}:role/{ASSUME_ROLE_NAME}",
+            RoleSessionName=ROLE_SESSION_NAME
+        )
+        credentials = response["Credentials"]
+        _credentials_cache[account_id] = credentials
+        return credentials
+
+
+def get_session(account_id, region):
+    """
+    A boto3 session for one target, kept while its credentials are valid.
+    Clients are only created from it through the registry's lock, which
+    makes sharing it between workers and warm invocations safe.
+    """
+
+    credentials = _assume_role_credentials(account_id) if account_id else None
+    key = (account_id, region, credentials["AccessKeyId"] if credentials else None)
+
+    with _credentials_lock:
+        if key not in _sessions:
+            for stale in [k for k in _sessions if k[:2] == key[:2]]:
+                del _sessions[stale]
+            if credentials is None:
+                _sessions[key] = boto3.Session(region_name=region)
+            else:
+                _sessions[key] = boto3.Session(
+                    aws_access_key_id=credentials["AccessKeyId"],
+                    aws_secret_access_key=credentials["SecretAccessKey"],
+                    aws_session_token=credentials["SessionToken"],
+                    region_name=region
+                )
+        return _sessions[key]
+
+
+def _run_target(target, context, pipeline):
+
+    account_id = target.get("account_id")
+    region = target.get("region")
+
+    session = get_session(account_id, region)
+    log_entries, status = pipeline(context, session=session, account_id=account_id)
+
+    for entry in log_entries:
+        entry["account_id"] = account_id or "self"
+        entry["region"] = region
+
+    return {"status": status, "entries": log_entries}
+
+
+def dispatch_targets(targets, context, event=None):
+    """Hand targets off to a new asynchronous invocation of this function, keeping the event's options."""
+
+    if not targets:
+        return
+
+    function_name = getattr(context, "invoked_function_arn", None)
+    if not function_name:
+        logger.error(f"Cannot hand off {len(targets)} targets: no function ARN in context")
+        return
+
+    try:
+        lambda_client = get_client("lambda")
+        lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="Event",
+            Payload=json.dumps(dict(event or {}, fanout=True, targets=targets))
+        )
+        logger.info(f"Handed off {len(targets)} targets to a new invocation")
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f"Failed to hand off {len(targets)} targets: {str(e)}")
+
+
+def run_fanout(event, context, pipeline, concurrency=FANOUT_CONCURRENCY):
+    """
+    Run `pipeline(context, session=..., account_id=...)` for every (account, region) target.
+
+    Targets run on a bounded thread pool. Targets beyond
+    FANOUT_MAX_TARGETS_PER_INVOCATION, or that cannot start with at least
+    FANOUT_MIN_SECONDS_PER_TARGET left, are handed to a new invocation.
+    Returns a report keyed by account and then region.
+    """
+
+    targets = event.get("targets") or build_targets()
+
+    if FANOUT_MAX_TARGETS_PER_INVOCATION and len(targets) > FANOUT_MAX_TARGETS_PER_INVOCATION:
+        rest = targets[FANOUT_MAX_TARGETS_PER_INVOCATION:]
+        targets = targets[:FANOUT_MAX_TARGETS_PER_INVOCATION]
+        for offset in range(0, len(rest), FANOUT_MAX_TARGETS_PER_INVOCATION):
+            dispatch_targets(rest[offset:offset + FANOUT_MAX_TARGETS_PER_INVOCATION], context, event)
+
+    deadline = get_deadline(context)
+    report = {}
+    pending = list(targets)
+    running = {}
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fanout")
+
+    try:
+        while pending or running:
+
+            while pending and len(running) < concurrency:
+                if deadline - time.monotonic() < FANOUT_MIN_SECONDS_PER_TARGET:
+                    logger.warning(f"Not enough time left for {len(pending)} targets")
+                    dispatch_targets(pending, context, event)
+                    pending = []
+                    break
+
+                target = pending.pop(0)
+                running[executor.submit(_run_target, target, context, pipeline)] = target
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                target = running.pop(future)
+                account_id = target.get("account_id") or "self"
+                region = target.get("region")
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Error running cleanup for account {account_id} in {region}: {str(e)}")
+                    result = {"status": {}, "entries": [], "error": str(e)}
+
+                report.setdefault(account_id, {})[region] = result
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return report
+
+
+def flatten_report(report):
+
+    return [entry for regions in report.values() for result in regions.values() for entry in result["entries"]]
@@ -0,0 +1,400 @@
+import json
+import time
+import hashlib
+import logging
+from itertools import chain
+from datetime import datetime, timezone
+from collections import defaultdict
+from botocore.exceptions import ClientError, BotoCoreError
+from aws_clients import get_client
+from config import (
+    DRY_RUN, TARGET_ACCOUNTS, RECHECK_SCHEDULER_ROLE_ARN, RECHECK_SCHEDULE_GROUP, TARGET_DRAIN_RECHECK_MINUTES,
+    DETACH_GRACE_MINUTES
+)
+from inventory import (
+    iter_filtered, iter_volumes, iter_snapshots, iter_images, iter_addresses,
+    iter_load_balancers, iter_target_groups, iter_classic_load_balancers
+)
+from scheduler import build_clients
+from executor import execute_plan
+from pricing import estimate_monthly_savings
+from policy import get_policy, OWN_ACCOUNT
+from fanout import get_session
+from instrumentation import span
+from resource_graph import cascade_services, cascade_plan
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+CLOUDTRAIL_DETAIL_TYPE = "AWS API Call via CloudTrail"
+
+# Matches every address, for events that only name an association that no longer exists.
+ALL = "*"
+
+# Seconds added to a recheck time so the resource is past its threshold when the check runs.
+RECHECK_SLACK_SECONDS = 60
+
+# Events that often precede an attach elsewhere (moving a volume or an address to another
+# instance). Their resources are only rechecked after DETACH_GRACE_MINUTES, never planned at once.
+GRACE_EVENTS = {"DetachVolume", "DisassociateAddress"}
+
+# Kind -> services its evaluation needs.
+KIND_SERVICES = {
+    "volume": {"ec2"},
+    "instance": {"ec2"},
+    "volume_snapshots": {"ec2", "ebs"},
+    "snapshot": {"ec2", "ebs"},
+    "ami": {"ec2"},
+    "elastic_ip": {"ec2"},
+    "target_group": {"elbv2"},
+    "load_balancer": {"elbv2"},
+    "classic_load_balancer": {"elb"},
+}
+
+
+def is_incremental_event(event):
+    """A CloudTrail event forwarded by EventBridge, or a scheduled recheck of resources kept earlier."""
+
+    return bool(event) and (event.get("detail-type") == CLOUDTRAIL_DETAIL_TYPE or "recheck" in event)
+
+
+def _items(section, key):
+
+    return (section or {}).get(key, {}).get("items", [])
+
+
+def event_references(detail):
+    """
+    The resources one CloudTrail API call may have left unused, as
+    [(kind, id)]. Failed calls and calls this tool does not follow give [].
+    """
+
+    if detail.get("errorCode"):
+        return []
+
+    name = detail.get("eventName")
+    request = detail.get("requestParameters") or {}
+    response = detail.get("responseElements") or {}
+
+    if name == "DetachVolume":
+        # Snapshots of a volume count as unused once it is detached.
+        return [("volume", request.get("volumeId")), ("volume_snapshots", request.get("volumeId"))]
+    if name in ("CreateSnapshot", "CopySnapshot"):
+        return [("snapshot", response.get("snapshotId"))]
+    if name == "CreateSnapshots":
+        return [("snapshot", item.get("snapshotId")) for item in _items(response, "snapshotSet")]
+    if name == "CreateImage":
+        return [("ami", response.get("imageId"))]
+    if name == "DisassociateAddress":
+        return [("elastic_ip", request.get("publicIp") or ALL)]
+    if name == "DeregisterTargets":
+        return [("target_group", request.get("targetGroupArn"))]
+    if name == "DeregisterInstancesFromLoadBalancer":
+        return [("classic_load_balancer", request.get("loadBalancerName"))]
+    if name == "StopInstances":
+        # Volumes and addresses stay attached to a stopped instance, so today's rules keep them;
+        # they are looked at so that anything already detached from it is not missed.
+        return [("instance", item.get("instanceId")) for item in _items(request, "instancesSet")]
+    return []
+
+
+def _own_account_id(context):
+    """The function's own account, from its ARN: arn:aws:lambda:<region>:<account>:function:<name>."""
+
+    parts = (getattr(context, "invoked_function_arn", None) or "").split(":")
+    return parts[4] if len(parts) > 4 else None
+
+
+def _is_ours(account_id, own_account):
+
+    return not account_id or account_id == own_account or account_id in TARGET_ACCOUNTS
+
+
+def _event_account(account_id):
+
+    # None stands for the function's own account, read with its own credentials.
+    return account_id if account_id in TARGET_ACCOUNTS else None
+
+
+def group_references(event, own_account=None):
+    """
+    {(account_id, region): {kind: {id}}} for a CloudTrail event or a recheck
+    event. CloudTrail events from accounts that are neither `own_account`
+    nor in TARGET_ACCOUNTS (e.g. forwarded by an organization bus) are
+    dropped, so their IDs are never looked up in this account.
+    """
+
+    groups = defaultdict(lambda: defaultdict(set))
+
+    if "recheck" in event:
+        for item in event["recheck"]:
+            account_id = item.get("account_id")
+            groups[(None if account_id == OWN_ACCOUNT else account_id, item.get("region"))][item["kind"]].add(item["id"])
+    else:
+        detail = event.get("detail") or {}
+        account_id = detail.get("recipientAccountId") or event.get("account")
+        if not _is_ours(account_id, own_account):
+            logger.warning(f"Ignoring {detail.get('eventName')} event from account {account_id}: "
+                           f"not this function's account and not in TARGET_ACCOUNTS")
+            return groups
+        account_id = _event_account(account_id)
+        region = detail.get("awsRegion") or event.get("region")
+        for kind, resource_id in event_references(detail):
+            if resource_id:
+                groups[(account_id, region)][kind].add(resource_id)
+
+    return groups
+
+
+class _Rechecks:
+    """Collects resources kept only because they are too young, as an on_kept callback per kind."""
+
+    def __init__(self):
+        self.items = []
+
+    def on_kept(self, kind):
+
+        return lambda resource_id, fingerprint, recheck_at: self.items.append((kind, resource_id, recheck_at))
+
+
+def _unique(id_field, items):
+
+    return list({item[id_field]: item for item in items if item.get(id_field)}.values())
+
+
+def _plan_ec2(clients, references, policy, rechecks):
+
+    # Scanner modules are imported on first use, so main's cold start does not load them.
+    from cleanup_volumes import plan_volumes
+    from cleanup_snapshots import build_snapshot_index, plan_snapshots, rank_snapshot_deletions
+    from cleanup_amis import plan_images
+    from cleanup_elastic_ips import plan_addresses
+
+    ec2 = clients["ec2"]
+    plan = []
+
+    volumes = _unique("VolumeId", chain(
+        iter_filtered(ec2, iter_volumes, "volume-id", references.get("volume", ())),
+        iter_filtered(ec2, iter_volumes, "attachment.instance-id", references.get("instance", ()))
+    ))
+    if volumes:
+        plan.extend(plan_volumes(volumes, policy, on_kept=rechecks.on_kept("volume")))
+
+    # A snapshot named by the event may still be pending; it is young either way and gets a recheck.
+    snapshots = _unique("SnapshotId", chain(
+        iter_filtered(ec2, iter_snapshots, "snapshot-id", references.get("snapshot", ())),
+        iter_filtered(ec2, iter_snapshots, "volume-id", references.get("volume_snapshots", ()))
+    ))
+    snapshots = [snapshot for snapshot in snapshots
+                 if snapshot.get("State") == "completed" or snapshot["SnapshotId"] in references.get("snapshot", ())]
+    if snapshots:
+        volume_attached, ami_snapshot_ids = build_snapshot_index(ec2, snapshots)
+        candidates = plan_snapshots(snapshots, policy, volume_attached, ami_snapshot_ids,
+                                    on_kept=rechecks.on_kept("snapshot"))
+        plan.extend(rank_snapshot_deletions(ec2, clients["ebs"], candidates))
+
+    images = list(iter_filtered(ec2, iter_images, "image-id", references.get("ami", ())))
+    if images:
+        plan.extend(plan_images(images, policy, on_kept=rechecks.on_kept("ami")))
+
+    public_ips = references.get("elastic_ip", set())
+    addresses = _unique("PublicIp", chain(
+        iter_addresses(ec2) if ALL in public_ips else iter_filtered(ec2, iter_addresses, "public-ip", public_ips),
+        iter_filtered(ec2, iter_addresses, "instance-id", references.get("instance", ()))
+    ))
+    if addresses:
+        plan.extend(plan_addresses(addresses, policy))
+
+    return plan
+
+
+def _plan_load_balancers(clients, references, policy, rechecks):
+
+    from cleanup_load_balancers import build_lb_topology, plan_load_balancers
+
+    elb = clients["elbv2"]
+    lb_arns = set(references.get("load_balancer", ()))
+    draining = set()
+
+    for tg_arn in references.get("target_group", ()):
+        try:
+            for tg in iter_target_groups(elb, arns=[tg_arn]):
+                draining.update(tg.get("LoadBalancerArns", []))
+        except ClientError as e:
+            logger.info(f"Skipping target group {tg_arn}: {str(e)}")
+    lb_arns |= draining
+
+    # One call per load balancer, so one that is already gone does not hide the others.
+    lbs = []
+    for lb_arn in sorted(lb_arns):
+        try:
+            lbs.extend(iter_load_balancers(elb, arns=[lb_arn]))
+        except ClientError as e:
+            logger.info(f"Skipping load balancer {lb_arn}: {str(e)}")
+    if not lbs:
+        return []
+
+    lb_has_targets = build_lb_topology(elb, [lb["LoadBalancerArn"] for lb in lbs])
+
+    # Deregistered targets keep counting while they drain, so look again once draining is over.
+    drained_at = time.time() + TARGET_DRAIN_RECHECK_MINUTES * 60
+    for lb_arn in sorted(draining):
+        if lb_has_targets.get(lb_arn):
+            rechecks.items.append(("load_balancer", lb_arn, drained_at))
+
+    return plan_load_balancers(elb, lbs, lb_has_targets, policy, on_kept=rechecks.on_kept("load_balancer"))
+
+
+def _plan_classic_load_balancers(clients, references, policy, rechecks):
+
+    from cleanup_load_balancers import plan_classic_load_balancers
+
+    classic_elb = clients["elb"]
+    lbs = []
+    for name in sorted(references.get("classic_load_balancer", ())):
+        try:
+            lbs.extend(iter_classic_load_balancers(classic_elb, names=[name]))
+        except ClientError as e:
+            logger.info(f"Skipping classic load balancer {name}: {str(e)}")
+    if not lbs:
+        return []
+
+    return plan_classic_load_balancers(classic_elb, lbs, policy,
+                                       on_kept=rechecks.on_kept("classic_load_balancer"))
+
+
+def evaluate_references(references, context, account_id=None, region=None, dry_run=DRY_RUN):
+    """
+    Evaluate only the referenced resources of one (account, region) with the
+    scanners' rules, apply the resulting plan and return (log entries,
+    rechecks), where rechecks are (kind, id, epoch seconds) for resources
+    kept only until they reach their age threshold.
+    """
+
+    session = get_session(account_id, region)
+    region = session.region_name
+    services = set().union(*(KIND_SERVICES[kind] for kind in references if kind in KIND_SERVICES))
+    clients = build_clients(sorted(services), session=session)
+    policy = get_policy(account_id, region)
+    rechecks = _Rechecks()
+    plan = []
+
+    with span("phase:scan"):
+        for planner, service in [(_plan_ec2, "ec2"), (_plan_load_balancers, "elbv2"),
+                                 (_plan_classic_load_balancers, "elb")]:
+            if service not in services:
+                continue
+            try:
+                plan.extend(planner(clients, references, policy, rechecks))
+            except (ClientError, BotoCoreError) as e:
+                logger.error(f"Error evaluating {service} resources from event: {str(e)}")
+
+    with span("phase:cascade"):
+        clients.update(build_clients(sorted(cascade_services(plan) - set(clients)), session=session))
+        plan = cascade_plan(plan, clients, policy)
+    with span("phase:pricing"):
+        estimate_monthly_savings(plan, region)
+    with span("phase:execute"):
+        log_entries = execute_plan(plan, clients, context, dry_run=dry_run)
+
+    for entry in log_entries:
+        entry["account_id"] = account_id or OWN_ACCOUNT
+        entry["region"] = region
+
+    return log_entries, rechecks.items
+
+
+def _schedule_name(account_id, region, kind, resource_id):
+
+    digest = hashlib.sha1(f"{account_id}|{region}|{kind}|{resource_id}".encode("utf-8")).hexdigest()
+    return f"ec2-cost-recheck-{digest[:20]}"
+
+
+def schedule_rechecks(rechecks, context, account_id, region, event):
+    """
+    One EventBridge Scheduler one-time schedule per kept resource, invoking
+    this function with a recheck event once it reaches its threshold. The
+    name is derived from the resource, so a repeated event moves the
+    existing schedule instead of adding another.
+    """
+
+    if not rechecks:
+        return 0
+    if not RECHECK_SCHEDULER_ROLE_ARN:
+        logger.info(f"RECHECK_SCHEDULER_ROLE_ARN not configured, {len(rechecks)} rechecks are left "
+                    f"to the scheduled full scan")
+        return 0
+
+    function_arn = getattr(context, "invoked_function_arn", None)
+    if not function_arn:
+        logger.error(f"Cannot schedule {len(rechecks)} rechecks: no function ARN in context")
+        return 0
+
+    scheduler = get_client("scheduler")
+    scheduled = 0
+
+    for kind, resource_id, recheck_at in rechecks:
+        due = max(recheck_at, time.time()) + RECHECK_SLACK_SECONDS
+        payload = {"recheck": [{"kind": kind, "id": resource_id,
+                                "account_id": account_id or OWN_ACCOUNT, "region": region}]}
+        if "dry_run" in event:
+            payload["dry_run"] = event["dry_run"]
+
+        schedule = {
+            "Name": _schedule_name(account_id, region, kind, resource_id),
+            "GroupName": RECHECK_SCHEDULE_GROUP,
+            "ScheduleExpression": f"at({datetime.fromtimestamp(due, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')})",
+            "ScheduleExpressionTimezone": "UTC",
+            "FlexibleTimeWindow": {"Mode": "OFF"},
+            "ActionAfterCompletion": "DELETE",
+            "Target": {"Arn": function_arn, "RoleArn": RECHECK_SCHEDULER_ROLE_ARN, "Input": json.dumps(payload)},
+        }
+
+        try:
+            try:
+                scheduler.create_schedule(**schedule)
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConflictException":
+                    raise
+                scheduler.update_schedule(**schedule)
+            scheduled += 1
+        except (ClientError, BotoCoreError) as e:
+            logger.error(f"Failed to schedule recheck of {kind} {resource_id}: {str(e)}")
+
+    logger.info(f"Scheduled {scheduled} rechecks in {account_id or OWN_ACCOUNT}/{region}")
+    return scheduled
+
+
+def run_incremental(event, context, dry_run=DRY_RUN):
+    """
+    Handle a CloudTrail event or a recheck event: evaluate just the
+    resources it names and schedule a recheck for those kept only for their
+    age. Resources of GRACE_EVENTS are only scheduled for a recheck. The
+    scheduled full scan remains as a reconciliation for missed events.
+    """
+
+    groups = group_references(event, _own_account_id(context))
+    event_name = (event.get("detail") or {}).get("eventName")
+    if not groups:
+        logger.info(f"Nothing to evaluate for {event_name or 'recheck'} event")
+        return []
+
+    all_logs = []
+    for (account_id, region), references in groups.items():
+        try:
+            region = get_session(account_id, region).region_name
+            if event_name in GRACE_EVENTS:
+                recheck_at = time.time() + DETACH_GRACE_MINUTES * 60
+                rechecks = [(kind, resource_id, recheck_at)
+                            for kind, resource_ids in references.items() for resource_id in sorted(resource_ids)]
+                logger.info(f"Rechecking {len(rechecks)} resources from {event_name} "
+                            f"in {DETACH_GRACE_MINUTES} minutes instead of now")
+            else:
+                log_entries, rechecks = evaluate_references(references, context, account_id, region, dry_run)
+                all_logs.extend(log_entries)
+            with span("phase:schedule"):
+                schedule_rechecks(rechecks, context, account_id, region, event)
+        except Exception as e:
+            logger.error(f"Error evaluating event resources in {account_id or OWN_ACCOUNT}/{region}: {str(e)}")
+
+    return all_logs
@@ -0,0 +1,205 @@
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from aws_clients import register_client_hook, get_api_stats, get_client_stats
+from config import METRICS_NAMESPACE
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+_lock = threading.Lock()
+_api = {}
+_spans = {}
+_startup = {"cold_start": False, "init_ms": 0.0}
+
+
+def _new_api_stats():
+
+    return {"calls": 0, "errors": 0, "retries": 0, "latency_ms": 0.0, "max_latency_ms": 0.0,
+            "request_bytes": 0, "response_bytes": 0}
+
+
+def _before_call(params, context, **kwargs):
+
+    body = params.get("body")
+    context["instrumentation"] = {
+        "started_at": time.perf_counter(),
+        "request_bytes": len(body) if isinstance(body, (bytes, str)) else 0
+    }
+
+
+def _after_call(http_response, parsed, model, context, **kwargs):
+
+    started = context.get("instrumentation")
+    if started is None:
+        return
+
+    latency_ms = (time.perf_counter() - started["started_at"]) * 1000
+    api = f"{model.service_model.service_id.hyphenize()}.{model.name}"
+    # Only the header: reading the body here would consume streaming responses.
+    response_bytes = int(getattr(http_response, "headers", {}).get("content-length") or 0)
+
+    with _lock:
+        stats = _api.setdefault(api, _new_api_stats())
+        stats["calls"] += 1
+        stats["errors"] += 1 if http_response.status_code >= 300 else 0
+        stats["retries"] += parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+        stats["latency_ms"] += latency_ms
+        stats["max_latency_ms"] = max(stats["max_latency_ms"], latency_ms)
+        stats["request_bytes"] += started["request_bytes"]
+        stats["response_bytes"] += response_bytes
+
+
+def instrument_client(client):
+
+    client.meta.events.register("before-call", _before_call)
+    client.meta.events.register("after-call", _after_call)
+
+
+register_client_hook(instrument_client)
+
+
+@contextmanager
+def span(name):
+    """Time a block, e.g. a scanner or a phase of the run. Repeated names are aggregated."""
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        with _lock:
+            stats = _spans.setdefault(name, {"count": 0, "duration_ms": 0.0, "max_duration_ms": 0.0})
+            stats["count"] += 1
+            stats["duration_ms"] += duration_ms
+            stats["max_duration_ms"] = max(stats["max_duration_ms"], duration_ms)
+
+
+def record_startup(cold_start, init_ms):
+    """Whether this invocation started the process, and how long loading the handler module took."""
+
+    with _lock:
+        _startup.update(cold_start=cold_start, init_ms=round(init_ms, 1) if cold_start else 0.0)
+
+
+def reset_metrics():
+
+    with _lock:
+        _api.clear()
+        _spans.clear()
+        _startup.update(cold_start=False, init_ms=0.0)
+
+
+def get_run_metrics():
+    """
+    Per-API call statistics (including rate-limiter waits and throttles),
+    span timings, and startup costs: cold start, handler module load time
+    and clients created or reused from the registry.
+    """
+
+    limiter_stats = get_api_stats()
+    client_stats = get_client_stats()
+    with _lock:
+        api = {name: dict(stats) for name, stats in _api.items()}
+        spans = {name: dict(stats) for name, stats in _spans.items()}
+        startup = dict(_startup)
+
+    for name, stats in limiter_stats.items():
+        entry = api.setdefault(name, _new_api_stats())
+        entry["throttles"] = stats["throttles"]
+        entry["rate_limited_seconds"] = round(stats["wait_seconds"], 3)
+
+    startup.update(
+        clients_created=client_stats["created"],
+        clients_reused=client_stats["reused"],
+        client_create_ms=round(client_stats["create_seconds"] * 1000, 1)
+    )
+    return {"api": api, "spans": spans, "startup": startup}
+
+
+def publish_emf(run_metrics, namespace=METRICS_NAMESPACE):
+    """Print the run metrics in CloudWatch Embedded Metric Format; Lambda turns them into metrics."""
+
+    timestamp = int(time.time() * 1000)
+
+    for api, stats in run_metrics["api"].items():
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [["Api"]],
+                    "Metrics": [
+                        {"Name": "Calls", "Unit": "Count"},
+                        {"Name": "Errors", "Unit": "Count"},
+                        {"Name": "Retries", "Unit": "Count"},
+                        {"Name": "Throttles", "Unit": "Count"},
+                        {"Name": "LatencyMs", "Unit": "Milliseconds"},
+                        {"Name": "RateLimitedMs", "Unit": "Milliseconds"},
+                        {"Name": "ResponseBytes", "Unit": "Bytes"}
+                    ]
+                }]
+            },
+            "Api": api,
+            "Calls": stats["calls"],
+            "Errors": stats["errors"],
+            "Retries": stats["retries"],
+            "Throttles": stats.get("throttles", 0),
+            "LatencyMs": round(stats["latency_ms"], 1),
+            "RateLimitedMs": round(stats.get("rate_limited_seconds", 0) * 1000, 1),
+            "ResponseBytes": stats["response_bytes"]
+        }))
+
+    for name, stats in run_metrics["spans"].items():
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [["Span"]],
+                    "Metrics": [{"Name": "DurationMs", "Unit": "Milliseconds"}]
+                }]
+            },
+            "Span": name,
+            "DurationMs": round(stats["duration_ms"], 1)
+        }))
+
+    startup = run_metrics["startup"]
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [[]],
+                "Metrics": [
+                    {"Name": "ColdStart", "Unit": "Count"},
+                    {"Name": "InitMs", "Unit": "Milliseconds"},
+                    {"Name": "ClientsCreated", "Unit": "Count"},
+                    {"Name": "ClientCreateMs", "Unit": "Milliseconds"}
+                ]
+            }]
+        },
+        "ColdStart": int(startup["cold_start"]),
+        "InitMs": startup["init_ms"],
+        "ClientsCreated": startup["clients_created"],
+        "ClientCreateMs": startup["client_create_ms"]
+    }))
+
+
+def log_run_metrics(run_metrics):
+
+    startup = run_metrics["startup"]
+    logger.info(
+        f"Startup: {'cold' if startup['cold_start'] else 'warm'}, init {startup['init_ms']:.0f} ms, "
+        f"{startup['clients_created']} clients created in {startup['client_create_ms']:.0f} ms, "
+        f"{startup['clients_reused']} reused"
+    )
+    for name, stats in sorted(run_metrics["spans"].items(), key=lambda item: -item[1]["duration_ms"]):
+        logger.info(f"Span {name}: {stats['duration_ms']:.0f} ms over {stats['count']} run(s)")
+    for api, stats in sorted(run_metrics["api"].items(), key=lambda item: -item[1]["latency_ms"]):
+        logger.info(
+            f"API {api}: {stats['calls']} calls, {stats['latency_ms']:.0f} ms total, "
+            f"{stats['retries']} retries, {stats.get('throttles', 0)} throttles"
+        )
@@ -0,0 +1,137 @@
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Values per describe_* filter.
+FILTER_CHUNK = 200
+
+# Largest MaxResults each describe_* call read in resumable pages accepts.
+MAX_PAGE_SIZES = {"describe_volumes": 500, "describe_snapshots": 1000, "describe_images": 1000}
+
+
+def paginate(client, operation, result_key, **kwargs):
+    """
+    Yield every item under `result_key` across all pages of a describe_* call.
+
+    Only one page is held in memory at a time. Operations without a boto3
+    paginator fall back to a single call.
+    """
+
+    if client.can_paginate(operation):
+        for page in client.get_paginator(operation).paginate(**kwargs):
+            yield from page.get(result_key, [])
+    else:
+        yield from getattr(client, operation)(**kwargs).get(result_key, [])
+
+
+def paginate_pages(client, operation, result_key, page_size, starting_token=None, **kwargs):
+    """
+    Yield (items, resume_token) for `page_size` items at a time. Passing a
+    resume_token back as `starting_token` continues right after those items,
+    e.g. in a later invocation; it is None after the last items.
+    """
+
+    page_size = min(page_size, MAX_PAGE_SIZES.get(operation, page_size))
+    token = starting_token
+    while True:
+        pages = client.get_paginator(operation).paginate(
+            PaginationConfig={"MaxItems": page_size, "PageSize": page_size, "StartingToken": token},
+            **kwargs
+        )
+        items = [item for page in pages for item in page.get(result_key, [])]
+        token = pages.resume_token
+        yield items, token
+        if not token:
+            return
+
+
+def _with_filters(kwargs, filters):
+
+    if filters:
+        kwargs["Filters"] = filters
+    return kwargs
+
+
+def iter_filtered(client, iterate, name, values):
+    """Items of `iterate(client, filters=...)` matching any of `values` for filter `name`, in chunks."""
+
+    values = sorted(values)
+    for offset in range(0, len(values), FILTER_CHUNK):
+        yield from iterate(client, filters=[{"Name": name, "Values": values[offset:offset + FILTER_CHUNK]}])
+
+
+def iter_volumes(ec2, filters=None):
+
+    return paginate(ec2, "describe_volumes", "Volumes", **_with_filters({}, filters))
+
+
+def iter_volume_pages(ec2, page_size, starting_token=None, filters=None):
+
+    return paginate_pages(ec2, "describe_volumes", "Volumes", page_size, starting_token, **_with_filters({}, filters))
+
+
+def iter_snapshots(ec2, filters=None):
+
+    return paginate(ec2, "describe_snapshots", "Snapshots", **_with_filters({"OwnerIds": ["self"]}, filters))
+
+
+def iter_snapshot_pages(ec2, page_size, starting_token=None, filters=None):
+
+    return paginate_pages(ec2, "describe_snapshots", "Snapshots", page_size, starting_token,
+                          **_with_filters({"OwnerIds": ["self"]}, filters))
+
+
+def iter_images(ec2, filters=None):
+
+    return paginate(ec2, "describe_images", "Images", **_with_filters({"Owners": ["self"]}, filters))
+
+
+def iter_image_pages(ec2, page_size, starting_token=None, filters=None):
+
+    return paginate_pages(ec2, "describe_images", "Images", page_size, starting_token,
+                          **_with_filters({"Owners": ["self"]}, filters))
+
+
+def iter_addresses(ec2, filters=None):
+
+    return paginate(ec2, "describe_addresses", "Addresses", **_with_filters({}, filters))
+
+
+def iter_instances(ec2, filters=None):
+
+    for reservation in paginate(ec2, "describe_instances", "Reservations", **_with_filters({}, filters)):
+        yield from reservation.get("Instances", [])
+
+
+def iter_load_balancers(elb, arns=None):
+
+    kwargs = {"LoadBalancerArns": arns} if arns else {}
+    return paginate(elb, "describe_load_balancers", "LoadBalancers", **kwargs)
+
+
+def iter_target_groups(elb, load_balancer_arn=None, arns=None):
+
+    kwargs = {"LoadBalancerArn": load_balancer_arn} if load_balancer_arn else {}
+    if arns:
+        kwargs["TargetGroupArns"] = arns
+    return paginate(elb, "describe_target_groups", "TargetGroups", **kwargs)
+
+
+def iter_classic_load_balancers(classic_elb, names=None):
+
+    kwargs = {"LoadBalancerNames": names} if names else {}
+    return paginate(classic_elb, "describe_load_balancers", "LoadBalancerDescriptions", **kwargs)
+
+
+def iter_batches(items, batch_size):
+    """Group a stream into lists of at most `batch_size` items."""
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
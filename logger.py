@@ -1,22 +1,58 @@
 import json
-import boto3
 import logging
-from datetime import datetime
 from botocore.exceptions import BotoCoreError, ClientError
+from aws_clients import get_client
 from config import LOG_S3_BUCKET
+from report_writer import write_report
+from retention import run_time
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def upload_log_to_s3(log_entries):
+def _target_statuses(report):
 
-    s3 = boto3.client("s3")
-    timestamp = datetime.utcnow().strftime("%Y-%m-%d-%H%M%S")
-    filename = f"{timestamp}-summary.json"
+    return {
+        account_id: {
+            region: {key: result[key] for key in ("status", "error") if key in result}
+            for region, result in regions.items()
+        }
+        for account_id, regions in report.items()
+    }
+
+def upload_log_to_s3(log_entries, run_metrics=None):
+    """
+    Stream the run's entries (a list, or a fan-out report keyed by account and
+    region) into partitioned, compressed report objects, then write a small
+    manifest listing them and, if given, the run metrics.
+
+    Returns where the report went, for linking from notifications:
+    {"bucket", "manifest", "region", "partitions": {partition: key}}, or
+    None if the upload failed.
+    """
+
+    s3 = get_client("s3")
+    started = run_time()
+    timestamp = started.strftime("%Y-%m-%d-%H%M%S")
 
     try:
-        log_data = json.dumps(log_entries, indent=2)
-        s3.put_object(Bucket=LOG_S3_BUCKET, Key=filename, Body=log_data)
-        logger.info(f"Successfully uploaded log to S3 bucket {LOG_S3_BUCKET} as {filename}")
+        written, keys = write_report(s3, LOG_S3_BUCKET, log_entries, timestamp, started.strftime("%Y-%m-%d"),
+                               s3.meta.region_name)
+        logger.info(f"Successfully uploaded {sum(written.values())} log entries in {len(written)} partitions "
+                    f"to S3 bucket {LOG_S3_BUCKET}")
+
+        manifest = {"run_id": timestamp, "partitions": written}
+        if isinstance(log_entries, dict):
+            manifest["targets"] = _target_statuses(log_entries)
+        manifest_filename = f"{timestamp}-manifest.json"
+        s3.put_object(Bucket=LOG_S3_BUCKET, Key=manifest_filename, Body=json.dumps(manifest, indent=2))
+        logger.info(f"Successfully uploaded manifest to S3 bucket {LOG_S3_BUCKET} as {manifest_filename}")
+
+        if run_metrics is not None:
+            metrics_filename = f"{timestamp}-metrics.json"
+            s3.put_object(Bucket=LOG_S3_BUCKET, Key=metrics_filename, Body=json.dumps(run_metrics, indent=2))
+            logger.info(f"Successfully uploaded run metrics to S3 bucket {LOG_S3_BUCKET} as {metrics_filename}")
     except (BotoCoreError, ClientError) as e:
         logger.error(f"Failed to upload logs to S3: {str(e)}")
+        return None
+
+    return {"bucket": LOG_S3_BUCKET, "manifest": manifest_filename, "region": s3.meta.region_name, "partitions": keys}
@@ -1,70 +1,190 @@
+import time
+
+_INIT_STARTED = time.perf_counter()
+
 import logging
-from cleanup_volumes import cleanup_unattached_volumes
-from cleanup_snapshots import cleanup_old_snapshots
-from cleanup_instances import cleanup_idle_instances
-from cleanup_elastic_ips import cleanup_unattached_elastic_ips
-from cleanup_load_balancers import cleanup_unused_load_balancers
-from cleanup_amis import cleanup_old_amis
+from functools import partial
 from logger import upload_log_to_s3
-from notifier import notify_cleanup_changes  
+from notifier import notify_cleanup_changes
+from scheduler import build_clients, run_scanners, select_scanners, required_services, get_deadline
+from fanout import is_fanout_event, run_fanout, flatten_report, dispatch_targets
+from incremental import is_incremental_event, run_incremental
+from aws_clients import reset_api_stats, get_session
+from executor import execute_plan, OUT_OF_TIME
+from config import DRY_RUN
+from state_store import load_state, disable_state, save_state
+from retention import start_run, log_age_histograms
+from pricing import estimate_monthly_savings
+from policy import get_policy
+from resource_graph import cascade_services, cascade_plan
+from checkpoint import begin_run, get_progress, can_resume, suspended_targets, continuation, resume_run
+from instrumentation import span, reset_metrics, record_startup, get_run_metrics, log_run_metrics, publish_emf
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Scanners only read and plan; ordering between deletions (e.g. an AMI's
+# snapshots after the AMI) is expressed with depends_on in the plan.
+# Scanner modules are imported only when a run enables them.
+SCANNERS = {
+    "volumes": {
+        "func": "cleanup_volumes:cleanup_unattached_volumes",
+        "clients": {"ec2": "ec2"},
+        "after": [],
+        "resumable": True,
+        "description": "EBS volume cleanup"
+    },
+    "amis": {
+        "func": "cleanup_amis:cleanup_old_amis",
+        "clients": {"ec2": "ec2"},
+        "after": [],
+        "resumable": True,
+        "description": "AMI cleanup"
+    },
+    "snapshots": {
+        "func": "cleanup_snapshots:cleanup_old_snapshots",
+        "clients": {"ec2": "ec2", "ebs": "ebs"},
+        "after": [],
+        "resumable": True,
+        "description": "snapshot cleanup"
+    },
+    "instances": {
+        "func": "cleanup_instances:cleanup_idle_instances",
+        "clients": {"ec2": "ec2", "cloudwatch": "cloudwatch"},
+        "after": [],
+        "description": "idle instance check"
+    },
+    "rightsizing": {
+        "func": "rightsizing:recommend_rightsizing",
+        "clients": {"ec2": "ec2", "cloudwatch": "cloudwatch"},
+        "after": [],
+        "description": "instance rightsizing"
+    },
+    "elastic_ips": {
+        "func": "cleanup_elastic_ips:cleanup_unattached_elastic_ips",
+        "clients": {"ec2": "ec2"},
+        "after": [],
+        "description": "Elastic IP release"
+    },
+    "load_balancers": {
+        "func": "cleanup_load_balancers:cleanup_unused_load_balancers",
+        "clients": {"elb": "elbv2", "classic_elb": "elb"},
+        "after": [],
+        "description": "load balancer cleanup"
+    },
+}
+
+_cold_start = True
+
+def run_cleanup(context, session=None, dry_run=DRY_RUN, account_id=None, scanners=None):
+
+    scanners = SCANNERS if scanners is None else scanners
+    region = get_session(session).region_name
+    clients = build_clients(required_services(scanners), session=session)
+    policy = get_policy(account_id, region)
+    progress = get_progress(account_id, region)
+    with span("phase:scan"):
+        plan, status = run_scanners(scanners, clients, context, policy=policy, progress=progress)
+
+    # The plan is applied once every scanner has finished, possibly in a later invocation.
+    if progress is not None and progress.suspended:
+        return [], status
+
+    # Resources the plan orphans, e.g. an AMI's snapshots or a load balancer's target groups.
+    with span("phase:cascade"):
+        clients.update(build_clients(sorted(cascade_services(plan) - set(clients)), session=session))
+        plan = cascade_plan(plan, clients, policy)
+    with span("phase:pricing"):
+        estimate_monthly_savings(plan, region)
+    with span("phase:execute"):
+        log_entries = execute_plan(
+            plan, clients, context, dry_run=dry_run,
+            done=progress.done if progress is not None else None,
+            on_done=progress.record_done if progress is not None else None
+        )
+
+    if progress is not None:
+        if can_resume() and any(entry.get("error") == OUT_OF_TIME for entry in log_entries):
+            progress.suspend("execution")
+            return [], status
+        progress.clear()
+    return log_entries, status
+
 def lambda_handler(event, context):
 
+    global _cold_start
+
     all_logs = []
+    report = None
+    dry_run = bool((event or {}).get("dry_run", DRY_RUN))
+    # e.g. {"scanners": ["volumes", "snapshots"]}; all scanners when absent.
+    scanners = select_scanners(SCANNERS, (event or {}).get("scanners"))
+    pipeline = partial(run_cleanup, dry_run=dry_run, scanners=scanners)
+    start_run()
+    reset_api_stats()
+    reset_metrics()
+    record_startup(_cold_start, INIT_SECONDS * 1000)
+    _cold_start = False
+    # Event-driven runs look at a handful of resources and must not race the full scan's state.
+    incremental = is_incremental_event(event)
+    with span("phase:load_state"):
+        if incremental:
+            disable_state()
+        else:
+            load_state()
+            begin_run(event, get_deadline(context))
 
 
     try:
-        volume_logs = cleanup_unattached_volumes()
-        all_logs.extend(volume_logs)
+        if incremental:
+            all_logs.extend(run_incremental(event, context, dry_run=dry_run))
+        elif is_fanout_event(event):
+            report = run_fanout(event, context, pipeline)
+            all_logs.extend(flatten_report(report))
+        else:
+            scanner_logs, _ = pipeline(context)
+            all_logs.extend(scanner_logs)
     except Exception as e:
-        logger.error(f"Error during EBS volume cleanup: {str(e)}")
+        logger.error(f"Error running cleanup scanners: {str(e)}")
 
- 
-    try:
-        snapshot_logs = cleanup_old_snapshots()
-        all_logs.extend(snapshot_logs)
-    except Exception as e:
-        logger.error(f"Error during snapshot cleanup: {str(e)}")
 
+    # Targets that ran out of time continue from their checkpoint in a new invocation.
+    suspended = [] if incremental else suspended_targets()
+    if suspended and report is not None:
+        dispatch_targets(suspended, context, continuation(event))
+    elif suspended:
+        resume_run(event, context)
 
-    try:
-        instance_logs = cleanup_idle_instances()
-        all_logs.extend(instance_logs)
-    except Exception as e:
-        logger.error(f"Error during idle instance check: {str(e)}")
 
+    log_age_histograms()
 
-    try:
-        eip_logs = cleanup_unattached_elastic_ips()
-        all_logs.extend(eip_logs)
-    except Exception as e:
-        logger.error(f"Error during Elastic IP release: {str(e)}")
 
+    # An event that changed nothing leaves no report and sends no notification;
+    # a suspended run reports once, from the invocation that finishes it.
+    if (all_logs or not incremental) and not (suspended and report is None):
+        uploaded = None
+        try:
+            with span("phase:upload"):
+                uploaded = upload_log_to_s3(report if report is not None else all_logs, get_run_metrics())
+        except Exception as e:
+            logger.error(f"Error uploading logs to S3: {str(e)}")
 
-    try:
-        lb_logs = cleanup_unused_load_balancers()
-        all_logs.extend(lb_logs)
-    except Exception as e:
-        logger.error(f"Error during load balancer cleanup: {str(e)}")
 
+        try:
+            with span("phase:notify"):
+                notify_cleanup_changes(all_logs, uploaded)
+        except Exception as e:
+            logger.error(f"Error sending SNS notifications: {str(e)}")
 
-    try:
-        ami_logs = cleanup_old_amis()
-        all_logs.extend(ami_logs)
-    except Exception as e:
-        logger.error(f"Error during AMI cleanup: {str(e)}")
 
+    with span("phase:save_state"):
+        save_state()
 
-    try:
-        upload_log_to_s3(all_logs)
-    except Exception as e:
-        logger.error(f"Error uploading logs to S3: {str(e)}")
 
+    run_metrics = get_run_metrics()
+    log_run_metrics(run_metrics)
+    publish_emf(run_metrics)
 
-    try:
-        notify_cleanup_changes(all_logs)
-    except Exception as e:
-        logger.error(f"Error sending SNS notifications: {str(e)}")
+
+# Seconds spent importing this module and everything it imports; Lambda does this once per process.
+INIT_SECONDS = time.perf_counter() - _INIT_STARTED
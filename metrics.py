@@ -0,0 +1,115 @@
+import logging
+from botocore.exceptions import ClientError, BotoCoreError
+from inventory import paginate
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# GetMetricData accepts at most 500 queries per request.
+MAX_QUERIES_PER_REQUEST = 500
+
+CPU_METRIC = "CPUUtilization"
+IO_METRICS = ["NetworkIn", "NetworkOut", "DiskReadBytes"]
+
+# Published by the CloudWatch agent, with whatever dimensions its config appends.
+AGENT_NAMESPACE = "CWAgent"
+MEMORY_METRIC = "mem_used_percent"
+
+METRIC_STATISTICS = {
+    "CPUUtilization": "Average",
+    "NetworkIn": "Sum",
+    "NetworkOut": "Sum",
+    "DiskReadBytes": "Sum",
+    "mem_used_percent": "Average",
+}
+
+
+def _build_queries(instance_ids, metric_names, period, namespace, dimensions=None):
+
+    queries = []
+    query_index = {}
+
+    for instance_id in instance_ids:
+        for metric_name in metric_names:
+            query_id = f"m{len(queries)}"
+            query_index[query_id] = (instance_id, metric_name)
+            queries.append({
+                "Id": query_id,
+                "MetricStat": {
+                    "Metric": {
+                        "Namespace": namespace,
+                        "MetricName": metric_name,
+                        "Dimensions": (dimensions or {}).get(instance_id) or [{"Name": "InstanceId", "Value": instance_id}]
+                    },
+                    "Period": period,
+                    "Stat": METRIC_STATISTICS.get(metric_name, "Average")
+                },
+                "ReturnData": True
+            })
+
+    return queries, query_index
+
+
+def get_instance_metrics(cloudwatch, instance_ids, metric_names, start_time, end_time,
+                         period=86400, namespace="AWS/EC2", dimensions=None):
+    """
+    Fetch datapoints for many instances with batched GetMetricData calls.
+
+    `dimensions` maps an instance ID to the full dimension list of its
+    metrics, for namespaces that add more than InstanceId.
+
+    Returns a map of instance_id -> metric_name -> list of values. Instances or
+    metrics without data map to an empty list; instances whose batch failed are
+    left out so callers do not mistake missing data for an idle instance.
+    """
+
+    metrics = {instance_id: {name: [] for name in metric_names} for instance_id in instance_ids}
+
+    queries, query_index = _build_queries(instance_ids, metric_names, period, namespace, dimensions)
+    paginator = cloudwatch.get_paginator("get_metric_data")
+    failed_instances = set()
+
+    for offset in range(0, len(queries), MAX_QUERIES_PER_REQUEST):
+        batch = queries[offset:offset + MAX_QUERIES_PER_REQUEST]
+
+        try:
+            pages = paginator.paginate(
+                MetricDataQueries=batch,
+                StartTime=start_time,
+                EndTime=end_time,
+                ScanBy="TimestampAscending"
+            )
+            for page in pages:
+                for result in page.get("MetricDataResults", []):
+                    instance_id, metric_name = query_index[result["Id"]]
+                    metrics[instance_id][metric_name].extend(result.get("Values", []))
+
+        except (ClientError, BotoCoreError) as e:
+            logger.error(f"Error fetching metric batch {offset // MAX_QUERIES_PER_REQUEST}: {str(e)}")
+            failed_instances.update(query_index[query["Id"]][0] for query in batch)
+
+    return {instance_id: values for instance_id, values in metrics.items()
+            if instance_id not in failed_instances}
+
+
+def find_agent_metric_dimensions(cloudwatch, metric_name=MEMORY_METRIC, namespace=AGENT_NAMESPACE):
+    """
+    Map instance ID -> dimensions of `metric_name` for every instance running
+    the CloudWatch agent, from one paginated ListMetrics sweep. Instances
+    without the agent are simply absent.
+    """
+
+    dimensions = {}
+    try:
+        for metric in paginate(cloudwatch, "list_metrics", "Metrics", Namespace=namespace, MetricName=metric_name):
+            instance_id = next((d["Value"] for d in metric.get("Dimensions", []) if d["Name"] == "InstanceId"), None)
+            # Prefer the plainest dimension set when the agent publishes several.
+            if not instance_id:
+                continue
+            current = dimensions.get(instance_id)
+            if current is None or len(metric["Dimensions"]) < len(current):
+                dimensions[instance_id] = metric["Dimensions"]
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f"Error listing {namespace} {metric_name} metrics: {str(e)}")
+
+    return dimensions
@@ -1,62 +1,270 @@
-import boto3
 import os
+import time
+import hashlib
 import logging
-from collections import Counter
+from datetime import datetime
 from botocore.exceptions import ClientError, BotoCoreError
+from aws_clients import get_client
+from config import NOTIFY_COOLDOWN_HOURS, NOTIFY_MAX_ITEMS_PER_GROUP
+from report_writer import partition_of
+from state_store import load_notified, save_notified
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 SNS_TOPIC_ARN = os.environ.get("SNS_TOPIC_ARN")
 
-def notify_cleanup_changes(log_entries):
+# SNS limits: 256 KiB per message and per publish_batch request, 10 messages per request.
+SNS_MAX_BYTES = 256 * 1024
+SNS_MAX_BATCH = 10
+# Room for the subject and the request's own fields.
+MESSAGE_BYTES = SNS_MAX_BYTES - 4096
 
-    if not SNS_TOPIC_ARN:
-        logger.warning("SNS_TOPIC_ARN not configured. Skipping notification.")
-        return
+CLEANUP_SUBJECT = "EC2 Cost Optimization Cleanup Summary"
+ALERT_SUBJECT = "EC2 Idle Resource Notification"
 
+# Fields that identify an alert; a change in any of them alerts again before the cooldown ends.
+FINGERPRINT_FIELDS = ("action", "resource_type", "account_id", "region", "resource_id", "recommended_type")
 
-    deleted_or_released = [log for log in log_entries if log.get("action") in {"deleted", "released"}]
-    notify_only = [log for log in log_entries if log.get("action") == "notify"]
 
-    from datetime import datetime
-    timestamp = datetime.utcnow().isoformat()
+def _fingerprint(entry):
 
+    identity = "|".join(str(entry.get(field) or "") for field in FINGERPRINT_FIELDS)
+    return hashlib.blake2b(identity.encode("utf-8"), digest_size=12).hexdigest()
 
-    if deleted_or_released:
-        type_counts = Counter(log["resource_type"] for log in deleted_or_released)
-        summary_lines = [f"{count} {rtype}(s)" for rtype, count in type_counts.items()]
-        message = "AWS EC2 Cleanup Summary:\n\n" + "\n".join(summary_lines)
-        message += f"\n\nTimestamp: {timestamp} UTC"
 
-        try:
-            sns = boto3.client("sns")
-            sns.publish(
-                TopicArn=SNS_TOPIC_ARN,
-                Subject="EC2 Cost Optimization Cleanup Summary",
-                Message=message
-            )
-            logger.info("Cleanup summary notification sent via SNS.")
-        except (ClientError, BotoCoreError) as e:
-            logger.error(f"Failed to send cleanup SNS notification: {str(e)}")
+def _size(text):
+
+    return len(text.encode("utf-8"))
+
+
+def _target_label(account_id, region):
+
+    if not account_id and not region:
+        return "This account"
+    return f"{account_id or 'This account'} / {region or 'default region'}"
+
+
+def _report_link(report, entry):
+
+    if not report:
+        return None
+    key = report["partitions"].get(partition_of(entry, report["region"]))
+    return f"s3://{report['bucket']}/{key}" if key else None
 
 
-    if notify_only:
+def _savings(logs):
+
+    return sum(log.get("monthly_savings") or 0 for log in logs)
+
+
+def _group(logs):
+    """(account, region, resource type) -> entries, costliest groups first."""
+
+    groups = {}
+    for log in logs:
+        groups.setdefault((log.get("account_id"), log.get("region"), log["resource_type"]), []).append(log)
+    return sorted(groups.items(), key=lambda item: (-_savings(item[1]), item[0][2]))
+
+
+def deduplicate(logs, notified, now=None):
+    """
+    Split alerts into those to send and those already sent within
+    NOTIFY_COOLDOWN_HOURS, according to `notified` (fingerprint -> sent at).
+    Returns (to send, number suppressed).
+    """
+
+    if NOTIFY_COOLDOWN_HOURS <= 0:
+        return logs, 0
+
+    now = now or time.time()
+    cooldown = NOTIFY_COOLDOWN_HOURS * 3600
+    fresh = []
+    for log in logs:
+        notified_at = notified.get(_fingerprint(log))
+        if notified_at is None or now - notified_at >= cooldown:
+            fresh.append(log)
+    return fresh, len(logs) - len(fresh)
+
+
+def _summary_sections(logs, report):
+    """One section per outcome, with a line per (account, region, resource type)."""
+
+    deleted_or_released = [log for log in logs if log.get("action") in {"deleted", "released"}]
+    sections = []
+    for title, status, savings_label in [
+        ("Cleaned up", "succeeded", "Estimated monthly savings"),
+        ("Planned (dry run)", "planned", "Potential monthly savings"),
+        ("Failed", "failed", "Monthly cost still incurred")
+    ]:
+        selected = [log for log in deleted_or_released if log.get("status", "succeeded") == status]
+        if not selected:
+            continue
+
         lines = []
-        for log in notify_only:
+        for (account_id, region, rtype), group in _group(selected):
+            line = f"{_target_label(account_id, region)}: {len(group)} {rtype}(s)"
+            if _savings(group):
+                line += f", about ${_savings(group):,.2f}/month"
+            lines.append(line)
+        if _savings(selected):
+            lines.append(f"{savings_label}: ${_savings(selected):,.2f}")
+        sections.append((f"{title}:\n" + "\n".join(lines), []))
+
+    if sections and report:
+        sections.append((f"Full report: s3://{report['bucket']}/{report['manifest']}", []))
+    return sections
+
+
+def _alert_sections(logs, report):
+    """
+    One section per (account, region, resource type): the costliest
+    NOTIFY_MAX_ITEMS_PER_GROUP resources, and a link to the report for the
+    rest. Each section carries the fingerprints of the alerts it lists.
+    """
+
+    sections = []
+    for (account_id, region, rtype), group in _group(logs):
+        group = sorted(group, key=lambda log: -(log.get("monthly_savings") or 0))
+        shown = group[:NOTIFY_MAX_ITEMS_PER_GROUP]
+
+        heading = f"{_target_label(account_id, region)}: {len(group)} {rtype}(s)"
+        if _savings(group):
+            heading += f", about ${_savings(group):,.2f}/month"
+        lines = [heading]
+        for log in shown:
             rid = log.get("resource_id", "unknown")
             reason = log.get("reason", "No reason provided")
-            lines.append(f"{log['resource_type']} {rid} - {reason}")
-        message = "AWS EC2 Cost Alert:\n\n" + "\n".join(lines)
-        message += f"\n\nTimestamp: {timestamp} UTC"
+            cost = f" (about ${log['monthly_savings']:,.2f}/month)" if log.get("monthly_savings") else ""
+            lines.append(f"  {rid} - {reason}{cost}")
+
+        link = _report_link(report, group[0])
+        if len(group) > len(shown):
+            lines.append(f"  ... and {len(group) - len(shown)} more" + (f", listed in {link}" if link else ""))
+        elif link:
+            lines.append(f"  Details: {link}")
+
+        # Resources left out of the message are covered by the link, so they count as alerted too.
+        sections.append(("\n".join(lines), [_fingerprint(log) for log in group]))
+    return sections
+
+
+def _split(text, limit):
+    """A section too large for one message -> pieces of whole lines that fit."""
+
+    pieces, lines, used = [], [], 0
+    for line in text.split("\n"):
+        if _size(line) > limit:
+            line = line.encode("utf-8")[:limit - 16].decode("utf-8", "ignore") + " [truncated]"
+        if lines and used + _size(line) + 1 > limit:
+            pieces.append("\n".join(lines))
+            lines, used = [], 0
+        lines.append(line)
+        used += _size(line) + 1
+    pieces.append("\n".join(lines))
+    return pieces
+
+
+def _pack(header, sections, footer):
+    """Sections -> messages of at most MESSAGE_BYTES each, as (text, fingerprints)."""
+
+    fixed = _size(header) + _size(footer) + 4
+    messages = []
+    body, fingerprints, used = [], [], fixed
+    for text, section_fingerprints in sections:
+        for position, piece in enumerate(_split(text, MESSAGE_BYTES - fixed)):
+            if body and used + _size(piece) + 2 > MESSAGE_BYTES:
+                messages.append((header + "\n\n".join(body) + footer, fingerprints))
+                body, fingerprints, used = [], [], fixed
+            body.append(piece)
+            if position == 0:
+                fingerprints.extend(section_fingerprints)
+            used += _size(piece) + 2
+    if body:
+        messages.append((header + "\n\n".join(body) + footer, fingerprints))
+    return messages
+
+
+def _publish(sns, subject, messages):
+    """
+    Send messages with publish_batch, as few requests as the SNS limits
+    allow. Returns the indexes of the messages SNS accepted.
+    """
+
+    total = len(messages)
+    entries = []
+    for position, (text, _) in enumerate(messages):
+        part = f" ({position + 1}/{total})" if total > 1 else ""
+        entries.append({"Id": str(position), "Subject": f"{subject}{part}", "Message": text})
 
+    batches = []
+    for entry in entries:
+        size = _size(entry["Message"]) + _size(entry["Subject"])
+        if (not batches or len(batches[-1][0]) >= SNS_MAX_BATCH
+                or batches[-1][1] + size > SNS_MAX_BYTES - 1024):
+            batches.append(([], 0))
+        batch, used = batches[-1]
+        batch.append(entry)
+        batches[-1] = (batch, used + size)
+
+    accepted = set()
+    for batch, _ in batches:
         try:
-            sns = boto3.client("sns")
-            sns.publish(
-                TopicArn=SNS_TOPIC_ARN,
-                Subject="EC2 Idle Resource Notification",
-                Message=message
-            )
-            logger.info("Notify-only alert sent via SNS.")
+            response = sns.publish_batch(TopicArn=SNS_TOPIC_ARN, PublishBatchRequestEntries=batch)
+            accepted.update(int(result["Id"]) for result in response.get("Successful", []))
+            for failure in response.get("Failed", []):
+                logger.error(f"SNS rejected part {int(failure['Id']) + 1} of {subject}: "
+                             f"{failure.get('Code')} {failure.get('Message', '')}")
         except (ClientError, BotoCoreError) as e:
-            logger.error(f"Failed to send notify-only SNS alert: {str(e)}")
+            logger.error(f"Failed to send {subject} via SNS: {str(e)}")
+    return accepted
+
+
+def notify_cleanup_changes(log_entries, report=None):
+    """
+    Send the cleanup summary and the notify-only alerts, grouped by account,
+    region and resource type. Alerts sent within NOTIFY_COOLDOWN_HOURS are
+    not repeated; `report`, as returned by upload_log_to_s3, is linked for
+    the full detail.
+    """
+
+    if not SNS_TOPIC_ARN:
+        logger.warning("SNS_TOPIC_ARN not configured. Skipping notification.")
+        return
+
+    timestamp = datetime.utcnow().isoformat()
+    footer = f"\n\nTimestamp: {timestamp} UTC"
+    sns = None
+
+    summary = _summary_sections(log_entries, report)
+    if summary:
+        sns = sns or get_client("sns")
+        messages = _pack("AWS EC2 Cleanup Summary:\n\n", summary, footer)
+        sent = _publish(sns, CLEANUP_SUBJECT, messages)
+        logger.info(f"Cleanup summary sent via SNS in {len(sent)} of {len(messages)} messages.")
+
+    notify_only = [log for log in log_entries if log.get("action") == "notify"]
+    notified = load_notified() if notify_only and NOTIFY_COOLDOWN_HOURS > 0 else {}
+    alerts, suppressed = deduplicate(notify_only, notified)
+    if suppressed:
+        logger.info(f"Not repeating {suppressed} alerts sent within the last {NOTIFY_COOLDOWN_HOURS:g} hours")
+
+    if alerts:
+        sns = sns or get_client("sns")
+        alert_footer = footer
+        if _savings(alerts):
+            alert_footer = f"\n\nPotential monthly savings: ${_savings(alerts):,.2f}" + alert_footer
+        if suppressed:
+            alert_footer = (f"\n\n{suppressed} resources alerted within the last {NOTIFY_COOLDOWN_HOURS:g} hours "
+                            f"are not repeated." + alert_footer)
+        messages = _pack("AWS EC2 Cost Alert:\n\n", _alert_sections(alerts, report), alert_footer)
+        sent = _publish(sns, ALERT_SUBJECT, messages)
+
+        now = time.time()
+        for position in sent:
+            for fingerprint in messages[position][1]:
+                notified[fingerprint] = now
+        if sent and NOTIFY_COOLDOWN_HOURS > 0:
+            save_notified(notified, NOTIFY_COOLDOWN_HOURS * 3600)
+        logger.info(f"Notify-only alert for {len(alerts)} resources sent via SNS in {len(sent)} of "
+                    f"{len(messages)} messages.")
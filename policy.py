@@ -0,0 +1,385 @@
+import re
+import json
+import fnmatch
+import logging
+import threading
+from collections import namedtuple
+from config import POLICY_FILE
+from retention import RETENTION
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Resource kinds a rule can name. Kinds without a retention period can only be excluded.
+KINDS = {"volume", "snapshot", "ami", "load_balancer", "target_group", "elastic_ip", "instance"}
+
+# Account key of the Lambda's own account, as in fan-out report entries.
+OWN_ACCOUNT = "self"
+
+# Distinct tag sets remembered per (target, kind) before the cache starts over.
+EVALUATION_CACHE_SIZE = 10000
+
+RULE_KEYS = {"name", "resources", "match", "action", "retention_days"}
+MATCH_KEYS = {"tags", "accounts", "regions"}
+ACCOUNT_KEYS = {"exclude_tags", "retention_days", "rules"}
+DOCUMENT_KEYS = {"version", "exclude_tags", "retention_days", "rules", "accounts"}
+
+
+class PolicyError(Exception):
+    pass
+
+
+class Verdict(namedtuple("Verdict", ["excluded", "rule", "retention_days"])):
+    """
+    Outcome of the policy for one resource: whether it must be left alone,
+    the rule that decided (None for the defaults) and the retention period
+    in days (None for kinds without one).
+    """
+
+    def details(self):
+
+        return {"policy_rule": self.rule} if self.rule else {}
+
+
+def _as_days(period):
+
+    days = period.total_seconds() / 86400
+    return int(days) if days.is_integer() else days
+
+
+def _as_list(value, field):
+
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return value
+    raise PolicyError(f"{field} must be a string or a list of strings")
+
+
+def _check_keys(section, allowed, where):
+
+    if not isinstance(section, dict):
+        raise PolicyError(f"{where} must be a mapping")
+    unknown = set(section) - allowed
+    if unknown:
+        raise PolicyError(f"Unknown key {sorted(unknown)[0]} in {where}")
+
+
+def _check_retention(value, where):
+
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise PolicyError(f"{where} must be a non-negative number of days")
+    return value
+
+
+def _tag_conditions(tags, where):
+    """
+    {tag key: "*" | value | [values]} -> [(key, matcher)], where matcher is
+    None for any value, a set of exact values, or a regular expression
+    string when a value contains a wildcard.
+    """
+
+    if not isinstance(tags, dict):
+        raise PolicyError(f"{where} must be a mapping")
+    conditions = []
+    for key, values in tags.items():
+        values = _as_list(values, f"{where}.{key}")
+        if "*" in values:
+            conditions.append((key, None))
+        elif any(any(char in value for char in "*?[") for value in values):
+            conditions.append((key, "|".join(fnmatch.translate(value) for value in sorted(values))))
+        else:
+            conditions.append((key, set(values)))
+    return conditions
+
+
+class _Rule:
+
+    def __init__(self, name, kinds, conditions, excluded, retention_days, accounts=None, regions=None):
+        self.name = name
+        self.kinds = kinds
+        self.conditions = conditions
+        self.excluded = excluded
+        self.retention_days = retention_days
+        self.accounts = accounts
+        self.regions = regions
+
+    def applies_to(self, account, region):
+
+        return ((self.accounts is None or account in self.accounts)
+                and (self.regions is None or region in self.regions))
+
+
+def _compile_rule(rule, where):
+
+    _check_keys(rule, RULE_KEYS, where)
+    name = rule.get("name") or where
+    action = rule.get("action", "retain")
+    if action not in ("retain", "exclude"):
+        raise PolicyError(f"{where}: action must be retain or exclude")
+    if action == "retain" and "retention_days" not in rule:
+        raise PolicyError(f"{where}: a retain rule needs retention_days")
+
+    kinds = set(_as_list(rule.get("resources", "*"), f"{where}.resources"))
+    if "*" in kinds:
+        kinds = set(KINDS)
+    elif kinds - KINDS:
+        raise PolicyError(f"{where}: unknown resource {sorted(kinds - KINDS)[0]}")
+
+    match = rule.get("match", {})
+    _check_keys(match, MATCH_KEYS, f"{where}.match")
+    accounts = match.get("accounts")
+    regions = match.get("regions")
+
+    return _Rule(
+        name,
+        kinds,
+        _tag_conditions(match.get("tags", {}), f"{where}.match.tags"),
+        action == "exclude",
+        None if action == "exclude" else _check_retention(rule["retention_days"], f"{where}.retention_days"),
+        set(_as_list(accounts, f"{where}.match.accounts")) if accounts is not None else None,
+        set(_as_list(regions, f"{where}.match.regions")) if regions is not None else None
+    )
+
+
+def _exclusion_rules(exclude_tags, where):
+    """Each exclude_tags entry is a rule of its own: any one of them excludes a resource."""
+
+    return [
+        _Rule(f"{where}:{key}", set(KINDS), [condition], True, None)
+        for key, values in exclude_tags.items()
+        for condition in _tag_conditions({key: values}, where)
+    ]
+
+
+def _retention_defaults(section, where):
+
+    _check_keys(section, RETENTION.keys(), where)
+    return {kind: _check_retention(days, f"{where}.{kind}") for kind, days in section.items()}
+
+
+class _TagIndex:
+    """
+    The rules of one resource kind, indexed by tag so that a resource only
+    looks at the rules that mention one of its tags.
+
+    Each rule is filed under one anchor condition, the most selective it
+    has (an exact value, then any value, then a wildcard pattern); its
+    other conditions are checked only when the anchor holds. Rules are kept
+    in precedence order and the first whose conditions all hold decides.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_value = {}
+        self.by_key = {}
+        self.patterns = {}
+        self.compiled = {}
+        self.unconditional = next((position for position, rule in enumerate(rules) if not rule.conditions), None)
+
+        for position, rule in enumerate(rules):
+            for _, matcher in rule.conditions:
+                if isinstance(matcher, str) and matcher not in self.compiled:
+                    self.compiled[matcher] = re.compile(matcher)
+            if not rule.conditions:
+                continue
+
+            key, matcher = min(rule.conditions, key=lambda condition: self._selectivity(condition[1]))
+            if isinstance(matcher, set):
+                for value in matcher:
+                    self.by_value.setdefault((key, value), []).append(position)
+            elif matcher is None:
+                self.by_key.setdefault(key, []).append(position)
+            else:
+                self.patterns.setdefault(key, {}).setdefault(matcher, []).append(position)
+
+        self.keys = frozenset(key for rule in rules for key, _ in rule.conditions)
+
+    @staticmethod
+    def _selectivity(matcher):
+
+        if isinstance(matcher, set):
+            return 0
+        return 1 if matcher is None else 2
+
+    def _holds(self, rule, tags):
+
+        for key, matcher in rule.conditions:
+            value = tags.get(key)
+            if value is None:
+                return False
+            if isinstance(matcher, set):
+                if value not in matcher:
+                    return False
+            elif matcher is not None and not self.compiled[matcher].fullmatch(value):
+                return False
+        return True
+
+    def first_match(self, tags):
+        """The deciding rule for a resource with `tags` ({key: value}), or None."""
+
+        best = self.unconditional
+        for key, value in tags.items():
+            candidates = self.by_value.get((key, value), []) + self.by_key.get(key, [])
+            for pattern, positions in self.patterns.get(key, {}).items():
+                if self.compiled[pattern].fullmatch(value):
+                    candidates = candidates + positions
+            for position in candidates:
+                if (best is None or position < best) and self._holds(self.rules[position], tags):
+                    best = position
+
+        return None if best is None else self.rules[best]
+
+
+class TargetPolicy:
+    """The policy as it applies to one (account, region), compiled into one tag index per resource kind."""
+
+    def __init__(self, indexes, retention_days):
+        self.indexes = indexes
+        self.retention_days = retention_days
+        self.defaults = {kind: Verdict(False, None, retention_days.get(kind)) for kind in KINDS}
+        self._cache = {kind: {} for kind in KINDS}
+
+    def uses_tags(self, kind):
+        """Whether any rule for `kind` looks at tags, i.e. whether tags are worth fetching."""
+
+        return bool(self.indexes[kind].keys)
+
+    def evaluate(self, kind, tags=None):
+        """Verdict for a resource of `kind` with AWS-style `tags` ([{"Key": ..., "Value": ...}])."""
+
+        # Only tags some rule mentions can change the verdict, so the rest stay out of the cache key.
+        index = self.indexes[kind]
+        signature = frozenset(
+            (tag["Key"], tag.get("Value", "")) for tag in tags or [] if tag["Key"] in index.keys
+        )
+        cache = self._cache[kind]
+        verdict = cache.get(signature)
+        if verdict is not None:
+            return verdict
+
+        rule = index.first_match(dict(signature))
+        if rule is None:
+            verdict = self.defaults[kind]
+        elif rule.excluded:
+            verdict = Verdict(True, rule.name, None)
+        else:
+            verdict = Verdict(False, rule.name, rule.retention_days if kind in RETENTION else None)
+
+        if len(cache) >= EVALUATION_CACHE_SIZE:
+            cache.clear()
+        cache[signature] = verdict
+        return verdict
+
+
+class Policy:
+    """
+    A policy document checked and split into rules once; per-target views
+    are compiled on first use and kept for the life of the process.
+    """
+
+    def __init__(self, document):
+        _check_keys(document, DOCUMENT_KEYS, "policy")
+        if document.get("version", 1) != 1:
+            raise PolicyError(f"Unsupported policy version {document.get('version')}")
+
+        self.exclusions = _exclusion_rules(document.get("exclude_tags", {}), "exclude_tags")
+        self.rules = [
+            _compile_rule(rule, f"rules[{position}]")
+            for position, rule in enumerate(document.get("rules", []))
+        ]
+        self.retention_days = _retention_defaults(document.get("retention_days", {}), "retention_days")
+
+        self.accounts = {}
+        for account, section in document.get("accounts", {}).items():
+            where = f"accounts.{account}"
+            _check_keys(section, ACCOUNT_KEYS, where)
+            self.accounts[str(account)] = {
+                "exclusions": _exclusion_rules(section.get("exclude_tags", {}), f"{where}.exclude_tags"),
+                "rules": [
+                    _compile_rule(rule, f"{where}.rules[{position}]")
+                    for position, rule in enumerate(section.get("rules", []))
+                ],
+                "retention_days": _retention_defaults(section.get("retention_days", {}), f"{where}.retention_days"),
+            }
+
+        self._targets = {}
+        self._lock = threading.Lock()
+
+    def _compile_target(self, account, region):
+
+        overrides = self.accounts.get(account, {"exclusions": [], "rules": [], "retention_days": {}})
+        rules = [
+            rule for rule in overrides["rules"] + self.rules
+            if rule.applies_to(account, region)
+        ]
+
+        # Exclusions always win over retention rules; account rules come before global ones.
+        ordered = (
+            overrides["exclusions"] + self.exclusions
+            + [rule for rule in rules if rule.excluded]
+            + [rule for rule in rules if not rule.excluded]
+        )
+
+        retention_days = {kind: _as_days(period) for kind, period in RETENTION.items()}
+        retention_days.update(self.retention_days)
+        retention_days.update(overrides["retention_days"])
+
+        indexes = {kind: _TagIndex([rule for rule in ordered if kind in rule.kinds]) for kind in KINDS}
+        return TargetPolicy(indexes, retention_days)
+
+    def for_target(self, account_id=None, region=None):
+
+        key = (account_id or OWN_ACCOUNT, region)
+        with self._lock:
+            if key not in self._targets:
+                self._targets[key] = self._compile_target(*key)
+            return self._targets[key]
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def _read_document(path):
+
+    with open(path) as f:
+        if not path.endswith((".yaml", ".yml")):
+            return json.load(f)
+
+        # Imported here so JSON policies do not pay for PyYAML at cold start.
+        try:
+            import yaml
+        except ImportError:
+            raise PolicyError("PyYAML is not installed, cannot read a YAML policy")
+        try:
+            return yaml.safe_load(f) or {}
+        except yaml.YAMLError as e:
+            raise PolicyError(f"Failed to parse policy {path}: {str(e)}") from e
+
+
+def load_policy(path=POLICY_FILE):
+    """
+    Compile the policy file once per process. Without a file only the
+    retention env vars apply. A policy that fails to load raises, so no
+    scanner runs with exclusions silently missing.
+    """
+
+    global _policy
+
+    with _policy_lock:
+        if _policy is None:
+            try:
+                document = _read_document(path) if path else {}
+                _policy = Policy(document)
+            except (OSError, ValueError) as e:
+                raise PolicyError(f"Failed to load policy {path}: {str(e)}") from e
+            logger.info(f"Compiled policy with {len(_policy.exclusions)} tag exclusions, {len(_policy.rules)} rules "
+                        f"and overrides for {len(_policy.accounts)} accounts")
+        return _policy
+
+
+def get_policy(account_id=None, region=None):
+    """The compiled policy for one (account, region); account None is the Lambda's own account."""
+
+    return load_policy().for_target(account_id, region)
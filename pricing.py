@@ -0,0 +1,255 @@
+import json
+import time
+import logging
+import threading
+from botocore.exceptions import ClientError, BotoCoreError
+from aws_clients import get_client
+from inventory import paginate
+from config import (
+    PRICE_FILE, PRICE_CACHE_PATH, PRICE_CACHE_KEY, PRICE_CACHE_TTL_DAYS, PRICING_API_ENABLED, LOG_S3_BUCKET
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+HOURS_PER_MONTH = 730
+
+# The Pricing API is only served from a few regions; prices cover all regions.
+PRICING_REGION = "us-east-1"
+
+# Regions missing from the price file are estimated with these rates.
+FALLBACK_REGION = "us-east-1"
+
+# resource_type -> (price kind, entry field holding the subtype, entry field holding GB-months).
+# Kinds without a GB field are billed per hour.
+PRICED_TYPES = {
+    "EBS Volume": ("ebs", "volume_type", "size_gb"),
+    "EBS Snapshot": ("snapshot", None, "size_gb"),
+    "Elastic IP": ("eip", None, None),
+    "Load Balancer": ("elb", "lb_type", None),
+    "Classic Load Balancer": ("elb", "lb_type", None),
+    "EC2 Instance": ("ec2", "instance_type", None),
+}
+
+# Kinds the Pricing API is asked about; the rest come from the price file only.
+REFRESHABLE_KINDS = {"ebs", "snapshot", "ec2"}
+
+_lock = threading.Lock()
+_loaded = False
+_api_available = PRICING_API_ENABLED
+# (region, kind, subtype) -> rate, from the price file.
+_bundled = {}
+# (region, kind, subtype) -> (rate, fetched_at), from the Pricing API.
+_fetched = {}
+
+
+def _index_price_file(document):
+
+    index = {}
+    for region, kinds in document.get("regions", {}).items():
+        for kind, rates in kinds.items():
+            if isinstance(rates, dict):
+                for subtype, rate in rates.items():
+                    index[(region, kind, subtype)] = float(rate)
+            else:
+                index[(region, kind, None)] = float(rates)
+    return index
+
+
+def _read_cache():
+
+    if PRICE_CACHE_PATH:
+        with open(PRICE_CACHE_PATH) as f:
+            return json.load(f)
+
+    s3 = get_client("s3")
+    return json.loads(s3.get_object(Bucket=LOG_S3_BUCKET, Key=PRICE_CACHE_KEY)["Body"].read())
+
+
+def _write_cache(rows):
+
+    if PRICE_CACHE_PATH:
+        with open(PRICE_CACHE_PATH, "w") as f:
+            json.dump(rows, f)
+        return
+
+    s3 = get_client("s3")
+    s3.put_object(Bucket=LOG_S3_BUCKET, Key=PRICE_CACHE_KEY, Body=json.dumps(rows))
+
+
+def load_prices():
+    """Index the price file and the cache of Pricing API results, once per process."""
+
+    global _loaded, _bundled, _fetched
+
+    with _lock:
+        if _loaded:
+            return
+        _loaded = True
+
+        try:
+            with open(PRICE_FILE) as f:
+                _bundled = _index_price_file(json.load(f))
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error(f"Failed to load price file {PRICE_FILE}: {str(e)}")
+
+        try:
+            _fetched = {
+                (region, kind, subtype): (float(rate), float(fetched_at))
+                for region, kind, subtype, rate, fetched_at in _read_cache()
+            }
+        except FileNotFoundError:
+            pass
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in {"NoSuchKey", "404"}:
+                logger.warning(f"Failed to load price cache: {str(e)}")
+        except (BotoCoreError, OSError, ValueError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable price cache: {str(e)}")
+
+        logger.info(f"Loaded {len(_bundled)} listed prices and {len(_fetched)} cached prices")
+
+
+def _save_cache(rows):
+
+    try:
+        _write_cache(rows)
+    except (ClientError, BotoCoreError, OSError) as e:
+        logger.warning(f"Failed to write price cache: {str(e)}")
+
+
+def _on_demand_rate(price_item):
+
+    product = json.loads(price_item)
+    attributes = product.get("product", {}).get("attributes", {})
+    for term in product.get("terms", {}).get("OnDemand", {}).values():
+        for dimension in term.get("priceDimensions", {}).values():
+            usd = float(dimension.get("pricePerUnit", {}).get("USD", 0))
+            if usd > 0:
+                return attributes, usd
+    return attributes, None
+
+
+def _fetch_rate(pricing, key):
+
+    region, kind, subtype = key
+    filters = {"regionCode": region}
+    if kind == "ec2":
+        filters.update(instanceType=subtype, operatingSystem="Linux", tenancy="Shared",
+                       preInstalledSw="NA", capacitystatus="Used")
+    elif kind == "ebs":
+        filters.update(productFamily="Storage", volumeApiName=subtype)
+    elif kind == "snapshot":
+        filters.update(productFamily="Storage Snapshot")
+
+    items = paginate(
+        pricing, "get_products", "PriceList",
+        ServiceCode="AmazonEC2",
+        Filters=[{"Type": "TERM_MATCH", "Field": field, "Value": value} for field, value in filters.items()]
+    )
+    for item in items:
+        attributes, rate = _on_demand_rate(item)
+        if rate is None:
+            continue
+        # The snapshot family also lists archive tier and fast snapshot restore.
+        if kind == "snapshot" and not attributes.get("usagetype", "").endswith("EBS:SnapshotUsage"):
+            continue
+        return rate
+    return None
+
+
+def refresh_prices(keys):
+    """
+    Ask the Pricing API for prices not fetched within PRICE_CACHE_TTL_DAYS.
+    Stops at the first error. The calls run outside the lock, so other
+    threads keep reading rates meanwhile.
+    """
+
+    global _api_available
+
+    load_prices()
+    now = time.time()
+    max_age = PRICE_CACHE_TTL_DAYS * 86400
+
+    with _lock:
+        if not _api_available:
+            return
+        stale = [
+            key for key in keys
+            if key[1] in REFRESHABLE_KINDS and (key not in _fetched or now - _fetched[key][1] > max_age)
+        ]
+    if not stale:
+        return
+
+    fetched = {}
+    try:
+        pricing = get_client("pricing", region_name=PRICING_REGION)
+        for key in stale:
+            rate = _fetch_rate(pricing, key)
+            if rate is not None:
+                fetched[key] = (rate, now)
+        logger.info(f"Refreshed {len(stale)} prices from the Pricing API")
+    except (ClientError, BotoCoreError, ValueError) as e:
+        logger.warning(f"Pricing API not available, using listed prices: {str(e)}")
+        with _lock:
+            _api_available = False
+
+    if not fetched:
+        return
+    with _lock:
+        _fetched.update(fetched)
+        rows = [[region, kind, subtype, rate, fetched_at]
+                for (region, kind, subtype), (rate, fetched_at) in _fetched.items()]
+    _save_cache(rows)
+
+
+def get_rate(region, kind, subtype=None):
+    """Rate for one price key: Pricing API result, else the price file, else the fallback region."""
+
+    load_prices()
+    key = (region, kind, subtype)
+    if key in _fetched:
+        return _fetched[key][0]
+    if key in _bundled:
+        return _bundled[key]
+    return _bundled.get((FALLBACK_REGION, kind, subtype))
+
+
+def _price_key(entry, region):
+
+    priced = PRICED_TYPES.get(entry.get("resource_type"))
+    if priced is None:
+        return None
+    kind, subtype_field, _ = priced
+    subtype = entry.get(subtype_field) if subtype_field else None
+    if subtype_field and not subtype:
+        return None
+    return (entry.get("region") or region, kind, subtype)
+
+
+def estimate_monthly_savings(entries, region):
+    """
+    Set "monthly_savings" (USD) on every entry whose resource can be priced:
+    GB-month rate x size for volumes and snapshots, hourly rate x 730 for the rest.
+    Entries that already carry an estimate (e.g. rightsizing) are left alone.
+    """
+
+    keys = {id(entry): None if "monthly_savings" in entry else _price_key(entry, region) for entry in entries}
+    refresh_prices({key for key in keys.values() if key})
+
+    for entry in entries:
+        key = keys[id(entry)]
+        if key is None:
+            continue
+        rate = get_rate(*key)
+        if rate is None:
+            continue
+
+        size_field = PRICED_TYPES[entry["resource_type"]][2]
+        if size_field:
+            if not entry.get(size_field):
+                continue
+            entry["monthly_savings"] = round(rate * entry[size_field], 2)
+        else:
+            entry["monthly_savings"] = round(rate * HOURS_PER_MONTH, 2)
+
+    return entries
@@ -0,0 +1,305 @@
+import re
+import json
+import zlib
+import logging
+from botocore.exceptions import ClientError, BotoCoreError
+from config import REPORT_PREFIX, REPORT_FORMAT, REPORT_COMPRESSION, REPORT_PART_SIZE_MB
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# pyarrow is heavy, so it is only imported when a Parquet report is written.
+pa = None
+pq = None
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# S3 rejects multipart parts below 5 MiB, except the last one.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Fields encoded in the partition path rather than in each record; Athena
+# rejects columns that repeat a partition key.
+PARTITION_FIELDS = {"account_id", "region"}
+
+# Parquet needs a fixed schema; any other field goes into "details" as JSON.
+PARQUET_COLUMNS = ["resource_id", "action", "resource_type", "reason", "operation", "status", "error", "timestamp"]
+PARQUET_ROW_GROUP_SIZE = 10000
+
+
+def _load_pyarrow():
+
+    global pa, pq
+
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+            pa, pq = pyarrow, pyarrow.parquet
+        except ImportError:
+            return False
+    return True
+
+
+def _slug(value):
+
+    return re.sub(r"[^a-z0-9-]+", "_", str(value).lower()).strip("_") or "unknown"
+
+
+def partition_of(entry, default_region):
+    """(account, region, resource type) of the report object an entry is written to."""
+
+    return (
+        _slug(entry.get("account_id", "self")),
+        _slug(entry.get("region") or default_region or "unknown"),
+        _slug(entry.get("resource_type", "unknown"))
+    )
+
+
+class _MultipartStream:
+    """
+    Write-only file object backed by an S3 multipart upload.
+
+    Bytes are buffered until a part is full, so memory stays at about one
+    part. Objects smaller than one part are sent with a single put_object.
+    """
+
+    def __init__(self, s3, bucket, key, part_size, content_type, content_encoding=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        self.extra = {"ContentType": content_type}
+        if content_encoding:
+            self.extra["ContentEncoding"] = content_encoding
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+        self.closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.size
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra)
+            self.upload_id = response["UploadId"]
+
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self.extra)
+            return
+
+        if self.buffer:
+            self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts}
+        )
+
+    def abort(self):
+        self.closed = True
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except (ClientError, BotoCoreError) as e:
+                logger.error(f"Failed to abort multipart upload of {self.key}: {str(e)}")
+
+
+class _JsonLinesPartition:
+
+    def __init__(self, stream, compression):
+        self.stream = stream
+        if compression == "zstd":
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            self.compressor = zlib.compressobj(wbits=31)
+
+    def write(self, record):
+        line = json.dumps(record, default=str, separators=(",", ":")) + "\n"
+        self.stream.write(self.compressor.compress(line.encode("utf-8")))
+
+    def close(self):
+        self.stream.write(self.compressor.flush())
+        self.stream.close()
+
+
+class _ParquetPartition:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.schema = pa.schema([(name, pa.string()) for name in PARQUET_COLUMNS + ["details"]])
+        self.writer = pq.ParquetWriter(pa.PythonFile(stream, mode="w"), self.schema, compression="snappy")
+        self.rows = []
+
+    def write(self, record):
+        row = {name: None if record.get(name) is None else str(record[name]) for name in PARQUET_COLUMNS}
+        details = {key: value for key, value in record.items() if key not in PARQUET_COLUMNS}
+        row["details"] = json.dumps(details, default=str) if details else None
+        self.rows.append(row)
+        if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        if self.rows:
+            self._write_row_group()
+        self.writer.close()
+        self.stream.close()
+
+
+class ReportWriter:
+    """
+    Streams log entries to S3, one object per partition:
+
+        {prefix}/dt={date}/account={account}/region={region}/resource={type}/{run_id}.jsonl.gz
+
+    Entries are compressed as they are written and uploaded in multipart
+    chunks, so a run never holds the serialized report in memory. Entries
+    come grouped by account and region, so a target's partitions are
+    finished as soon as the next target starts and only one target's
+    uploads are open at a time. A partition written to again after that
+    continues in a new object, {run_id}-{n}.
+    """
+
+    def __init__(self, s3, bucket, run_id, date, default_region, prefix=REPORT_PREFIX, fmt=REPORT_FORMAT,
+                 compression=REPORT_COMPRESSION, part_size=REPORT_PART_SIZE_MB * 1024 * 1024):
+        if fmt == "parquet" and not _load_pyarrow():
+            logger.warning("pyarrow is not installed, writing the report as JSON Lines")
+            fmt = "jsonl"
+        if compression == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, compressing the report with gzip")
+            compression = "gzip"
+
+        self.s3 = s3
+        self.bucket = bucket
+        self.run_id = run_id
+        self.date = date
+        self.default_region = default_region or "unknown"
+        self.prefix = prefix.strip("/")
+        self.format = fmt
+        self.compression = compression
+        self.part_size = part_size
+        self.partitions = {}
+        self.counts = {}
+        # partition -> object key, kept after close so notifications can link to them.
+        self.keys = {}
+        # key -> record count of finished objects.
+        self.written = {}
+        self.objects = {}
+        self.target = None
+
+    def _key(self, account, region, resource_type, sequence=1):
+
+        name = self.run_id if sequence == 1 else f"{self.run_id}-{sequence}"
+        if self.format == "parquet":
+            filename = f"{name}.parquet"
+        else:
+            filename = f"{name}.jsonl.{'zst' if self.compression == 'zstd' else 'gz'}"
+        return (f"{self.prefix}/dt={self.date}/account={account}/region={region}/"
+                f"resource={resource_type}/{filename}")
+
+    def _open(self, partition):
+
+        self.objects[partition] = self.objects.get(partition, 0) + 1
+        key = self._key(*partition, sequence=self.objects[partition])
+        if self.format == "parquet":
+            stream = _MultipartStream(self.s3, self.bucket, key, self.part_size, "application/vnd.apache.parquet")
+            return key, _ParquetPartition(stream)
+
+        encoding = "zstd" if self.compression == "zstd" else "gzip"
+        stream = _MultipartStream(self.s3, self.bucket, key, self.part_size, "application/x-ndjson", encoding)
+        return key, _JsonLinesPartition(stream, self.compression)
+
+    def write(self, entry):
+
+        partition = partition_of(entry, self.default_region)
+        if partition[:2] != self.target:
+            self._finish()
+            self.target = partition[:2]
+
+        if partition not in self.partitions:
+            self.partitions[partition] = self._open(partition)
+            self.keys.setdefault(partition, self.partitions[partition][0])
+            self.counts[partition] = 0
+
+        _, writer = self.partitions[partition]
+        writer.write({key: value for key, value in entry.items() if key not in PARTITION_FIELDS})
+        self.counts[partition] += 1
+
+    def _finish(self):
+
+        for partition, (key, writer) in list(self.partitions.items()):
+            writer.close()
+            self.written[key] = self.counts[partition]
+            del self.partitions[partition]
+
+    def close(self):
+        """Finish every upload. Returns {key: record count}; on failure pending uploads are aborted."""
+
+        try:
+            self._finish()
+        finally:
+            self.abort()
+        return self.written
+
+    def abort(self):
+
+        for key, writer in self.partitions.values():
+            writer.stream.abort()
+        self.partitions = {}
+
+
+def iter_report_entries(report):
+    """Entries of a flat log list or of a fan-out report keyed by account and region."""
+
+    if isinstance(report, dict):
+        for regions in report.values():
+            for result in regions.values():
+                yield from result["entries"]
+    else:
+        yield from report
+
+
+def write_report(s3, bucket, report, run_id, date, default_region):
+    """Write every entry of `report`. Returns ({key: record count}, {partition: key})."""
+
+    writer = ReportWriter(s3, bucket, run_id, date, default_region)
+    try:
+        for entry in iter_report_entries(report):
+            writer.write(entry)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close(), writer.keys
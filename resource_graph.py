@@ -0,0 +1,284 @@
+import logging
+from collections import defaultdict
+from botocore.exceptions import ClientError, BotoCoreError
+from inventory import iter_filtered, iter_images, iter_snapshots, iter_addresses, iter_target_groups
+from executor import plan_action
+from retention import evaluate_ages
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Planned load balancers above which one sweep of all target groups is cheaper than a call per load balancer.
+TARGET_GROUP_SWEEP_THRESHOLD = 10
+
+
+class ResourceGraph:
+    """
+    Which resources use which within one (account, region): an AMI uses the
+    snapshots behind its block devices, a load balancer uses its target
+    groups and the Elastic IPs on its network interfaces. A resource all of
+    whose users are deleted is orphaned by those deletions.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.uses = defaultdict(set)
+        self.used_by = defaultdict(set)
+
+    def add(self, resource_id, kind, **attributes):
+
+        node = self.nodes.setdefault(resource_id, {"kind": kind})
+        node.update({key: value for key, value in attributes.items() if value is not None})
+        return node
+
+    def link(self, user, used):
+
+        self.uses[user].add(used)
+        self.used_by[used].add(user)
+
+    def orphaned_by(self, deleted, kind):
+        """Resources of `kind` used by something in `deleted` and by nothing else."""
+
+        used = {resource_id for user in deleted for resource_id in self.uses[user]}
+        return sorted(
+            resource_id for resource_id in used
+            if self.nodes[resource_id]["kind"] == kind and self.used_by[resource_id] <= deleted
+        )
+
+
+def _deletions(plan, operation, service=None):
+
+    return [
+        entry for entry in plan
+        if entry.get("operation") == operation and (service is None or entry.get("service") == service)
+    ]
+
+
+def cascade_services(plan):
+    """Services build_resource_graph and the cascaded actions need for `plan`."""
+
+    services = set()
+    if _deletions(plan, "deregister_image"):
+        services.add("ec2")
+    for entry in _deletions(plan, "delete_load_balancer", "elbv2"):
+        services.add("elbv2")
+        if entry.get("allocation_ids"):
+            services.add("ec2")
+    return services
+
+
+def _add_ami_snapshots(graph, ec2, amis, policy):
+
+    for entry in amis:
+        graph.add(entry["resource_id"], "ami")
+        for snapshot_id in entry.get("snapshot_ids", []):
+            graph.add(snapshot_id, "snapshot")
+            graph.link(entry["resource_id"], snapshot_id)
+
+    # Other AMIs built from the same snapshots keep them alive.
+    snapshot_ids = {snapshot_id for entry in amis for snapshot_id in entry.get("snapshot_ids", [])}
+    for image in iter_filtered(ec2, iter_images, "block-device-mapping.snapshot-id", snapshot_ids):
+        graph.add(image["ImageId"], "ami")
+        for mapping in image.get("BlockDeviceMappings", []):
+            ebs = mapping.get("Ebs") or {}
+            if ebs.get("SnapshotId") in snapshot_ids:
+                graph.add(ebs["SnapshotId"], "snapshot", size_gb=ebs.get("VolumeSize"))
+                graph.link(image["ImageId"], ebs["SnapshotId"])
+
+    # Start times and tags, for the snapshot rules' retention and exclusions.
+    for snapshot in iter_filtered(ec2, iter_snapshots, "snapshot-id", snapshot_ids):
+        graph.add(snapshot["SnapshotId"], "snapshot", tags=snapshot.get("Tags", []),
+                  start_time=snapshot.get("StartTime"))
+
+
+def _add_load_balancer_resources(graph, clients, load_balancers, policy):
+
+    elb = clients["elbv2"]
+    if len(load_balancers) > TARGET_GROUP_SWEEP_THRESHOLD:
+        target_groups = iter_target_groups(elb)
+    else:
+        target_groups = (
+            tg for entry in load_balancers for tg in iter_target_groups(elb, load_balancer_arn=entry["resource_id"])
+        )
+    for tg in target_groups:
+        graph.add(tg["TargetGroupArn"], "target_group")
+        for user in tg.get("LoadBalancerArns", []):
+            graph.add(user, "load_balancer")
+            graph.link(user, tg["TargetGroupArn"])
+
+    for entry in load_balancers:
+        graph.add(entry["resource_id"], "load_balancer")
+        for allocation_id in entry.get("allocation_ids", []):
+            graph.add(allocation_id, "elastic_ip")
+            graph.link(entry["resource_id"], allocation_id)
+
+    tg_arns = sorted(resource_id for resource_id, node in graph.nodes.items() if node["kind"] == "target_group")
+    if tg_arns and policy.uses_tags("target_group"):
+        # Imported here so runs without load balancer deletions do not load the scanner module.
+        from cleanup_load_balancers import fetch_tags
+        for tg_arn, tags in fetch_tags(elb, "ResourceArns", "ResourceArn", tg_arns).items():
+            graph.add(tg_arn, "target_group", tags=tags)
+
+    allocation_ids = {allocation_id for entry in load_balancers for allocation_id in entry.get("allocation_ids", [])}
+    for address in iter_filtered(clients.get("ec2"), iter_addresses, "allocation-id", allocation_ids):
+        graph.add(address["AllocationId"], "elastic_ip", public_ip=address.get("PublicIp"),
+                  tags=address.get("Tags", []))
+
+
+def build_resource_graph(plan, clients, policy):
+    """
+    The graph around the deletions in `plan`, from one filtered pass over
+    each related listing: the AMIs sharing the planned AMIs' snapshots, and
+    the target groups and Elastic IPs of the planned load balancers.
+    """
+
+    graph = ResourceGraph()
+
+    amis = _deletions(plan, "deregister_image")
+    if amis:
+        _add_ami_snapshots(graph, clients["ec2"], amis, policy)
+
+    load_balancers = _deletions(plan, "delete_load_balancer", "elbv2")
+    if load_balancers:
+        _add_load_balancer_resources(graph, clients, load_balancers, policy)
+
+    logger.info(f"Resource graph has {len(graph.nodes)} resources and "
+                f"{sum(len(used) for used in graph.uses.values())} relations")
+    return graph
+
+
+def _plan_snapshot(snapshot_id, node, users, verdict):
+
+    return plan_action(
+        snapshot_id,
+        "EBS Snapshot",
+        "deleted",
+        f"Snapshot associated with deregistered AMI {', '.join(users)}",
+        "ec2",
+        "delete_snapshot",
+        {"SnapshotId": snapshot_id},
+        depends_on=users,
+        details={"size_gb": node.get("size_gb"), **verdict.details()}
+    )
+
+
+def _plan_target_group(tg_arn, node, users, verdict):
+
+    return plan_action(
+        tg_arn,
+        "Target Group",
+        "deleted",
+        f"Only used by deleted load balancer {', '.join(users)}",
+        "elbv2",
+        "delete_target_group",
+        {"TargetGroupArn": tg_arn},
+        depends_on=users,
+        details=verdict.details()
+    )
+
+
+def _plan_address(allocation_id, node, users, verdict):
+
+    return plan_action(
+        allocation_id,
+        "Elastic IP",
+        "released",
+        f"On a network interface of deleted load balancer {', '.join(users)}",
+        "ec2",
+        "release_address",
+        {"AllocationId": allocation_id},
+        depends_on=users,
+        details=verdict.details()
+    )
+
+
+# Policy kind -> planner of the action that reclaims an orphaned resource of that kind.
+CASCADES = {
+    "snapshot": _plan_snapshot,
+    "target_group": _plan_target_group,
+    "elastic_ip": _plan_address,
+}
+
+
+# Kinds whose orphans are also held to their rule's retention period, counted from this node attribute.
+AGED_KINDS = {"snapshot": "start_time"}
+
+
+def _past_retention(kind, orphans):
+    """The (resource_id, node, users, verdict) orphans old enough for their rule's retention_days."""
+
+    if kind not in AGED_KINDS:
+        return orphans
+
+    field = AGED_KINDS[kind]
+    dated = []
+    for orphan in orphans:
+        if orphan[1].get(field) is None:
+            logger.info(f"Skipping {kind} {orphan[0]}: not found")
+        else:
+            dated.append(orphan)
+
+    ages, expired, _ = evaluate_ages(
+        kind,
+        [node[field] for _, node, _, _ in dated],
+        [verdict.retention_days * 86400 for _, _, _, verdict in dated]
+    )
+    kept = []
+    for orphan, age, old_enough in zip(dated, ages, expired):
+        if old_enough:
+            kept.append(orphan)
+        else:
+            logger.info(f"Keeping {kind} {orphan[0]}: {age} days old, retained for "
+                        f"{orphan[3].retention_days} days by {orphan[3].rule or 'default retention'}")
+    return kept
+
+
+def cascade_plan(plan, clients, policy):
+    """
+    Add to `plan` the resources its deletions orphan, so they are reclaimed
+    in the same invocation: snapshots no remaining AMI uses, target groups
+    of deleted load balancers, Elastic IPs of deleted NLBs. Snapshots must
+    also be past their rule's retention_days. Each depends on
+    the deletions that free it, which makes the executor apply everything
+    in topological order; a failed deletion keeps what it would have freed.
+    A resource some scanner planned already only gains the dependencies.
+    """
+
+    deleted = {entry["resource_id"] for entry in plan if entry.get("operation")}
+    if not cascade_services(plan):
+        return plan
+
+    try:
+        graph = build_resource_graph(plan, clients, policy)
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f"Failed to build resource graph, orphaned resources are left for a later run: {str(e)}")
+        return plan
+
+    planned = {entry["resource_id"]: entry for entry in plan if entry.get("operation")}
+    cascaded = []
+    for kind, plan_orphan in CASCADES.items():
+        orphans = []
+        for resource_id in graph.orphaned_by(deleted, kind):
+            users = sorted(graph.used_by[resource_id])
+            if resource_id in planned:
+                planned[resource_id]["depends_on"] = sorted(set(planned[resource_id]["depends_on"]) | set(users))
+                continue
+
+            node = graph.nodes[resource_id]
+            verdict = policy.evaluate(kind, node.get("tags"))
+            if verdict.excluded:
+                logger.info(f"Skipping {kind} {resource_id}: excluded by policy rule {verdict.rule}")
+                continue
+            orphans.append((resource_id, node, users, verdict))
+
+        for resource_id, node, users, verdict in _past_retention(kind, orphans):
+            logger.info(f"Planning cascaded cleanup of {kind} {resource_id}, orphaned by {', '.join(users)}")
+            cascaded.append(plan_orphan(resource_id, node, users, verdict))
+
+        for resource_id in graph.used_by:
+            users = graph.used_by[resource_id]
+            if graph.nodes[resource_id]["kind"] == kind and users & deleted and not users <= deleted:
+                logger.info(f"Keeping {kind} {resource_id}: still used by {', '.join(sorted(users - deleted))}")
+
+    logger.info(f"Cascaded {len(cascaded)} actions from {len(deleted)} planned deletions")
+    return plan + cascaded
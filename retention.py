@@ -0,0 +1,146 @@
+import bisect
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from config import EBS_VOLUME_AGE_DAYS, SNAPSHOT_RETENTION_DAYS, AMI_RETENTION_DAYS, LB_MIN_AGE_MINUTES
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+RETENTION = {
+    "volume": timedelta(days=EBS_VOLUME_AGE_DAYS),
+    "snapshot": timedelta(days=SNAPSHOT_RETENTION_DAYS),
+    "ami": timedelta(days=AMI_RETENTION_DAYS),
+    "load_balancer": timedelta(minutes=LB_MIN_AGE_MINUTES),
+}
+
+# Upper bounds in days of the age histogram buckets; the last bucket is open.
+AGE_BUCKETS = [1, 7, 30, 90, 180, 365]
+AGE_BUCKET_LABELS = ["<1d", "1-7d", "7-30d", "30-90d", "90-180d", "180-365d", ">=365d"]
+
+# Resources per vectorized age evaluation.
+AGE_BATCH_SIZE = 1000
+
+_lock = threading.Lock()
+_numpy = None
+_run_time = None
+_run_timestamp = None
+_histograms = {}
+
+
+def start_run(now=None):
+    """Capture the single clock reading every age check and log entry of this run uses."""
+
+    global _run_time, _run_timestamp, _histograms
+
+    with _lock:
+        _run_time = now or datetime.now(timezone.utc)
+        _run_timestamp = _run_time.replace(tzinfo=None).isoformat()
+        _histograms = {}
+
+
+def run_time():
+
+    if _run_time is None:
+        start_run()
+    return _run_time
+
+
+def run_timestamp():
+    """The run's clock as a naive UTC ISO string, the format log entries use."""
+
+    if _run_timestamp is None:
+        start_run()
+    return _run_timestamp
+
+
+def _load_numpy():
+    """numpy, imported on first use since it adds tens of milliseconds to a cold start; None if missing."""
+
+    global _numpy
+
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def _epoch_seconds(times):
+
+    np = _load_numpy()
+    if np is not None:
+        if times and isinstance(times[0], str):
+            # ISO-8601 strings parse in one vectorized call, e.g. AMI CreationDate.
+            parsed = np.array([t.rstrip("Z") for t in times], dtype="datetime64[ms]")
+            return parsed.astype("datetime64[s]").astype(np.int64).astype(np.float64)
+        return np.fromiter((t.timestamp() for t in times), dtype=np.float64, count=len(times))
+
+    if times and isinstance(times[0], str):
+        return [
+            datetime.strptime(t, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc).timestamp()
+            for t in times
+        ]
+    return [t.timestamp() for t in times]
+
+
+def evaluate_ages(kind, times, periods=None):
+    """
+    Age check for a whole batch of creation times (aware datetimes or ISO strings).
+
+    `periods` optionally gives each resource its own retention period in
+    seconds (e.g. from a policy rule) instead of the one for `kind`.
+    Returns three lists in input order: age in whole days, whether the
+    resource has reached its retention age, and the epoch time at which it
+    does. Ages are added to the run's histogram.
+    """
+
+    if not times:
+        return [], [], []
+
+    np = _load_numpy()
+    now = run_time().timestamp()
+    created = _epoch_seconds(times)
+    if periods is None:
+        periods = [RETENTION[kind].total_seconds()] * len(times)
+
+    if np is not None:
+        periods = np.asarray(periods, dtype=np.float64)
+        ages = ((now - created) // 86400).astype(np.int64)
+        expired = created <= now - periods
+        recheck_at = created + periods
+        counts = np.bincount(np.searchsorted(AGE_BUCKETS, ages, side="right"), minlength=len(AGE_BUCKET_LABELS))
+        ages, expired, recheck_at, counts = ages.tolist(), expired.tolist(), recheck_at.tolist(), counts.tolist()
+    else:
+        ages = [int((now - ts) // 86400) for ts in created]
+        expired = [ts <= now - period for ts, period in zip(created, periods)]
+        recheck_at = [ts + period for ts, period in zip(created, periods)]
+        counts = [0] * len(AGE_BUCKET_LABELS)
+        for age in ages:
+            counts[bisect.bisect_right(AGE_BUCKETS, age)] += 1
+
+    with _lock:
+        histogram = _histograms.setdefault(kind, [0] * len(AGE_BUCKET_LABELS))
+        for index, count in enumerate(counts):
+            histogram[index] += count
+
+    return ages, expired, recheck_at
+
+
+def get_age_histograms():
+    """Resource counts per age bucket for every kind evaluated this run."""
+
+    with _lock:
+        return {
+            kind: dict(zip(AGE_BUCKET_LABELS, counts))
+            for kind, counts in _histograms.items()
+        }
+
+
+def log_age_histograms():
+
+    for kind, buckets in sorted(get_age_histograms().items()):
+        summary = ", ".join(f"{label}: {count}" for label, count in buckets.items())
+        logger.info(f"Age histogram for {kind}: {summary}")
@@ -0,0 +1,278 @@
+import json
+import logging
+from itertools import chain
+from datetime import timedelta
+from botocore.exceptions import ClientError, BotoCoreError
+from aws_clients import get_client
+from config import (
+    RIGHTSIZING_ENABLED, RIGHTSIZING_LOOKBACK_DAYS, RIGHTSIZING_TARGET_CPU_PERCENT,
+    RIGHTSIZING_TARGET_MEMORY_PERCENT, RIGHTSIZING_MIN_SAVINGS_PERCENT, RIGHTSIZING_BATCH_SIZE,
+    INSTANCE_CATALOG_FILE, IDLE_CPU_THRESHOLD
+)
+from metrics import get_instance_metrics, find_agent_metric_dimensions, CPU_METRIC, MEMORY_METRIC, AGENT_NAMESPACE
+from inventory import iter_instances, iter_batches
+from pricing import get_rate, refresh_prices, HOURS_PER_MONTH
+from retention import run_time, run_timestamp
+from policy import get_policy
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+NETWORK_METRICS = ["NetworkIn", "NetworkOut"]
+METRIC_NAMES = [CPU_METRIC] + NETWORK_METRICS
+
+# Hours of CPU data an instance needs before it is sized; newer instances are skipped.
+MIN_HOURS = 7 * 24
+
+_catalog = None
+
+
+class InstanceCatalog:
+    """The local instance-type catalog as column arrays, for sizing a whole batch at once."""
+
+    def __init__(self, types):
+        self.names = sorted(types)
+        self.index = {name: position for position, name in enumerate(self.names)}
+        self.vcpu = np.array([types[name]["vcpu"] for name in self.names], dtype=np.float64)
+        self.memory_gib = np.array([types[name]["memory_gib"] for name in self.names], dtype=np.float64)
+        self.network_gbps = np.array([types[name]["network_gbps"] for name in self.names], dtype=np.float64)
+        self.arch = np.array([types[name]["arch"] for name in self.names])
+        self.burst_baseline = np.array([types[name].get("burst_baseline", 0.0) for name in self.names])
+
+    def prices(self, region):
+
+        return np.array([get_rate(region, "ec2", name) or np.nan for name in self.names], dtype=np.float64)
+
+
+def load_catalog():
+
+    global _catalog
+
+    if _catalog is None:
+        with open(INSTANCE_CATALOG_FILE) as f:
+            _catalog = InstanceCatalog(json.load(f)["types"])
+    return _catalog
+
+
+def _to_matrix(series):
+    """Ragged value lists -> (rows, longest) matrix padded with NaN, filled without a per-row loop."""
+
+    lengths = np.fromiter(map(len, series), dtype=np.int64, count=len(series))
+    width = max(int(lengths.max(initial=0)), 1)
+    matrix = np.full((len(series), width), np.nan)
+    matrix[np.arange(width) < lengths[:, None]] = np.fromiter(
+        chain.from_iterable(series), dtype=np.float64, count=int(lengths.sum())
+    )
+    return matrix, lengths
+
+
+def _row_percentiles(matrix, lengths, percentiles):
+    """
+    Percentiles of each row (linear interpolation, like numpy's default),
+    shape (len(percentiles), rows); NaN for rows without data. One sort of
+    the whole matrix instead of nanpercentile's per-row work.
+    """
+
+    ordered = np.sort(matrix, axis=1)  # NaN padding sorts last
+    rows = np.arange(len(matrix))
+    last = np.maximum(lengths - 1, 0)
+
+    result = np.empty((len(percentiles), len(matrix)))
+    for position, percentile in enumerate(percentiles):
+        rank = last * percentile / 100
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.ceil(rank).astype(np.int64)
+        low_values, high_values = ordered[rows, lower], ordered[rows, upper]
+        result[position] = low_values + (high_values - low_values) * (rank - lower)
+
+    result[:, lengths == 0] = np.nan
+    return result
+
+
+def fleet_stats(instance_ids, metrics, memory):
+    """
+    Per-instance usage statistics over hourly series, vectorized across the batch.
+
+    Returns arrays aligned with `instance_ids`: hours of CPU data, CPU mean,
+    p95, p99 and peak (percent), network p99 (Gbps, in + out) and memory p99
+    (percent, NaN without the CloudWatch agent).
+    """
+
+    cpu, cpu_hours = _to_matrix([metrics[iid][CPU_METRIC] for iid in instance_ids])
+    cpu_p95, cpu_p99, cpu_peak = _row_percentiles(cpu, cpu_hours, [95, 99, 100])
+
+    network_bytes = np.zeros(len(instance_ids))
+    for name in NETWORK_METRICS:
+        values, hours = _to_matrix([metrics[iid][name] for iid in instance_ids])
+        network_bytes += np.nan_to_num(_row_percentiles(values, hours, [99])[0])
+
+    memory_used, memory_hours = _to_matrix([memory.get(iid, {}).get(MEMORY_METRIC, []) for iid in instance_ids])
+
+    return {
+        "cpu_hours": cpu_hours,
+        "cpu_mean": np.nansum(cpu, axis=1) / np.maximum(cpu_hours, 1),
+        "cpu_p95": cpu_p95,
+        "cpu_p99": cpu_p99,
+        "cpu_peak": cpu_peak,
+        # Hourly byte sums to gigabits per second.
+        "network_p99_gbps": network_bytes * 8 / 3600 / 1e9,
+        "memory_p99": _row_percentiles(memory_used, memory_hours, [99])[0],
+    }
+
+
+def recommend(catalog, prices, current_types, stats):
+    """
+    Cheapest catalog type per instance that fits its usage, vectorized as an
+    instances x types feasibility matrix.
+
+    A type fits when it has the same architecture, keeps p99 CPU at or below
+    the target utilization, has enough memory (p99 at or below target when
+    the agent reports memory, otherwise at least the current memory), covers
+    p99 network bandwidth and, if burstable, has a baseline above mean CPU.
+    Returns (current index, recommended index, current price, recommended
+    price); recommended index is -1 where nothing is cheaper enough.
+    """
+
+    current = np.array([catalog.index[name] for name in current_types], dtype=np.int64)
+    vcpu = catalog.vcpu[current]
+    memory = catalog.memory_gib[current]
+
+    cpu_peak_demand = vcpu * stats["cpu_p99"] / 100
+    cpu_mean_demand = vcpu * stats["cpu_mean"] / 100
+    memory_demand = np.where(
+        np.isnan(stats["memory_p99"]),
+        memory,
+        memory * stats["memory_p99"] / RIGHTSIZING_TARGET_MEMORY_PERCENT
+    )
+
+    fits = (
+        (catalog.arch[None, :] == catalog.arch[current][:, None])
+        & (catalog.vcpu[None, :] * RIGHTSIZING_TARGET_CPU_PERCENT / 100 >= cpu_peak_demand[:, None])
+        & (catalog.memory_gib[None, :] >= memory_demand[:, None])
+        & (catalog.network_gbps[None, :] >= stats["network_p99_gbps"][:, None])
+        & ((catalog.burst_baseline[None, :] == 0)
+           | (catalog.burst_baseline[None, :] * catalog.vcpu[None, :] >= cpu_mean_demand[:, None]))
+        & ~np.isnan(prices)[None, :]
+    )
+
+    cost = np.where(fits, prices[None, :], np.inf)
+    best = np.argmin(cost, axis=1)
+    best_price = cost[np.arange(len(current)), best]
+    current_price = prices[current]
+
+    worthwhile = (
+        np.isfinite(best_price)
+        & (best != current)
+        & (best_price <= current_price * (1 - RIGHTSIZING_MIN_SAVINGS_PERCENT / 100))
+    )
+    return current, np.where(worthwhile, best, -1), current_price, best_price
+
+
+def _size_batch(cloudwatch, catalog, prices, instances, memory_dimensions, start_time, end_time):
+
+    instance_ids = [instance["InstanceId"] for instance in instances]
+    current_types = [instance["InstanceType"] for instance in instances]
+
+    metrics = get_instance_metrics(cloudwatch, instance_ids, METRIC_NAMES, start_time, end_time, period=3600)
+    with_agent = [iid for iid in instance_ids if iid in memory_dimensions]
+    memory = get_instance_metrics(
+        cloudwatch, with_agent, [MEMORY_METRIC], start_time, end_time,
+        period=3600, namespace=AGENT_NAMESPACE, dimensions=memory_dimensions
+    ) if with_agent else {}
+
+    # Instances whose metric batch failed are left out rather than sized on no data.
+    keep = [position for position, iid in enumerate(instance_ids) if iid in metrics]
+    instance_ids = [instance_ids[position] for position in keep]
+    current_types = [current_types[position] for position in keep]
+    if not instance_ids:
+        return []
+
+    stats = fleet_stats(instance_ids, metrics, memory)
+    _, best, current_price, best_price = recommend(catalog, prices, current_types, stats)
+
+    # Idle instances are reported by the idle check; young ones lack data.
+    candidates = (best >= 0) & (stats["cpu_hours"] >= MIN_HOURS) & (stats["cpu_mean"] > IDLE_CPU_THRESHOLD)
+
+    recommendations = []
+    for position in np.flatnonzero(candidates):
+        mean = stats["cpu_mean"][position]
+        recommended = catalog.names[best[position]]
+        memory_p99 = stats["memory_p99"][position]
+        recommendations.append({
+            "resource_id": instance_ids[position],
+            "action": "notify",
+            "resource_type": "EC2 Instance",
+            "reason": (
+                f"Underutilized: CPU p95 {stats['cpu_p95'][position]:.0f}%, p99 {stats['cpu_p99'][position]:.0f}%, "
+                f"peak/mean {stats['cpu_peak'][position] / mean:.1f} over {RIGHTSIZING_LOOKBACK_DAYS} days; "
+                f"resize {current_types[position]} -> {recommended}"
+            ),
+            "instance_type": current_types[position],
+            "recommended_type": recommended,
+            "cpu_p95": round(float(stats["cpu_p95"][position]), 1),
+            "cpu_p99": round(float(stats["cpu_p99"][position]), 1),
+            "memory_p99": None if np.isnan(memory_p99) else round(float(memory_p99), 1),
+            "monthly_savings": round(float(current_price[position] - best_price[position]) * HOURS_PER_MONTH, 2),
+            "timestamp": run_timestamp()
+        })
+
+    return recommendations
+
+
+def recommend_rightsizing(ec2=None, cloudwatch=None, policy=None):
+    """Recommend cheaper instance types for running instances that use a fraction of their capacity."""
+
+    if not RIGHTSIZING_ENABLED:
+        return []
+    if np is None:
+        logger.warning("numpy is not installed, skipping rightsizing")
+        return []
+
+    ec2 = ec2 or get_client("ec2")
+    cloudwatch = cloudwatch or get_client("cloudwatch")
+    region = ec2.meta.region_name
+    policy = policy or get_policy(region=region)
+    recommendations = []
+
+    try:
+        catalog = load_catalog()
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Failed to load instance catalog {INSTANCE_CATALOG_FILE}: {str(e)}")
+        return []
+
+    seen = set()
+    prices = None
+
+    try:
+        end_time = run_time()
+        start_time = end_time - timedelta(days=RIGHTSIZING_LOOKBACK_DAYS)
+        memory_dimensions = find_agent_metric_dimensions(cloudwatch)
+
+        instances = iter_instances(ec2, filters=[{"Name": "instance-state-name", "Values": ["running"]}])
+        known = (
+            instance for instance in instances
+            if instance.get("InstanceType") in catalog.index
+            and not policy.evaluate("instance", instance.get("Tags")).excluded
+        )
+
+        for batch in iter_batches(known, RIGHTSIZING_BATCH_SIZE):
+            # Only the types instances run are refreshed; the other candidates keep listed or cached prices.
+            new_types = {instance["InstanceType"] for instance in batch} - seen
+            if new_types or prices is None:
+                seen |= new_types
+                refresh_prices({(region, "ec2", name) for name in new_types})
+                prices = catalog.prices(region)
+            recommendations.extend(
+                _size_batch(cloudwatch, catalog, prices, batch, memory_dimensions, start_time, end_time)
+            )
+
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f"Error describing instances for rightsizing: {str(e)}")
+
+    logger.info(f"Rightsizing recommended {len(recommendations)} instance type changes")
+    return recommendations
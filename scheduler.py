@@ -0,0 +1,201 @@
+import sys
+import time
+import logging
+import importlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from aws_clients import get_client
+from instrumentation import span
+from checkpoint import RunSuspended, time_is_short
+from config import SCANNER_MAX_WORKERS, SCANNER_TIMEOUT_SECONDS, HANDLER_RESERVED_SECONDS
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Used when no Lambda context is available, e.g. when running locally.
+DEFAULT_BUDGET_SECONDS = 900
+
+
+def build_clients(services, session=None):
+    """One client per service from the shared registry, used by every scanner thread."""
+
+    return {service: get_client(service, session=session) for service in services}
+
+
+def required_services(scanners):
+    """Services the given scanners need clients for."""
+
+    return sorted({service for spec in scanners.values() for service in spec.get("clients", {}).values()})
+
+
+def select_scanners(scanners, names=None):
+    """
+    The scanners named in `names` (all when empty) plus those they run
+    after. Unknown names are logged and ignored.
+    """
+
+    if not names:
+        return dict(scanners)
+
+    for name in names:
+        if name not in scanners:
+            logger.error(f"Ignoring unknown scanner {name}")
+
+    selected = set()
+    pending = [name for name in names if name in scanners]
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(dep for dep in scanners[name].get("after", []) if dep in scanners)
+
+    return {name: spec for name, spec in scanners.items() if name in selected}
+
+
+def load_scanner(func):
+    """
+    A scanner function, importing its module on first use when `func` is
+    a "module:function" string so that scanners a run does not enable are
+    never imported.
+    """
+
+    if callable(func):
+        return func
+
+    module_name, function_name = func.split(":")
+    if module_name in sys.modules:
+        return getattr(sys.modules[module_name], function_name)
+
+    with span(f"import:{module_name}"):
+        module = importlib.import_module(module_name)
+    return getattr(module, function_name)
+
+
+def get_deadline(context, reserved_seconds=HANDLER_RESERVED_SECONDS):
+    """Monotonic time by which all scanners must finish, leaving room for upload and notify."""
+
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        remaining = context.get_remaining_time_in_millis() / 1000
+    else:
+        remaining = DEFAULT_BUDGET_SECONDS
+
+    return time.monotonic() + max(0, remaining - reserved_seconds)
+
+
+def _run_timed(name, func, **kwargs):
+
+    func = load_scanner(func)
+    with span(f"scanner:{name}"):
+        return func(**kwargs)
+
+
+def run_scanners(scanners, clients, context=None, max_workers=SCANNER_MAX_WORKERS,
+                 timeout_seconds=SCANNER_TIMEOUT_SECONDS, policy=None, progress=None):
+    """
+    Run scanners concurrently on a bounded thread pool.
+
+    `scanners` maps a scanner name to a spec with:
+      - "func": the cleanup function, or "module:function" to import it
+        only when the scanner runs; it returns a list of log entries
+      - "clients": map of keyword argument -> service name in `clients`
+      - "after": names of scanners that must finish before this one starts
+      - "description": human readable label used in error logs
+      - "resumable": whether the scanner takes a `cursor` to continue a
+        listing from a checkpoint
+
+    `policy`, if given, is passed to every scanner as its `policy` argument.
+
+    With a checkpoint `progress`, scanners finished in an earlier invocation
+    are not run again, finished scanners are saved, and scanners are not
+    started, or stop at their next page, once time is short.
+
+    A scanner whose dependency timed out (and may still be running) is skipped.
+    Returns (log_entries, status) where status maps scanner name to one of
+    "completed", "failed", "timed_out", "suspended" or "skipped".
+    """
+
+    deadline = get_deadline(context)
+    results = {}
+    status = {}
+    pending = dict(scanners)
+    running = {}
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scanner")
+
+    try:
+        while pending or running:
+
+            for name, spec in list(pending.items()):
+                after = spec.get("after", [])
+                unknown = [dep for dep in after if dep not in scanners]
+                blocked = [dep for dep in after if status.get(dep) in {"timed_out", "skipped"}]
+                waiting = [dep for dep in after if status.get(dep) == "suspended"]
+
+                if unknown or blocked:
+                    logger.error(f"Skipping {spec['description']}: dependency {(unknown or blocked)[0]} did not finish")
+                    status[name] = "skipped"
+                    del pending[name]
+                    continue
+
+                if progress is not None and progress.completed_scanner(name) is not None:
+                    results[name] = progress.completed_scanner(name)
+                    status[name] = "completed"
+                    del pending[name]
+                    continue
+
+                if progress is not None and (waiting or (all(dep in status for dep in after) and time_is_short())):
+                    status[name] = "suspended"
+                    progress.suspend(f"scanner {name}")
+                    del pending[name]
+                    continue
+
+                if all(dep in status for dep in after):
+                    kwargs = {arg: clients[service] for arg, service in spec.get("clients", {}).items()}
+                    if policy is not None:
+                        kwargs["policy"] = policy
+                    if progress is not None and spec.get("resumable"):
+                        kwargs["cursor"] = progress.cursor(name)
+                    future = executor.submit(_run_timed, name, spec["func"], **kwargs)
+                    expires_at = min(time.monotonic() + timeout_seconds, deadline)
+                    running[future] = (name, expires_at)
+                    del pending[name]
+
+            if not running:
+                break
+
+            next_expiry = min(expires_at for _, expires_at in running.values())
+            done, _ = wait(running, timeout=max(0, next_expiry - time.monotonic()),
+                           return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name, _ = running.pop(future)
+                description = scanners[name]["description"]
+                try:
+                    results[name] = future.result() or []
+                    status[name] = "completed"
+                    if progress is not None:
+                        progress.complete_scanner(name, results[name])
+                except RunSuspended:
+                    status[name] = "suspended"
+                except Exception as e:
+                    logger.error(f"Error during {description}: {str(e)}")
+                    status[name] = "failed"
+
+            now = time.monotonic()
+            for future, (name, expires_at) in list(running.items()):
+                if now >= expires_at:
+                    logger.error(f"Error during {scanners[name]['description']}: timed out, result discarded")
+                    future.cancel()
+                    status[name] = "timed_out"
+                    del running[future]
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    for name in scanners:
+        logger.info(f"Scanner {name}: {status.get(name, 'skipped')}")
+
+    log_entries = []
+    for name in scanners:
+        log_entries.extend(results.get(name, []))
+
+    return log_entries, status
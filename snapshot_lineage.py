@@ -0,0 +1,263 @@
+import hashlib
+import logging
+from collections import defaultdict
+from botocore.exceptions import ClientError, BotoCoreError
+from config import LINEAGE_MAX_DIFF_CALLS, SNAPSHOT_MAX_DELETIONS_PER_RUN
+from inventory import iter_snapshots
+from state_store import cache_get, cache_put
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+GIB = 1024 ** 3
+DEFAULT_BLOCK_SIZE = 512 * 1024
+
+# Snapshots copied from another snapshot report this instead of a real volume.
+PLACEHOLDER_VOLUME_ID = "vol-ffffffff"
+
+# Values per describe_snapshots volume-id filter.
+VOLUME_FILTER_CHUNK = 200
+
+# Without these permissions no block diff will succeed, so stop asking.
+ACCESS_DENIED_CODES = {"AccessDeniedException", "UnauthorizedOperation", "AccessDenied"}
+
+
+class BlockDiffBudgetExhausted(Exception):
+    pass
+
+
+class BlockDiffs:
+    """Blocks written between consecutive snapshots, read through the EBS direct APIs at most once per run."""
+
+    def __init__(self, ebs, max_calls=LINEAGE_MAX_DIFF_CALLS):
+        self.ebs = ebs
+        self.calls_left = max_calls
+        self.block_size = DEFAULT_BLOCK_SIZE
+        self.written = {}
+
+    def _pages(self, operation, result_key, **kwargs):
+
+        while True:
+            if self.calls_left <= 0:
+                raise BlockDiffBudgetExhausted()
+            self.calls_left -= 1
+
+            response = getattr(self.ebs, operation)(MaxResults=10000, **kwargs)
+            self.block_size = response.get("BlockSize", self.block_size)
+            yield from response.get(result_key, [])
+
+            if not response.get("NextToken"):
+                return
+            kwargs["NextToken"] = response["NextToken"]
+
+    def blocks_written(self, previous_id, snapshot_id):
+        """Indexes of the blocks `snapshot_id` stores; `previous_id` is None for the first of a lineage."""
+
+        key = (previous_id, snapshot_id)
+        if key not in self.written:
+            if previous_id is None:
+                blocks = self._pages("list_snapshot_blocks", "Blocks", SnapshotId=snapshot_id)
+            else:
+                blocks = self._pages("list_changed_blocks", "ChangedBlocks",
+                                     FirstSnapshotId=previous_id, SecondSnapshotId=snapshot_id)
+            self.written[key] = {block["BlockIndex"] for block in blocks}
+        return self.written[key]
+
+
+def load_lineages(ec2, volume_ids):
+    """Every completed snapshot of the given volumes, grouped by volume and ordered by StartTime."""
+
+    lineages = defaultdict(list)
+    volume_ids = sorted(volume_ids)
+
+    for offset in range(0, len(volume_ids), VOLUME_FILTER_CHUNK):
+        filters = [
+            {"Name": "volume-id", "Values": volume_ids[offset:offset + VOLUME_FILTER_CHUNK]},
+            {"Name": "status", "Values": ["completed"]}
+        ]
+        for snapshot in iter_snapshots(ec2, filters=filters):
+            lineages[snapshot["VolumeId"]].append((snapshot["StartTime"], snapshot["SnapshotId"]))
+
+    return {volume_id: [snapshot_id for _, snapshot_id in sorted(chain)] for volume_id, chain in lineages.items()}
+
+
+def _freed_in_run(diffs, chain, start, end):
+    """
+    Bytes freed per snapshot when chain[start..end] are all deleted.
+
+    A snapshot stores the blocks written since its predecessor. Deleting a
+    run of snapshots frees a stored block if a later snapshot in the run, or
+    the first kept snapshot after it, rewrote that block. If no snapshot
+    follows the run, every block the run stores is freed.
+    """
+
+    previous_id = chain[start - 1] if start else None
+    following_id = chain[end + 1] if end + 1 < len(chain) else None
+    run = chain[start:end + 1]
+
+    # The result depends only on the run and its neighbours, and snapshots never change.
+    signature = "|".join([previous_id or "", *run, following_id or ""])
+    cache_key = "ebs-freed:" + hashlib.sha1(signature.encode("utf-8")).hexdigest()
+    cached = cache_get(cache_key)
+    if cached is not None:
+        return dict(zip(run, cached))
+
+    rewritten = set(diffs.blocks_written(chain[end], following_id)) if following_id else None
+    freed = []
+    for index in range(end, start - 1, -1):
+        written = diffs.blocks_written(chain[index - 1] if index else None, chain[index])
+        if rewritten is None:
+            freed.append(len(written) * diffs.block_size)
+        else:
+            freed.append(len(written & rewritten) * diffs.block_size)
+            rewritten |= written
+
+    freed.reverse()
+    cache_put(cache_key, freed)
+    return dict(zip(run, freed))
+
+
+def _runs(chain, deleting):
+    """(start, end) of each stretch of consecutive snapshots in `chain` that are all in `deleting`."""
+
+    runs = []
+    position = 0
+    while position < len(chain):
+        if chain[position] not in deleting:
+            position += 1
+            continue
+        end = position
+        while end + 1 < len(chain) and chain[end + 1] in deleting:
+            end += 1
+        runs.append((position, end))
+        position = end + 1
+    return runs
+
+
+class _Unit:
+    """
+    Deletions that are selected together: a run of one lineage starting at
+    chain[start], whose freed bytes hold only if all of it is deleted, or a
+    single snapshot that keeps its volume-size estimate (no chain).
+    """
+
+    def __init__(self, actions, freed, chain=None, start=None):
+        self.actions = actions
+        self.freed = freed
+        self.chain = chain
+        self.start = start
+
+    @property
+    def density(self):
+
+        return sum(self.freed) / len(self.actions)
+
+
+def _lineage_units(ec2, ebs, candidates, max_diff_calls):
+    """`candidates` as units, with freed bytes from block diffs where the budget allows."""
+
+    by_volume = defaultdict(dict)
+    units = []
+    for volume_id, action in candidates:
+        if volume_id and volume_id != PLACEHOLDER_VOLUME_ID:
+            by_volume[volume_id][action["resource_id"]] = action
+        else:
+            units.append(_Unit([action], [(action.get("size_gb") or 0) * GIB]))
+
+    lineages = {}
+    if by_volume:
+        try:
+            lineages = load_lineages(ec2, by_volume)
+        except (ClientError, BotoCoreError) as e:
+            logger.error(f"Error loading snapshot lineages: {str(e)}")
+
+    diffs = BlockDiffs(ebs, max_diff_calls)
+    diffs_available = True
+    estimated = 0
+
+    for volume_id, deleting in by_volume.items():
+        chain = lineages.get(volume_id, [])
+        for start, end in _runs(chain, deleting):
+            run = chain[start:end + 1]
+            freed = None
+            if diffs_available:
+                try:
+                    freed = _freed_in_run(diffs, chain, start, end)
+                except BlockDiffBudgetExhausted:
+                    logger.warning(f"Block diff budget of {max_diff_calls} calls used up, "
+                                   f"remaining snapshots keep their volume-size estimate")
+                    diffs_available = False
+                except ClientError as e:
+                    logger.warning(f"No block diffs for volume {volume_id}, keeping the volume-size estimate: {str(e)}")
+                    if e.response["Error"]["Code"] in ACCESS_DENIED_CODES:
+                        diffs_available = False
+                except BotoCoreError as e:
+                    logger.warning(f"No block diffs for volume {volume_id}, keeping the volume-size estimate: {str(e)}")
+
+            if freed is None:
+                units.extend(_Unit([deleting[snapshot_id]], [(deleting[snapshot_id].get("size_gb") or 0) * GIB])
+                             for snapshot_id in run)
+            else:
+                units.append(_Unit([deleting[snapshot_id] for snapshot_id in run],
+                                   [freed[snapshot_id] for snapshot_id in run], chain, start))
+                estimated += len(run)
+
+        # Candidates missing from the lineage (e.g. no longer completed) keep their estimate.
+        in_chain = set(chain)
+        units.extend(_Unit([action], [(action.get("size_gb") or 0) * GIB])
+                     for snapshot_id, action in deleting.items() if snapshot_id not in in_chain)
+
+    logger.info(f"Estimated reclaimable storage of {estimated} snapshots across {len(lineages)} lineages "
+                f"with {max_diff_calls - diffs.calls_left} block diff calls")
+    return units, diffs
+
+
+def select_deletions(ec2, ebs, candidates, max_deletions=SNAPSHOT_MAX_DELETIONS_PER_RUN,
+                     max_diff_calls=LINEAGE_MAX_DIFF_CALLS):
+    """
+    The at most `max_deletions` snapshot deletions, from (volume_id, action)
+    candidates, that reclaim the most storage; the rest are planned again on
+    a later run.
+
+    A snapshot stores the blocks written since its predecessor, so what it
+    frees depends on which of its neighbours are deleted with it. Runs of
+    consecutive candidates in a volume's lineage are taken whole, most
+    storage per deletion first; a run longer than the room left is cut to
+    its oldest part, re-estimated for exactly that part, and ranked again.
+    Chosen actions get "size_gb" set to the GiB they free and
+    "reclaim_estimate" to "block_diff"; the others keep their volume-size
+    upper bound.
+    """
+
+    units, diffs = _lineage_units(ec2, ebs, candidates, max_diff_calls)
+    pending = sorted(units, key=lambda unit: unit.density, reverse=True)
+
+    chosen = []
+    room = max_deletions
+    while pending and room:
+        unit = pending.pop(0)
+        if len(unit.actions) <= room:
+            chosen.append(unit)
+            room -= len(unit.actions)
+        elif unit.chain is not None:
+            # Only the oldest part of the run fits; the first snapshot kept after it changes what it frees.
+            try:
+                freed = _freed_in_run(diffs, unit.chain, unit.start, unit.start + room - 1)
+            except (BlockDiffBudgetExhausted, ClientError, BotoCoreError) as e:
+                logger.warning(f"Cannot estimate part of a snapshot run, deferring all of it: {str(e)}")
+                continue
+            part = unit.chain[unit.start:unit.start + room]
+            pending.append(_Unit(unit.actions[:room], [freed[snapshot_id] for snapshot_id in part],
+                                 unit.chain, unit.start))
+            pending.sort(key=lambda unit: unit.density, reverse=True)
+
+    selected = []
+    for unit in chosen:
+        for action, freed in zip(unit.actions, unit.freed):
+            if unit.chain is not None:
+                action["size_gb"] = round(freed / GIB, 3)
+                action["reclaim_estimate"] = "block_diff"
+            selected.append(action)
+
+    logger.info(f"Deferring {len(candidates) - len(selected)} snapshot deletions that reclaim the least storage")
+    return sorted(selected, key=lambda action: action.get("size_gb") or 0, reverse=True)
@@ -0,0 +1,199 @@
+import gzip
+import json
+import time
+import zlib
+import logging
+import threading
+from botocore.exceptions import ClientError, BotoCoreError
+from aws_clients import get_client
+from config import (
+    STATE_STORE_ENABLED, STATE_STORE_PATH, STATE_STORE_KEY, STATE_TTL_DAYS, LOG_S3_BUCKET,
+    NOTIFY_STATE_PATH, NOTIFY_STATE_KEY
+)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+FORMAT_VERSION = 1
+
+# resource_id -> [fingerprint, recheck_at, last_seen], times in epoch seconds.
+# Only "keep" verdicts are stored; anything else is re-evaluated every run.
+_resources = {}
+# key -> [value, last_used] for derived results that never change, e.g. EBS block diffs.
+_cache = {}
+_lock = threading.Lock()
+_loaded = False
+
+
+def _read(path=STATE_STORE_PATH, key=STATE_STORE_KEY):
+
+    if path:
+        with open(path, "rb") as f:
+            return f.read()
+
+    s3 = get_client("s3")
+    return s3.get_object(Bucket=LOG_S3_BUCKET, Key=key)["Body"].read()
+
+
+def _write(data, path=STATE_STORE_PATH, key=STATE_STORE_KEY):
+
+    if path:
+        with open(path, "wb") as f:
+            f.write(data)
+        return
+
+    s3 = get_client("s3")
+    s3.put_object(Bucket=LOG_S3_BUCKET, Key=key, Body=data, ContentEncoding="gzip")
+
+
+def load_state():
+    """Load the store once per invocation. A missing or corrupt store means a full rescan."""
+
+    global _resources, _cache, _loaded
+
+    _resources = {}
+    _cache = {}
+    _loaded = STATE_STORE_ENABLED
+    if not STATE_STORE_ENABLED:
+        return
+
+    try:
+        document = json.loads(gzip.decompress(_read()))
+        if document.get("version") != FORMAT_VERSION:
+            raise ValueError(f"unsupported version {document.get('version')}")
+        _resources = {
+            resource_id: [entry[0], float(entry[1]), float(entry[2])]
+            for resource_id, entry in document["resources"].items()
+        }
+        _cache = {key: [entry[0], float(entry[1])] for key, entry in document.get("cache", {}).items()}
+        logger.info(f"Loaded state for {len(_resources)} resources and {len(_cache)} cached results")
+
+    except FileNotFoundError:
+        logger.info("No resource state found, running a full scan")
+    except ClientError as e:
+        if e.response["Error"]["Code"] in {"NoSuchKey", "404"}:
+            logger.info("No resource state found, running a full scan")
+        else:
+            logger.error(f"Failed to load resource state, running a full scan: {str(e)}")
+    except (BotoCoreError, OSError, EOFError, zlib.error, ValueError, KeyError, TypeError, IndexError) as e:
+        logger.warning(f"Resource state is unreadable, running a full scan: {str(e)}")
+        _resources = {}
+        _cache = {}
+
+
+def disable_state():
+    """
+    Use no stored state for this invocation, so every resource is evaluated.
+    Cached results stay available in memory.
+    """
+
+    global _resources, _loaded
+
+    with _lock:
+        _resources = {}
+        _loaded = False
+
+
+def save_state():
+    """Evict entries not seen within STATE_TTL_DAYS and persist the rest."""
+
+    if not _loaded:
+        return
+
+    cutoff = time.time() - STATE_TTL_DAYS * 86400
+    with _lock:
+        resources = {rid: entry for rid, entry in _resources.items() if entry[2] >= cutoff}
+        cache = {key: entry for key, entry in _cache.items() if entry[1] >= cutoff}
+
+    document = {"version": FORMAT_VERSION, "resources": resources, "cache": cache}
+    data = gzip.compress(json.dumps(document, separators=(",", ":")).encode("utf-8"))
+
+    try:
+        _write(data)
+        logger.info(f"Saved state for {len(resources)} resources ({len(data)} bytes)")
+    except (ClientError, BotoCoreError, OSError) as e:
+        logger.error(f"Failed to save resource state: {str(e)}")
+
+
+def needs_evaluation(resource_id, fingerprint, now=None):
+    """
+    False only when the resource was kept last time, is unchanged, and has
+    not reached its recheck time. Marks the resource as seen either way.
+    """
+
+    if not _loaded:
+        return True
+
+    now = now or time.time()
+    with _lock:
+        entry = _resources.get(resource_id)
+        if entry is None or entry[0] != fingerprint or entry[1] <= now:
+            return True
+        entry[2] = now
+        return False
+
+
+def record_kept(resource_id, fingerprint, recheck_at, now=None):
+    """Remember that a resource was kept and when it has to be looked at again."""
+
+    if not _loaded:
+        return
+
+    with _lock:
+        _resources[resource_id] = [fingerprint, recheck_at, now or time.time()]
+
+
+def cache_get(key, now=None):
+    """A cached result, or None. Works without a loaded store, but then only for this process."""
+
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        entry[1] = now or time.time()
+        return entry[0]
+
+
+def cache_put(key, value, now=None):
+
+    with _lock:
+        _cache[key] = [value, now or time.time()]
+
+
+def load_notified():
+    """
+    Fingerprint -> epoch seconds of the alerts sent recently. Kept apart
+    from the resource state, so it is read and written in event-driven runs
+    and with STATE_STORE_ENABLED off as well.
+    """
+
+    try:
+        document = json.loads(gzip.decompress(_read(NOTIFY_STATE_PATH, NOTIFY_STATE_KEY)))
+        if document.get("version") != FORMAT_VERSION:
+            raise ValueError(f"unsupported version {document.get('version')}")
+        return {fingerprint: float(sent_at) for fingerprint, sent_at in document["notified"].items()}
+
+    except FileNotFoundError:
+        pass
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in {"NoSuchKey", "404"}:
+            logger.error(f"Failed to load sent notifications, alerts may repeat: {str(e)}")
+    except (BotoCoreError, OSError, EOFError, zlib.error, ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning(f"Sent notifications are unreadable, alerts may repeat: {str(e)}")
+    return {}
+
+
+def save_notified(notified, max_age_seconds):
+    """Persist the fingerprints of alerts sent within the last `max_age_seconds`."""
+
+    cutoff = time.time() - max_age_seconds
+    document = {
+        "version": FORMAT_VERSION,
+        "notified": {fingerprint: sent_at for fingerprint, sent_at in notified.items() if sent_at >= cutoff}
+    }
+    data = gzip.compress(json.dumps(document, separators=(",", ":")).encode("utf-8"))
+
+    try:
+        _write(data, NOTIFY_STATE_PATH, NOTIFY_STATE_KEY)
+    except (ClientError, BotoCoreError, OSError) as e:
+        logger.error(f"Failed to save sent notifications, alerts may repeat: {str(e)}")